@@ -1,164 +1,235 @@
 from flask import Flask, render_template, request, jsonify, send_file
 from flask_cors import CORS
 import fitz  # PyMuPDF
-from PIL import Image, ImageDraw, ImageFont
+from PIL import features
+import hashlib
 import io
 import json
 import os
 import base64
+import functools
+import logging
+import multiprocessing
 from pathlib import Path
 import tempfile
+import threading
 import shutil
 
+from color_sampler import color_to_hex, sample_page_color
+from edit_tracker import EditTracker
+from export_engine import EXPORT_MODE_FULL, export_bytes, export_pool
+from export_profiles import DEFAULT_EXPORT_PROFILE, EXPORT_PROFILES
+from font_registry import font_registry
+from image_cache import ImageCache
+from inserted_images import inserted_images
+from page_edits import collect_page_edits
+from render_service import PAGE_IMAGE_FORMATS, RenderPool
+from session_manager import SessionManager, remove_file
+from tile_renderer import page_pixel_size
+
 app = Flask(__name__)
 CORS(app)  # Разрешаем CORS для работы с разных устройств
 
 # Глобальные переменные для хранения состояния
-pdf_documents = {}  # {session_id: fitz.Document}
-pdf_data = {}  # {session_id: {deletion_areas, color_changes, etc.}}
 upload_dir = Path(tempfile.gettempdir()) / "pdf_editor_uploads"
 upload_dir.mkdir(exist_ok=True)
+# Сессии: документы закрываются по лимиту открытых и открываются заново по требованию,
+# простаивающие сессии удаляются вместе с их файлами и изображениями в кэше
+sessions = SessionManager(upload_dir, on_close=lambda session_id: forget_page_images(session_id),
+                          on_remove=lambda paths: release_worker_files(paths))
+pdf_data = sessions.data  # {session_id: {deletion_areas, color_changes, etc.}}
+# Рендеринг страниц: исполнители открывают документы сами, страницы разных сессий
+# рендерятся параллельно
+render_pool = RenderPool()
+
+# Шаг масштаба: плавное масштабирование не плодит изображения почти одинакового размера
+ZOOM_STEP = 0.05
+# Ограничение кэша закодированных изображений страниц (байты)
+PAGE_IMAGE_CACHE_LIMIT = 128 * 1024 * 1024
+
+# Закодированные изображения страниц:
+# ('page', номер страницы, масштаб, сессия, версия изменений, с изменениями, формат) -> байты
+page_images = ImageCache(PAGE_IMAGE_CACHE_LIMIT)
+
+
+def get_page_edits(session_id, page_num, redact=False):
+    """Изменения страницы сессии в виде словаря (см. page_edits.collect_page_edits)"""
+    data = pdf_data[session_id]
+    # Вставленный контент просматривается, только если он есть на странице
+    has_content = data['edits'].count(page_num, 'inserted_content') > 0
+    return collect_page_edits(
+        page_num,
+        data.get('deletion_areas', []),
+        data.get('color_changes', []),
+        data.get('color_replacements', []),
+        data.get('inserted_content', []) if has_content else [],
+        30,
+        redact
+    )
 
 
-def apply_changes_to_image(img, page_num, session_id, zoom=1.0):
-    """Применение изменений к изображению"""
-    from PIL import ImageDraw
-    
-    if session_id not in pdf_data:
-        return img
-    
+def file_digest(path):
+    """SHA-1 содержимого файла (хэш документа для ETag)"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def quantize_zoom(zoom):
+    """Масштаб, округленный до шага ZOOM_STEP"""
+    return max(ZOOM_STEP, round(round(zoom / ZOOM_STEP) * ZOOM_STEP, 2))
+
+
+def page_changed(session_id, page_num, reset=False, **deltas):
+    """Учет изменения страницы (см. EditTracker.changed); reset - все изменения страницы удалены
+
+    Новая версия страницы делает устаревшими ее изображения в кэше и с прежним ETag.
+    """
+    tracker = pdf_data[session_id]['edits']
+    if reset:
+        tracker.reset_page(page_num)
+    else:
+        tracker.changed(page_num, **deltas)
+    page_images.invalidate(lambda key: key[1] == page_num and key[3] == session_id)
+
+
+def forget_page_images(session_id):
+    """Удаление из кэша всех изображений страниц сессии"""
+    page_images.invalidate(lambda key: key[3] == session_id)
+
+
+def release_worker_files(paths):
+    """Закрытие файлов сессии в процессах рендеринга и сохранения перед их удалением"""
+    render_pool.release(paths)
+    export_pool.release(paths)
+
+
+def page_image_format(requested):
+    """Формат изображения страницы: параметр format, иначе WebP, если его принимает браузер"""
+    if requested == 'webp' and not features.check('webp'):
+        requested = 'png'
+    if requested in PAGE_IMAGE_FORMATS:
+        return requested
+    if 'image/webp' in request.accept_mimetypes and features.check('webp'):
+        return 'webp'
+    return 'png'
+
+
+def page_etag(session_id, page_num, zoom, apply_changes, image_format):
+    """ETag изображения страницы: (хэш документа, страница, масштаб, версия изменений, формат)"""
     data = pdf_data[session_id]
-    deletion_areas = data.get('deletion_areas', [])
-    color_changes = data.get('color_changes', [])
-    color_replacements = data.get('color_replacements', [])
-    inserted_content = data.get('inserted_content', [])
-    
-    img_copy = img.copy()
-    draw = ImageDraw.Draw(img_copy)
-    
-    # Применение удалений
-    if page_num < len(deletion_areas):
-        for area in deletion_areas[page_num]:
-            x1, y1, x2, y2 = area
-            x1_scaled = int(x1 * zoom)
-            y1_scaled = int(y1 * zoom)
-            x2_scaled = int(x2 * zoom)
-            y2_scaled = int(y2 * zoom)
-            
-            x1_scaled = max(0, min(x1_scaled, img.width))
-            y1_scaled = max(0, min(y1_scaled, img.height))
-            x2_scaled = max(0, min(x2_scaled, img.width))
-            y2_scaled = max(0, min(y2_scaled, img.height))
-            
-            if x1_scaled < x2_scaled and y1_scaled < y2_scaled:
-                draw.rectangle([x1_scaled, y1_scaled, x2_scaled, y2_scaled], 
-                             fill=(255, 255, 255), outline=None)
-    
-    # Применение замены цвета в областях
-    if page_num < len(color_changes):
-        for change in color_changes[page_num]:
-            area, orig_color, new_color = change
-            x1, y1, x2, y2 = area
-            x1_scaled = int(x1 * zoom)
-            y1_scaled = int(y1 * zoom)
-            x2_scaled = int(x2 * zoom)
-            y2_scaled = int(y2 * zoom)
-            
-            x1_scaled = max(0, min(x1_scaled, img.width))
-            y1_scaled = max(0, min(y1_scaled, img.height))
-            x2_scaled = max(0, min(x2_scaled, img.width))
-            y2_scaled = max(0, min(y2_scaled, img.height))
-            
-            if x1_scaled < x2_scaled and y1_scaled < y2_scaled:
-                if new_color and new_color.startswith('#'):
-                    try:
-                        r = int(new_color[1:3], 16)
-                        g = int(new_color[3:5], 16)
-                        b = int(new_color[5:7], 16)
-                        draw.rectangle([x1_scaled, y1_scaled, x2_scaled, y2_scaled], 
-                                     fill=(r, g, b), outline=None)
-                    except (ValueError, IndexError):
-                        pass
-    
-    # Применение замены цвета на всей странице
-    if page_num < len(color_replacements) and color_replacements[page_num]:
-        pixels = img_copy.load()
-        width, height = img_copy.size
-        
-        for replacement in color_replacements[page_num]:
-            old_color_hex = replacement['old_color']
-            new_color_hex = replacement['new_color']
-            tolerance = replacement.get('tolerance', 30)
-            
-            try:
-                old_r = int(old_color_hex[1:3], 16)
-                old_g = int(old_color_hex[3:5], 16)
-                old_b = int(old_color_hex[5:7], 16)
-                
-                new_r = int(new_color_hex[1:3], 16)
-                new_g = int(new_color_hex[3:5], 16)
-                new_b = int(new_color_hex[5:7], 16)
-            except (ValueError, IndexError):
-                continue
-            
-            for y in range(height):
-                for x in range(width):
-                    r, g, b = pixels[x, y]
-                    color_distance = ((r - old_r)**2 + (g - old_g)**2 + (b - old_b)**2)**0.5
-                    if color_distance <= tolerance:
-                        pixels[x, y] = (new_r, new_g, new_b)
-    
-    # Применение вставленного контента
-    for content in inserted_content:
-        if content['page'] == page_num:
-            x = int(content['x'] * zoom)
-            y = int(content['y'] * zoom)
-            
-            if content['type'] == 'text':
-                try:
-                    text = content['data']['text']
-                    font_size = content['data']['font_size']
-                    color_hex = content['data']['color']
-                    
-                    r = int(color_hex[1:3], 16)
-                    g = int(color_hex[3:5], 16)
-                    b = int(color_hex[5:7], 16)
-                    
-                    try:
-                        font = ImageFont.truetype("arial.ttf", font_size)
-                    except:
-                        try:
-                            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", font_size)
-                        except:
-                            font = ImageFont.load_default()
-                    
-                    draw.text((x, y), text, fill=(r, g, b), font=font)
-                except Exception:
-                    pass
-            
-            elif content['type'] == 'image':
-                try:
-                    img_path = content['data']['path']
-                    if Path(img_path).exists():
-                        insert_img = Image.open(img_path)
-                        
-                        width = content['data']['width']
-                        height = content['data']['height']
-                        if width > 0 or height > 0:
-                            if width > 0 and height > 0:
-                                insert_img = insert_img.resize((width, height), Image.Resampling.LANCZOS)
-                            elif width > 0:
-                                ratio = width / insert_img.width
-                                insert_img = insert_img.resize((width, int(insert_img.height * ratio)), Image.Resampling.LANCZOS)
-                            elif height > 0:
-                                ratio = height / insert_img.height
-                                insert_img = insert_img.resize((int(insert_img.width * ratio), height), Image.Resampling.LANCZOS)
-                        
-                        img_copy.paste(insert_img, (x, y), insert_img if insert_img.mode == 'RGBA' else None)
-                except Exception:
-                    pass
-    
-    return img_copy
+    version = data['edits'].version(page_num) if apply_changes else 'orig'
+    return f"{data['doc_hash'][:16]}-{page_num}-{zoom:g}-{version}-{image_format}"
+
+
+def page_image_bytes(session_id, page_num, zoom, apply_changes, image_format):
+    """Закодированное изображение страницы (из кэша или из пула рендеринга)
+
+    Под блокировкой сессии берется только снимок изменений страницы: пока
+    страница рендерится, запросы той же сессии не ждут.
+    """
+    with sessions.locked(session_id):
+        data = pdf_data[session_id]
+        version = data['edits'].version(page_num) if apply_changes else None
+        edits = None
+        if apply_changes and data['edits'].has_edits(page_num):
+            edits = get_page_edits(session_id, page_num)
+        file_path, doc_hash = data['file_path'], data['doc_hash']
+    
+    key = ('page', page_num, zoom, session_id, version, apply_changes, image_format)
+    image = page_images.get(key)
+    if image is None:
+        image = render_pool.render(file_path, doc_hash, page_num, zoom, edits, image_format)
+        page_images.put(key, image, len(image))
+    return image
+
+
+def store_output(session_id, pdf_bytes, report):
+    """Готовый PDF сессии для ответа и повторной загрузки (/api/download)
+
+    Ответ на сохранение отдается из памяти; в файл сессии данные
+    записываются в фоне (persist_output), и до этого /api/download тоже
+    отдает их из памяти. Прежний файл сессии удаляется.
+    """
+    pdf_info = pdf_data[session_id]
+    previous = pdf_info.get('output')
+    if previous is not None and previous['path'] is not None:
+        pdf_info['files'].remove(previous['path'])
+        remove_file(previous['path'])
+    pdf_info['output'] = {
+        'data': pdf_bytes,
+        'path': None,
+        'size': len(pdf_bytes),
+        'etag': hashlib.sha1(pdf_bytes).hexdigest(),
+        'report': report,
+    }
+    return pdf_info['output']
+
+
+def persist_output(session_id, output):
+    """Запись готового PDF в файл сессии, после чего данные в памяти освобождаются
+
+    Имя файла содержит хэш содержимого: загрузка, начатая до повторного
+    сохранения, дочитывает уже открытый прежний файл.
+    """
+    file_path = str(upload_dir / f"{session_id}_output_{output['etag'][:16]}.pdf")
+    try:
+        with open(file_path, 'wb') as f:
+            f.write(output['data'])
+    except OSError:
+        # Данные остаются в памяти до следующего сохранения или закрытия сессии
+        logging.getLogger(__name__).exception("Не удалось записать файл сохранения")
+        remove_file(file_path)
+        return
+    with sessions.locked(session_id):
+        pdf_info = pdf_data.get(session_id)
+        if pdf_info is None or pdf_info.get('output') is not output:
+            # Сессия закрыта или документ уже сохранен заново
+            remove_file(file_path)
+            return
+        pdf_info['files'].append(file_path)
+        output['path'] = file_path
+        del output['data']
+
+
+def send_output(output):
+    """Ответ с сохраненным PDF из памяти или из файла сессии
+
+    ETag - хэш содержимого: Range (в том числе с If-Range) и If-None-Match
+    обрабатываются send_file, поэтому прерванную загрузку можно продолжить.
+    """
+    source = output['path'] if output['path'] is not None else io.BytesIO(output['data'])
+    response = send_file(source, mimetype='application/pdf',
+                         as_attachment=True, download_name='edited.pdf',
+                         etag=output['etag'], conditional=True, max_age=0)
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def request_session_id():
+    """Идентификатор сессии запроса (параметр, поле формы или JSON)"""
+    session_id = request.args.get('session_id') or request.form.get('session_id')
+    if session_id is None and request.is_json:
+        session_id = (request.get_json(silent=True) or {}).get('session_id')
+    return session_id or 'default'
+
+
+def session_locked(view):
+    """Обработчик выполняется под блокировкой сессии запроса: данные и документ
+    сессии меняются по одному запросу, разные сессии обрабатываются параллельно"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with sessions.locked(request_session_id()):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+@app.before_request
+def touch_session():
+    """Отметка об обращении к сессии (простаивающие сессии закрываются)"""
+    sessions.touch(request_session_id())
 
 
 @app.route('/')
@@ -216,6 +287,7 @@ def test():
 
 
 @app.route('/api/upload', methods=['POST'])
+@session_locked
 def upload_pdf():
     """Загрузка PDF файла"""
     if 'file' not in request.files:
@@ -236,19 +308,21 @@ def upload_pdf():
         total_pages = len(pdf_doc)
         
         if total_pages == 0:
+            pdf_doc.close()
+            remove_file(file_path)
             return jsonify({'error': 'PDF file is empty'}), 400
         
-        # Сохраняем документ
-        pdf_documents[session_id] = pdf_doc
-        
-        # Инициализируем данные
-        pdf_data[session_id] = {
+        # Сохраняем документ и данные (прежняя сессия с тем же id закрывается)
+        sessions.add(session_id, pdf_doc, {
             'deletion_areas': [[] for _ in range(total_pages)],
             'color_changes': [[] for _ in range(total_pages)],
             'color_replacements': [[] for _ in range(total_pages)],
             'inserted_content': [],
-            'file_path': str(file_path)
-        }
+            'file_path': str(file_path),
+            'files': [str(file_path)],  # Временные файлы сессии (удаляются при ее закрытии)
+            'doc_hash': file_digest(file_path),
+            'edits': EditTracker(total_pages)  # Версии и сводки изменений страниц
+        })
         
         return jsonify({
             'success': True,
@@ -263,45 +337,103 @@ def upload_pdf():
 def get_page(page_num):
     """Получение изображения страницы"""
     session_id = request.args.get('session_id', 'default')
-    zoom = float(request.args.get('zoom', 1.0))
+    zoom = quantize_zoom(float(request.args.get('zoom', 1.0)))
     apply_changes = request.args.get('apply_changes', 'true').lower() == 'true'
     
-    if session_id not in pdf_documents:
+    try:
+        with sessions.locked(session_id):
+            if session_id not in pdf_data:
+                return jsonify({'error': 'PDF not loaded'}), 400
+            
+            pdf_doc = sessions.document(session_id)
+            if page_num < 0 or page_num >= len(pdf_doc):
+                return jsonify({'error': 'Invalid page number'}), 400
+            
+            page = pdf_doc[page_num]
+            width, height = page_pixel_size(page, zoom)
+            page_width, page_height = page.rect.width, page.rect.height
+        
+        # Изображение с изменениями (если нужно) - из кэша или после рендеринга
+        png_data = page_image_bytes(session_id, page_num, zoom, apply_changes, 'png')
+        img_base64 = base64.b64encode(png_data).decode('utf-8')
+        
+        return jsonify({
+            'success': True,
+            'image': f'data:image/png;base64,{img_base64}',
+            'width': width,
+            'height': height,
+            'page_width': page_width,
+            'page_height': page_height
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/page/<int:page_num>/info')
+@session_locked
+def get_page_info(page_num):
+    """Размеры страницы и версия ее изменений (изображение - /api/page/<n>/image)"""
+    session_id = request.args.get('session_id', 'default')
+    
+    if session_id not in pdf_data:
         return jsonify({'error': 'PDF not loaded'}), 400
     
     try:
-        pdf_doc = pdf_documents[session_id]
+        zoom = quantize_zoom(float(request.args.get('zoom', 1.0)))
+        pdf_doc = sessions.document(session_id)
         if page_num < 0 or page_num >= len(pdf_doc):
             return jsonify({'error': 'Invalid page number'}), 400
         
         page = pdf_doc[page_num]
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        
-        # Применяем изменения, если нужно
-        if apply_changes and session_id in pdf_data:
-            img = apply_changes_to_image(img, page_num, session_id, zoom)
-        
-        # Конвертируем в base64
-        img_bytes = io.BytesIO()
-        img.save(img_bytes, format='PNG')
-        img_bytes.seek(0)
-        img_base64 = base64.b64encode(img_bytes.read()).decode('utf-8')
-        
+        width, height = page_pixel_size(page, zoom)
         return jsonify({
             'success': True,
-            'image': f'data:image/png;base64,{img_base64}',
-            'width': img.width,
-            'height': img.height,
+            'width': width,
+            'height': height,
             'page_width': page.rect.width,
-            'page_height': page.rect.height
+            'page_height': page.rect.height,
+            'version': pdf_data[session_id]['edits'].version(page_num),
+            'edits': pdf_data[session_id]['edits'].summary(page_num)
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/page/<int:page_num>/image')
+def get_page_image(page_num):
+    """Изображение страницы (PNG или WebP) с ETag; при совпадении If-None-Match - 304 без рендеринга"""
+    session_id = request.args.get('session_id', 'default')
+    
+    try:
+        zoom = quantize_zoom(float(request.args.get('zoom', 1.0)))
+        apply_changes = request.args.get('apply_changes', 'true').lower() == 'true'
+        image_format = page_image_format(request.args.get('format'))
+        
+        with sessions.locked(session_id):
+            if session_id not in pdf_data:
+                return jsonify({'error': 'PDF not loaded'}), 400
+            if page_num < 0 or page_num >= len(pdf_data[session_id]['edits']):
+                return jsonify({'error': 'Invalid page number'}), 400
+            etag = page_etag(session_id, page_num, zoom, apply_changes, image_format)
+        
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(
+                page_image_bytes(session_id, page_num, zoom, apply_changes, image_format),
+                mimetype=PAGE_IMAGE_FORMATS[image_format][1])
+        
+        response.set_etag(etag)
+        # Браузер хранит изображение, но перед использованием сверяет ETag
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Accept')
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/add_deletion', methods=['POST'])
+@session_locked
 def add_deletion():
     """Добавление области для удаления"""
     data = request.json
@@ -314,12 +446,14 @@ def add_deletion():
     
     if page_num < len(pdf_data[session_id]['deletion_areas']):
         pdf_data[session_id]['deletion_areas'][page_num].append(area)
+        page_changed(session_id, page_num, deletion_areas=1)
         return jsonify({'success': True})
     
     return jsonify({'error': 'Invalid page number'}), 400
 
 
 @app.route('/api/add_color_change', methods=['POST'])
+@session_locked
 def add_color_change():
     """Добавление замены цвета"""
     data = request.json
@@ -334,12 +468,14 @@ def add_color_change():
     
     if page_num < len(pdf_data[session_id]['color_changes']):
         pdf_data[session_id]['color_changes'][page_num].append([area, orig_color, new_color])
+        page_changed(session_id, page_num, color_changes=1)
         return jsonify({'success': True})
     
     return jsonify({'error': 'Invalid page number'}), 400
 
 
 @app.route('/api/add_color_replacement', methods=['POST'])
+@session_locked
 def add_color_replacement():
     """Добавление замены цвета на всю страницу"""
     data = request.json
@@ -358,12 +494,48 @@ def add_color_replacement():
             'new_color': new_color,
             'tolerance': tolerance
         })
+        page_changed(session_id, page_num, color_replacements=1)
         return jsonify({'success': True})
     
     return jsonify({'error': 'Invalid page number'}), 400
 
 
+@app.route('/api/sample_color')
+@session_locked
+def sample_color():
+    """Цвет страницы в точке (пипетка); рендерится только фрагмент вокруг точки"""
+    session_id = request.args.get('session_id', 'default')
+    
+    if session_id not in pdf_data:
+        return jsonify({'error': 'PDF not loaded'}), 400
+    
+    try:
+        page_num = int(request.args.get('page_num', 0))
+        x = float(request.args.get('x', 0))
+        y = float(request.args.get('y', 0))
+        zoom = float(request.args.get('zoom', 1.0))
+        radius = int(request.args.get('radius', 0))
+        
+        pdf_doc = sessions.document(session_id)
+        if page_num < 0 or page_num >= len(pdf_doc):
+            return jsonify({'error': 'Invalid page number'}), 400
+        
+        page = pdf_doc[page_num]
+        if not (0 <= x < page.rect.width and 0 <= y < page.rect.height):
+            return jsonify({'error': 'Point is outside the page'}), 400
+        
+        rgb = sample_page_color(page, x, y, zoom, radius)
+        return jsonify({
+            'success': True,
+            'color': color_to_hex(rgb),
+            'rgb': list(rgb)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/add_content', methods=['POST'])
+@session_locked
 def add_content():
     """Добавление вставленного контента"""
     data = request.json
@@ -379,19 +551,26 @@ def add_content():
             file_path = upload_dir / f"{session_id}_img_{file.filename}"
             file.save(str(file_path))
             data['data']['path'] = str(file_path)
+            pdf_data[session_id]['files'].append(str(file_path))
+    
+    page_num = data.get('page_num', 0)
+    if not 0 <= page_num < len(pdf_data[session_id]['edits'].versions):
+        return jsonify({'error': 'Invalid page number'}), 400
     
     pdf_data[session_id]['inserted_content'].append({
-        'page': data.get('page_num', 0),
+        'page': page_num,
         'type': data.get('type'),
         'x': data.get('x'),
         'y': data.get('y'),
         'data': data.get('data')
     })
+    page_changed(session_id, page_num, inserted_content=1)
     
     return jsonify({'success': True})
 
 
 @app.route('/api/delete_item', methods=['POST'])
+@session_locked
 def delete_item():
     """Удаление элемента"""
     data = request.json
@@ -407,13 +586,16 @@ def delete_item():
         if item_type == 'deletion' and page_num < len(pdf_data[session_id]['deletion_areas']):
             if 0 <= index < len(pdf_data[session_id]['deletion_areas'][page_num]):
                 del pdf_data[session_id]['deletion_areas'][page_num][index]
+                page_changed(session_id, page_num, deletion_areas=-1)
         elif item_type == 'color' and page_num < len(pdf_data[session_id]['color_changes']):
             if 0 <= index < len(pdf_data[session_id]['color_changes'][page_num]):
                 del pdf_data[session_id]['color_changes'][page_num][index]
+                page_changed(session_id, page_num, color_changes=-1)
         elif item_type == 'content':
             content_list = pdf_data[session_id]['inserted_content']
             if 0 <= index < len(content_list) and content_list[index]['page'] == page_num:
                 del content_list[index]
+                page_changed(session_id, page_num, inserted_content=-1)
         
         return jsonify({'success': True})
     except Exception as e:
@@ -421,145 +603,112 @@ def delete_item():
 
 
 @app.route('/api/save', methods=['POST'])
+@session_locked
 def save_pdf():
     """Сохранение PDF"""
     data = request.json
     session_id = data.get('session_id', 'default')
     
-    if session_id not in pdf_documents:
+    if session_id not in pdf_data:
         return jsonify({'error': 'PDF not loaded'}), 400
     
+    # Только профили по имени: разрешение растеризации не задается клиентом
+    profile = data.get('profile') or DEFAULT_EXPORT_PROFILE
+    if not isinstance(profile, str) or profile not in EXPORT_PROFILES:
+        return jsonify({'error': f'Unknown export profile, expected one of: {", ".join(EXPORT_PROFILES)}'}), 400
+    
     try:
-        pdf_doc = pdf_documents[session_id]
+        pdf_doc = sessions.document(session_id)
         pdf_info = pdf_data[session_id]
         
-        # Создаем новый документ
-        new_doc = fitz.open()
-        
-        for page_num in range(len(pdf_doc)):
-            page = pdf_doc[page_num]
-            page_rect = page.rect
-            
-            # Проверяем, нужны ли изменения через изображение
-            has_full_page_color_replacements = (
-                page_num < len(pdf_info['color_replacements']) and 
-                pdf_info['color_replacements'][page_num]
-            )
-            has_inserted_content = any(
-                c['page'] == page_num for c in pdf_info['inserted_content']
-            )
-            
-            new_page = new_doc.new_page(width=page_rect.width, height=page_rect.height)
-            
-            if has_full_page_color_replacements or has_inserted_content:
-                # Используем изображение
-                pix = page.get_pixmap()
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                img = apply_changes_to_image(img, page_num, session_id, 1.0)
-                
-                img_bytes = io.BytesIO()
-                img.save(img_bytes, format='PNG')
-                img_bytes.seek(0)
-                
-                img_rect = fitz.Rect(0, 0, page_rect.width, page_rect.height)
-                new_page.insert_image(img_rect, stream=img_bytes.getvalue())
-            else:
-                # Используем векторную графику
-                new_page.show_pdf_page(new_page.rect, pdf_doc, page_num)
-                
-                # Применяем удаления
-                if page_num < len(pdf_info['deletion_areas']):
-                    for area in pdf_info['deletion_areas'][page_num]:
-                        x1, y1, x2, y2 = area
-                        x1 = max(0, min(x1, page_rect.width))
-                        y1 = max(0, min(y1, page_rect.height))
-                        x2 = max(0, min(x2, page_rect.width))
-                        y2 = max(0, min(y2, page_rect.height))
-                        
-                        if x1 < x2 and y1 < y2:
-                            rect = fitz.Rect(x1, y1, x2, y2)
-                            new_page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
-                
-                # Применяем замены цвета
-                if page_num < len(pdf_info['color_changes']):
-                    for change in pdf_info['color_changes'][page_num]:
-                        area, orig_color, new_color = change
-                        x1, y1, x2, y2 = area
-                        x1 = max(0, min(x1, page_rect.width))
-                        y1 = max(0, min(y1, page_rect.height))
-                        x2 = max(0, min(x2, page_rect.width))
-                        y2 = max(0, min(y2, page_rect.height))
-                        
-                        if x1 < x2 and y1 < y2:
-                            rect = fitz.Rect(x1, y1, x2, y2)
-                            if new_color and new_color.startswith('#'):
-                                try:
-                                    r = int(new_color[1:3], 16) / 255.0
-                                    g = int(new_color[3:5], 16) / 255.0
-                                    b = int(new_color[5:7], 16) / 255.0
-                                    new_page.draw_rect(rect, color=(r, g, b), fill=(r, g, b))
-                                except (ValueError, IndexError):
-                                    pass
-                
-                # Применяем вставленный контент
-                for content in pdf_info['inserted_content']:
-                    if content['page'] == page_num:
-                        try:
-                            if content['type'] == 'text':
-                                text = content['data']['text']
-                                font_size = content['data']['font_size']
-                                color_hex = content['data']['color']
-                                
-                                r = int(color_hex[1:3], 16) / 255.0
-                                g = int(color_hex[3:5], 16) / 255.0
-                                b = int(color_hex[5:7], 16) / 255.0
-                                
-                                point = fitz.Point(content['x'], content['y'])
-                                new_page.insert_text(point, text, fontsize=font_size, color=(r, g, b))
-                            
-                            elif content['type'] == 'image':
-                                img_path = content['data']['path']
-                                if Path(img_path).exists():
-                                    img = Image.open(img_path)
-                                    width = content['data']['width']
-                                    height = content['data']['height']
-                                    
-                                    if width > 0 or height > 0:
-                                        if width > 0 and height > 0:
-                                            img = img.resize((width, height), Image.Resampling.LANCZOS)
-                                        elif width > 0:
-                                            ratio = width / img.width
-                                            img = img.resize((width, int(img.height * ratio)), Image.Resampling.LANCZOS)
-                                        elif height > 0:
-                                            ratio = height / img.height
-                                            img = img.resize((int(img.width * ratio), height), Image.Resampling.LANCZOS)
-                                    
-                                    img_bytes = io.BytesIO()
-                                    img.save(img_bytes, format='PNG')
-                                    img_bytes.seek(0)
-                                    
-                                    rect = fitz.Rect(
-                                        content['x'],
-                                        content['y'],
-                                        content['x'] + img.width,
-                                        content['y'] + img.height
-                                    )
-                                    new_page.insert_image(rect, stream=img_bytes.getvalue())
-                        except Exception:
-                            pass
+        # Изменения страниц; страницы без изменений копируются как есть
+        page_edits = [None] * len(pdf_doc)
+        for page_num in pdf_info['edits'].edited_pages():
+            page_edits[page_num] = get_page_edits(session_id, page_num, bool(data.get('redact', False)))
         
-        # Сохраняем во временный файл
-        output_path = upload_dir / f"{session_id}_output.pdf"
-        new_doc.save(str(output_path))
-        new_doc.close()
+        # Сериализуем в память: пересборкой (страницы с изменениями
+        # обрабатываются параллельно) или дописыванием изменений в копию файла
+        pdf_bytes, report = export_bytes(pdf_doc, pdf_info['file_path'], page_edits,
+                                         mode=data.get('mode', EXPORT_MODE_FULL),
+                                         profile=profile)
         
-        return send_file(str(output_path), as_attachment=True, download_name='edited.pdf')
+        # Ответ отдается из памяти; файл для повторной и докачки (/api/download)
+        # записывается в отдельном потоке, не задерживая ответ
+        output = store_output(session_id, pdf_bytes, report)
+        threading.Thread(target=persist_output, args=(session_id, output),
+                         name="save-output", daemon=True).start()
+        return send_output(output)
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/download', methods=['GET'])
+@session_locked
+def download_pdf():
+    """Скачивание последнего сохраненного PDF (с поддержкой Range для докачки)"""
+    session_id = request.args.get('session_id', 'default')
+    
+    if session_id not in pdf_data:
+        return jsonify({'error': 'PDF not loaded'}), 400
+    
+    output = pdf_data[session_id].get('output')
+    if output is None:
+        return jsonify({'error': 'PDF not saved'}), 404
+    
+    return send_output(output)
+
+
+@app.route('/api/export_report', methods=['GET'])
+@session_locked
+def export_report():
+    """Отчет о последнем сохранении: режим, время и размер обработанных страниц"""
+    session_id = request.args.get('session_id', 'default')
+    
+    if session_id not in pdf_data:
+        return jsonify({'error': 'PDF not loaded'}), 400
+    
+    output = pdf_data[session_id].get('output')
+    if output is None:
+        return jsonify({'error': 'PDF not saved'}), 404
+    
+    return jsonify({'success': True, 'report': output['report']})
+
+
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    """Статистика кэшей изображений (число записей, объем, доля попаданий) и пула рендеринга"""
+    return jsonify({
+        'success': True,
+        'page_images': page_images.stats(),
+        'inserted_images': inserted_images.stats(),
+        'render_pool': render_pool.stats()
+    })
+
+
+@app.route('/api/sessions', methods=['GET'])
+def sessions_report():
+    """Активные сессии, открытые документы, память и место на диске"""
+    report = sessions.report()
+    report['memory']['page_images_bytes'] = page_images.stats()['bytes']
+    report['success'] = True
+    return jsonify(report)
+
+
+@app.route('/api/close_session', methods=['POST'])
+def close_session():
+    """Закрытие сессии: документ закрывается, временные файлы удаляются"""
+    data = request.json
+    session_id = data.get('session_id', 'default')
+    
+    if not sessions.close_session(session_id):
+        return jsonify({'error': 'PDF not loaded'}), 400
+    
+    return jsonify({'success': True})
+
+
 @app.route('/api/clear', methods=['POST'])
+@session_locked
 def clear_page():
     """Очистка всех изменений на странице"""
     data = request.json
@@ -577,14 +726,17 @@ def clear_page():
         pdf_data[session_id]['color_replacements'][page_num] = []
     
     # Удаляем вставленный контент на этой странице
-    pdf_data[session_id]['inserted_content'] = [
-        c for c in pdf_data[session_id]['inserted_content'] if c['page'] != page_num
-    ]
+    if pdf_data[session_id]['edits'].count(page_num, 'inserted_content'):
+        pdf_data[session_id]['inserted_content'] = [
+            c for c in pdf_data[session_id]['inserted_content'] if c['page'] != page_num
+        ]
+    page_changed(session_id, page_num, reset=True)
     
     return jsonify({'success': True})
 
 
 @app.route('/api/get_page_data')
+@session_locked
 def get_page_data():
     """Получение данных изменений для страницы"""
     session_id = request.args.get('session_id', 'default')
@@ -594,17 +746,19 @@ def get_page_data():
         return jsonify({'error': 'PDF not loaded'}), 400
     
     data = pdf_data[session_id]
+    has_content = data['edits'].count(page_num, 'inserted_content') > 0
     
     return jsonify({
         'success': True,
         'deletion_areas': data['deletion_areas'][page_num] if page_num < len(data['deletion_areas']) else [],
         'color_changes': data['color_changes'][page_num] if page_num < len(data['color_changes']) else [],
         'color_replacements': data['color_replacements'][page_num] if page_num < len(data['color_replacements']) else [],
-        'inserted_content': [c for c in data['inserted_content'] if c['page'] == page_num]
+        'inserted_content': [c for c in data['inserted_content'] if c['page'] == page_num] if has_content else []
     })
 
 
 @app.route('/api/apply_to_page', methods=['POST'])
+@session_locked
 def apply_to_page():
     """Применение изменений с одной страницы на другую"""
     data = request.json
@@ -617,8 +771,12 @@ def apply_to_page():
         return jsonify({'error': 'PDF not loaded'}), 400
     
     pdf_info = pdf_data[session_id]
+    if not 0 <= target_page < len(pdf_info['edits'].versions):
+        return jsonify({'error': 'Invalid page number'}), 400
     
     try:
+        deletion_areas, color_changes, color_replacements = [], [], []
+        
         # Копируем области удаления
         if source_page < len(pdf_info['deletion_areas']):
             deletion_areas = pdf_info['deletion_areas'][source_page].copy()
@@ -650,17 +808,37 @@ def apply_to_page():
                 pdf_info['color_replacements'][target_page] = color_replacements
         
         # Копируем вставленный контент
-        source_content = [c.copy() for c in pdf_info['inserted_content'] if c['page'] == source_page]
+        source_content = []
+        if pdf_info['edits'].count(source_page, 'inserted_content'):
+            source_content = [c.copy() for c in pdf_info['inserted_content'] if c['page'] == source_page]
         for content in source_content:
             content['page'] = target_page
             pdf_info['inserted_content'].append(content)
         
+        # Сводка изменений целевой страницы пополняется скопированными изменениями
+        page_changed(session_id, target_page,
+                     deletion_areas=len(deletion_areas),
+                     color_changes=len(color_changes),
+                     color_replacements=len(color_replacements),
+                     inserted_content=len(source_content))
+        
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 if __name__ == '__main__':
+    # Нужно для процессов рендеринга и сохранения в собранном приложении (PyInstaller --onefile)
+    multiprocessing.freeze_support()
+    # Сообщения модулей (шрифты, очистка сессий) в консоль в прежнем виде
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+    # Поиск файлов шрифтов для вставленного текста (один раз при запуске)
+    font_registry.resolve()
+    
+    # Фоновое закрытие простаивающих сессий и удаление оставшихся временных файлов
+    sessions.start_cleanup()
+    
     # Запуск на всех интерфейсах для доступа с iPad
     # Используем порт 5001, так как 5000 часто занят AirPlay на macOS
     app.run(host='0.0.0.0', port=5001, debug=True)
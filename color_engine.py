@@ -0,0 +1,191 @@
+"""
+Векторизованная замена цвета (пипетка) для предпросмотра и сохранения
+"""
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+# Максимально возможный квадрат расстояния между двумя RGB цветами
+MAX_DISTANCE_SQ = 3 * 255 ** 2
+
+# Параметры таблицы поиска: 32 уровня на канал, ячейка 8x8x8 цветов
+CUBE_SHIFT = 3
+CUBE_LEVELS = 256 >> CUBE_SHIFT
+CUBE_CELL = 1 << CUBE_SHIFT
+
+# Типы ячеек таблицы поиска
+CELL_IDENTITY = 0  # ни одна замена не затрагивает ячейку
+CELL_CONSTANT = 1  # все цвета ячейки переходят в один цвет
+CELL_MIXED = 2     # граница допуска проходит через ячейку
+
+
+def parse_hex_color(color_hex):
+    """Конвертация hex цвета (#rrggbb) в кортеж RGB"""
+    return (
+        int(color_hex[1:3], 16),
+        int(color_hex[3:5], 16),
+        int(color_hex[5:7], 16),
+    )
+
+
+def tolerance_to_distance_sq(tolerance):
+    """Наибольший квадрат расстояния, который еще попадает в допуск.
+
+    Исходная проверка `((dr**2 + dg**2 + db**2) ** 0.5) <= tolerance`
+    сводится к сравнению целого квадрата расстояния с порогом, поэтому
+    порог подбирается той же самой операцией `** 0.5`, что и раньше.
+    """
+    tolerance = float(tolerance)
+    if tolerance < 0:
+        return -1
+    if tolerance ** 2 >= MAX_DISTANCE_SQ:
+        return MAX_DISTANCE_SQ
+
+    distance_sq = int(tolerance * tolerance)
+    while distance_sq + 1 <= MAX_DISTANCE_SQ and (distance_sq + 1) ** 0.5 <= tolerance:
+        distance_sq += 1
+    while distance_sq >= 0 and distance_sq ** 0.5 > tolerance:
+        distance_sq -= 1
+    return distance_sq
+
+
+def compile_replacements(replacements, default_tolerance=30):
+    """Подготовка списка замен: ((old_rgb, new_rgb, max_distance_sq), ...)
+
+    Замены с некорректными цветами пропускаются, как и раньше.
+    Результат хешируемый и служит ключом кэша таблиц поиска.
+    """
+    rules = []
+    for replacement in replacements:
+        try:
+            old_rgb = parse_hex_color(replacement['old_color'])
+            new_rgb = parse_hex_color(replacement['new_color'])
+            tolerance = replacement.get('tolerance', default_tolerance)
+            max_distance_sq = tolerance_to_distance_sq(tolerance)
+        except (ValueError, IndexError, TypeError):
+            continue
+        rules.append((old_rgb, new_rgb, max_distance_sq))
+    return tuple(rules)
+
+
+def apply_rules_to_array(pixels, rules):
+    """Применение подготовленных замен к массиву (N, 3) или (H, W, 3) uint8 на месте.
+
+    Замены применяются по порядку: каждая следующая видит результат
+    предыдущих.
+    """
+    if not rules:
+        return pixels
+
+    channels = pixels.reshape(-1, 3)
+    distance_sq = np.empty(channels.shape[0], dtype=np.int32)
+    diff = np.empty(channels.shape[0], dtype=np.int32)
+
+    for old_rgb, new_rgb, max_distance_sq in rules:
+        if max_distance_sq < 0:
+            continue
+        distance_sq.fill(0)
+        for channel in range(3):
+            np.subtract(channels[:, channel], old_rgb[channel], out=diff, dtype=np.int32)
+            np.multiply(diff, diff, out=diff)
+            distance_sq += diff
+        mask = distance_sq <= max_distance_sq
+        channels[mask] = new_rgb
+    return pixels
+
+
+def map_color(rgb, rules):
+    """Цвет (r, g, b) после применения цепочки замен"""
+    pixels = np.array([rgb], dtype=np.uint8)
+    return tuple(int(v) for v in apply_rules_to_array(pixels, rules)[0])
+
+
+@lru_cache(maxsize=64)
+def compile_lookup_cube(rules):
+    """Компиляция цепочки замен в квантованную таблицу поиска RGB -> RGB
+
+    Цепочка прогоняется сразу по всем ячейкам куба 32x32x32. Ячейка, целиком
+    лежащая вне допуска, остается без изменений; ячейка, целиком попавшая в
+    допуск, получает итоговый цвет цепочки. Только ячейки, через которые
+    проходит граница допуска, помечаются как смешанные и затем
+    обрабатываются точно, попиксельно. Таблицы кэшируются по списку замен,
+    поэтому страницы с одинаковыми заменами используют одну таблицу.
+
+    Возвращает (kinds, colors) либо None, если замены ничего не меняют.
+    """
+    levels = np.arange(CUBE_LEVELS, dtype=np.int32) * CUBE_CELL
+    grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+    low = grid
+    high = grid + (CUBE_CELL - 1)
+
+    kinds = np.full(grid.shape[0], CELL_IDENTITY, dtype=np.uint8)
+    colors = np.zeros((grid.shape[0], 3), dtype=np.int32)
+
+    for old_rgb, new_rgb, max_distance_sq in rules:
+        if max_distance_sq < 0:
+            continue
+        old = np.array(old_rgb, dtype=np.int32)
+
+        # Ячейки, уже получившие один цвет: проверяем сам цвет
+        constant = kinds == CELL_CONSTANT
+        if constant.any():
+            diff = colors[constant] - old
+            hit = (diff * diff).sum(axis=1) <= max_distance_sq
+            rows = np.flatnonzero(constant)[hit]
+            colors[rows] = new_rgb
+
+        # Нетронутые ячейки: ближайшая и дальняя точки куба до old_rgb
+        identity = kinds == CELL_IDENTITY
+        nearest = np.maximum(np.maximum(low[identity] - old, old - high[identity]), 0)
+        farthest = np.maximum(np.abs(low[identity] - old), np.abs(high[identity] - old))
+        min_sq = (nearest * nearest).sum(axis=1)
+        max_sq = (farthest * farthest).sum(axis=1)
+
+        rows = np.flatnonzero(identity)
+        covered = rows[max_sq <= max_distance_sq]
+        kinds[covered] = CELL_CONSTANT
+        colors[covered] = new_rgb
+        kinds[rows[(min_sq <= max_distance_sq) & (max_sq > max_distance_sq)]] = CELL_MIXED
+
+    if not kinds.any():
+        return None
+    return kinds, colors.astype(np.uint8)
+
+
+def apply_rules_with_cube(pixels, rules):
+    """Применение замен к массиву (H, W, 3) uint8 через таблицу поиска на месте"""
+    cube = compile_lookup_cube(rules)
+    if cube is None:
+        return pixels
+    kinds, colors = cube
+
+    flat = pixels.reshape(-1, 3)
+    index = (flat[:, 0] >> CUBE_SHIFT).astype(np.int32) << (2 * (8 - CUBE_SHIFT))
+    index |= (flat[:, 1] >> CUBE_SHIFT).astype(np.int32) << (8 - CUBE_SHIFT)
+    index |= flat[:, 2] >> CUBE_SHIFT
+    pixel_kinds = kinds[index]
+
+    constant = np.flatnonzero(pixel_kinds == CELL_CONSTANT)
+    mixed = np.flatnonzero(pixel_kinds == CELL_MIXED)
+    if mixed.size:
+        flat[mixed] = apply_rules_to_array(flat[mixed], rules)
+    if constant.size:
+        flat[constant] = colors[index[constant]]
+    return pixels
+
+
+def apply_color_replacements(img, replacements, default_tolerance=30):
+    """Применение всех замен цвета страницы к изображению за один проход
+
+    Возвращает новое RGB изображение; исходное не изменяется.
+    """
+    rules = compile_replacements(replacements, default_tolerance)
+    if not rules:
+        return img
+
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    pixels = np.array(img, dtype=np.uint8)
+    apply_rules_with_cube(pixels, rules)
+    return Image.fromarray(pixels, 'RGB')
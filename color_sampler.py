@@ -0,0 +1,67 @@
+"""
+Выборка цвета в точке страницы (пипетка) без рендеринга всей страницы
+"""
+import fitz  # PyMuPDF
+
+from pixmap_utils import pixmap_to_image
+from tile_renderer import page_pixel_size
+
+# Наибольший радиус усреднения пипетки в пикселях экрана
+MAX_SAMPLE_RADIUS = 10
+
+
+def color_to_hex(rgb):
+    """Конвертация кортежа RGB в hex цвет (#rrggbb)"""
+    return '#%02x%02x%02x' % tuple(rgb[:3])
+
+
+def sample_box(pixel_x, pixel_y, radius, width, height):
+    """Квадрат (x1, y1, x2, y2) вокруг пикселя, ограниченный размерами изображения"""
+    pixel_x = max(0, min(int(pixel_x), width - 1))
+    pixel_y = max(0, min(int(pixel_y), height - 1))
+    radius = max(0, min(int(radius), MAX_SAMPLE_RADIUS))
+    return (max(0, pixel_x - radius), max(0, pixel_y - radius),
+            min(width, pixel_x + radius + 1), min(height, pixel_y + radius + 1))
+
+
+def average_color(img):
+    """Средний цвет RGB изображения (округление до целого)"""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    count = img.width * img.height
+    if count == 1:
+        return img.getpixel((0, 0))
+    totals = [0, 0, 0]
+    for number, color in img.getcolors(maxcolors=count):
+        for channel in range(3):
+            totals[channel] += number * color[channel]
+    return tuple((total + count // 2) // count for total in totals)
+
+
+def sample_image_color(img, pixel_x, pixel_y, radius=0):
+    """Цвет уже отрендеренного изображения в пикселе (pixel_x, pixel_y)
+
+    При radius > 0 возвращается средний цвет квадрата (2 * radius + 1) пикселей.
+    """
+    box = sample_box(pixel_x, pixel_y, radius, img.width, img.height)
+    return average_color(img.crop(box))
+
+
+def sample_page_color(page, x, y, zoom=1.0, radius=0):
+    """Цвет страницы в точке (x, y) (координаты PDF) при масштабе отображения zoom
+
+    Рендерится только небольшой фрагмент вокруг точки, поэтому результат
+    совпадает с пикселем полного рендеринга страницы при том же масштабе.
+    radius задается в пикселях экрана.
+    """
+    width, height = page_pixel_size(page, zoom)
+    box = sample_box(x * zoom, y * zoom, radius, width, height)
+    clip = fitz.Rect(box[0] / zoom, box[1] / zoom, box[2] / zoom, box[3] / zoom) & page.rect
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+    img = pixmap_to_image(pix)
+    # Пиксмап может оказаться чуть больше квадрата - вырезаем по его положению
+    crop = (max(0, box[0] - pix.x), max(0, box[1] - pix.y),
+            min(img.width, box[2] - pix.x), min(img.height, box[3] - pix.y))
+    if crop[0] < crop[2] and crop[1] < crop[3]:
+        img = img.crop(crop)
+    return average_color(img)
@@ -0,0 +1,85 @@
+"""
+Учет изменений страниц: версия страницы и число изменений каждого типа
+"""
+
+# Типы изменений (ключи словаря изменений страницы, см. page_edits.collect_page_edits)
+EDIT_TYPES = ('deletion_areas', 'color_changes', 'color_replacements', 'inserted_content')
+
+
+class EditTracker:
+    """Версии и сводки изменений страниц документа
+
+    Каждое изменение страницы увеличивает ее версию (ключи кэшей, ETag) и
+    счетчик изменений своего типа, поэтому проверка "есть ли изменения на
+    странице" и пропуск неизмененных страниц не требуют просмотра списков изменений.
+    """
+
+    def __init__(self, total_pages):
+        self.versions = [0] * total_pages
+        self.counts = [dict.fromkeys(EDIT_TYPES, 0) for _ in range(total_pages)]
+        self.edited = set()  # Страницы, на которых есть изменения
+
+    def changed(self, page_num, **deltas):
+        """Изменение страницы: deltas - на сколько изменилось число изменений каждого типа
+
+        Например, changed(0, deletion_areas=1). Возвращает False для несуществующей страницы.
+        """
+        if not 0 <= page_num < len(self.versions):
+            return False
+        counts = self.counts[page_num]
+        for edit_type, delta in deltas.items():
+            counts[edit_type] = max(0, counts[edit_type] + delta)
+        self._touch(page_num)
+        return True
+
+    def set_counts(self, page_num, **counts):
+        """Изменение страницы с известным итоговым числом изменений (массовая загрузка, шаблоны)"""
+        if not 0 <= page_num < len(self.versions):
+            return False
+        self.counts[page_num].update(counts)
+        self._touch(page_num)
+        return True
+
+    def reset_page(self, page_num):
+        """Все изменения страницы удалены"""
+        return self.set_counts(page_num, **dict.fromkeys(EDIT_TYPES, 0))
+
+    def _touch(self, page_num):
+        """Новая версия страницы и обновление множества страниц с изменениями"""
+        self.versions[page_num] += 1
+        if any(self.counts[page_num].values()):
+            self.edited.add(page_num)
+        else:
+            self.edited.discard(page_num)
+
+    def __len__(self):
+        """Число страниц документа"""
+        return len(self.versions)
+
+    def version(self, page_num):
+        """Версия изменений страницы"""
+        return self.versions[page_num]
+
+    def count(self, page_num, edit_type):
+        """Число изменений типа edit_type на странице"""
+        return self.counts[page_num][edit_type] if 0 <= page_num < len(self.counts) else 0
+
+    def has_edits(self, page_num):
+        """Есть ли на странице изменения"""
+        return page_num in self.edited
+
+    def summary(self, page_num):
+        """Число изменений каждого типа на странице"""
+        return dict(self.counts[page_num])
+
+    def edited_pages(self):
+        """Номера страниц с изменениями по возрастанию"""
+        return sorted(self.edited)
+
+    def totals(self):
+        """Число изменений каждого типа во всем документе"""
+        totals = dict.fromkeys(EDIT_TYPES, 0)
+        for page_num in self.edited:
+            for edit_type, count in self.counts[page_num].items():
+                totals[edit_type] += count
+        return totals
@@ -0,0 +1,408 @@
+"""
+Сохранение PDF за один проход: страницы без изменений копируются сериями,
+страницы с изменениями строятся в итоговом документе или в пуле процессов
+"""
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz  # PyMuPDF
+
+from inserted_images import EmbeddedImages
+from page_edits import (RecoloredPages, add_edited_page, apply_overlays, build_edited_page,
+                        insert_content_overlays, is_overlay_only, is_recolor_candidate)
+from process_pool import SpawnPool, WorkerDocuments
+
+# Режимы сохранения: пересборка документа или дописывание изменений в конец файла
+EXPORT_MODE_FULL = 'full'
+EXPORT_MODE_INCREMENTAL = 'incremental'
+# Сборка мусора при сохранении документа с удаленным содержимым: прежние потоки
+# содержимого и изображения страниц остались бы в файле недостижимыми объектами
+REDACTED_SAVE_GARBAGE = 3
+
+
+def default_export_workers():
+    """Число процессов сохранения: PDF_EDITOR_EXPORT_WORKERS или число ядер (не больше 4)"""
+    try:
+        return max(1, int(os.environ['PDF_EDITOR_EXPORT_WORKERS']))
+    except (KeyError, ValueError):
+        return max(1, min(4, os.cpu_count() or 1))
+
+
+DEFAULT_EXPORT_WORKERS = default_export_workers()
+
+# Сколько исходных документов держит открытыми процесс пула
+WORKER_OPEN_DOCUMENTS = 2
+
+# Исходные документы, открытые процессом пула, по source_key
+_worker_documents = WorkerDocuments(WORKER_OPEN_DOCUMENTS)
+
+
+def source_key(file_path):
+    """Ключ исходного файла для процессов пула: путь, размер и время изменения
+
+    Процесс пула переоткрывает файл, если его перезаписали между сохранениями.
+    """
+    stat = os.stat(file_path)
+    return str(file_path), stat.st_size, stat.st_mtime_ns
+
+
+def build_page_bytes(source_doc, page_num, edits, profile=None):
+    """Растеризация страницы в процессе пула: одностраничный PDF в байтах и статистика страницы
+
+    Перекрасить страницу без растеризации уже не удалось (raster_pages), поэтому
+    процесс пула не повторяет эту попытку.
+    """
+    start = time.perf_counter()
+    doc, stats = build_edited_page(source_doc, page_num, edits, profile, recolor=False)
+    try:
+        # Несжатые потоки сжимаются без потерь
+        page_bytes = doc.tobytes(deflate=True)
+    finally:
+        doc.close()
+    return page_bytes, dict(stats, page=page_num, seconds=time.perf_counter() - start)
+
+
+def _build_page_in_worker(key, page_num, edits, profile):
+    """Обработка страницы в процессе пула"""
+    return build_page_bytes(_worker_documents.get(key), page_num, edits, profile)
+
+
+class ExportPool(SpawnPool):
+    """Пул процессов сохранения, общий для всех сохранений
+
+    Создается при первом сохранении с растеризацией нескольких страниц
+    и пересоздается только при смене числа процессов, после сбоя или
+    после удаления файла, который открывали его процессы (release).
+    """
+
+
+export_pool = ExportPool()
+
+
+def plan_export(page_edits):
+    """План сохранения: шаги ('copy', первая, последняя) и ('edit', страница, страница)
+
+    Подряд идущие страницы без изменений объединяются в один шаг,
+    который копируется одним вызовом insert_pdf.
+    """
+    steps = []
+    for page_num, edits in enumerate(page_edits):
+        if edits is not None:
+            steps.append(('edit', page_num, page_num))
+        elif steps and steps[-1][0] == 'copy':
+            steps[-1] = ('copy', steps[-1][1], page_num)
+        else:
+            steps.append(('copy', page_num, page_num))
+    return steps
+
+
+def raster_pages(page_edits, edited, recolored):
+    """Страницы из edited, которые придется растеризовать (их можно строить в пуле процессов)
+
+    Замена цвета без растеризации выполняется здесь же для всех страниц
+    заранее (recolored - RecoloredPages): так общие изображения и формы
+    перекрашиваются один раз. Остальные нерастеризуемые страницы строятся
+    сразу в итоговом документе, и их общие ресурсы тоже остаются общими.
+    """
+    pages = []
+    for page_num in edited:
+        edits = page_edits[page_num]
+        if is_overlay_only(edits):
+            continue
+        if is_recolor_candidate(edits) and recolored.prepare(page_num, edits):
+            continue
+        # Растеризуется; отказ или ошибка перекрашивания запомнены в recolored,
+        # и ни add_edited_page, ни процесс пула не повторяют эту попытку
+        pages.append(page_num)
+    return pages
+
+
+def added_bytes(doc, first_xref):
+    """Размер объектов doc, созданных начиная с first_xref (без учета сжатия при сохранении)"""
+    total = 0
+    for xref in range(first_xref, doc.xref_length()):
+        total += len(doc.xref_object(xref, compressed=True))
+        if doc.xref_is_stream(xref):
+            total += len(doc.xref_stream_raw(xref))
+    return total
+
+
+def export_document(source_doc, file_path, page_edits, workers=None, on_error=None, profile=None):
+    """Сборка нового документа из source_doc с изменениями страниц за один проход
+
+    page_edits - список по страницам: словарь изменений (см. collect_page_edits)
+    либо None, если страница копируется без изменений. Серии страниц без
+    изменений копируются одним insert_pdf (plan_export). Страницы с
+    изменениями строятся сразу в итоговом документе; при workers > 1
+    растеризуемые страницы (raster_pages) обрабатываются в общем пуле из
+    workers процессов (export_pool), каждый из которых сам открывает
+    file_path; результат собирается в
+    исходном порядке страниц. Перекрашенные без растеризации страницы с
+    одинаковыми заменами используют общие копии ресурсов. profile -
+    профиль растеризации (export_profiles). Вставленные изображения
+    встраиваются в итоговый документ по одному разу на уникальное содержимое.
+
+    on_error(page_num, exc) вызывается для страницы, которую не удалось
+    обработать, и страница пропускается; без on_error ошибка пробрасывается.
+
+    Возвращает (документ, отчет): отчет содержит способ обработки, время
+    и размер добавленных объектов каждой страницы, итоги и страницы, где
+    содержимое под областями удаления удалить не удалось (unredacted_pages).
+    """
+    if workers is None:
+        workers = DEFAULT_EXPORT_WORKERS
+    steps = plan_export(page_edits)
+    edited = [first for kind, first, last in steps if kind == 'edit']
+    start = time.perf_counter()
+
+    new_doc = fitz.open()
+    embedded = EmbeddedImages(new_doc)
+    recolored = RecoloredPages(source_doc)
+    has_text = False
+    try:
+        pooled = raster_pages(page_edits, edited, recolored)
+        if workers <= 1 or len(pooled) <= 1:
+            # Растеризуемых страниц не больше одной или один процесс: пул не нужен
+            executor = None
+            results = {}
+        else:
+            key = source_key(file_path)
+            executor, futures = export_pool.submit(
+                workers, file_path,
+                [(_build_page_in_worker, (key, page_num, page_edits[page_num], profile))
+                 for page_num in pooled])
+            results = dict(zip(pooled, futures))
+        report = {'pages': [], 'copied_pages': 0, 'copy_steps': 0,
+                  'workers': min(workers, len(pooled)) if executor is not None else 1}
+        try:
+            for kind, first, last in steps:
+                if kind == 'copy':
+                    # final=0: шрифты и другие общие ресурсы переносятся один раз на весь документ
+                    new_doc.insert_pdf(source_doc, from_page=first, to_page=last, final=0)
+                    report['copied_pages'] += last - first + 1
+                    report['copy_steps'] += 1
+                    continue
+
+                page_num, edits = first, page_edits[first]
+                page_count = new_doc.page_count
+                first_xref = new_doc.xref_length()
+                try:
+                    if page_num not in results:
+                        page_start = time.perf_counter()
+                        stats = add_edited_page(new_doc, source_doc, page_num, edits, profile, recolored)
+                        page_stats = dict(stats, page=page_num, seconds=time.perf_counter() - page_start)
+                    else:
+                        page_bytes, page_stats = results[page_num].result()
+                        temp_doc = fitz.open("pdf", page_bytes)
+                        try:
+                            new_doc.insert_pdf(temp_doc)
+                        finally:
+                            temp_doc.close()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        # Процесс пула аварийно завершился (например, сбой MuPDF)
+                        export_pool.reset(executor)
+                    # Недостроенная страница не должна попасть в документ
+                    while new_doc.page_count > page_count:
+                        new_doc.delete_page(-1)
+                    if on_error is None:
+                        raise
+                    on_error(page_num, e)
+                    continue
+                if insert_content_overlays(new_doc[-1], edits, embedded):
+                    has_text = True
+                page_stats['bytes'] = added_bytes(new_doc, first_xref)
+                report['pages'].append(page_stats)
+        finally:
+            # Пул общий: отменяются только еще не начатые страницы этого сохранения
+            for future in results.values():
+                future.cancel()
+        if has_text:
+            # Шрифт вставленного текста встраивается только с использованными символами
+            new_doc.subset_fonts()
+    except Exception:
+        new_doc.close()
+        raise
+    finally:
+        recolored.close()
+
+    report['seconds'] = time.perf_counter() - start
+    report['page_seconds'] = sum(page['seconds'] for page in report['pages'])
+    report['page_bytes'] = sum(page['bytes'] for page in report['pages'])
+    # Страницы, где под областями удаления остался текст или изображения (см. redact_areas)
+    report['unredacted_pages'] = [page['page'] for page in report['pages'] if page.get('unredacted')]
+    return new_doc, report
+
+
+def same_file(path, other):
+    """Указывают ли пути на один файл (other может еще не существовать)"""
+    try:
+        return os.path.samefile(path, other)
+    except OSError:
+        return os.path.abspath(path) == os.path.abspath(other)
+
+
+def redacts_content(edits):
+    """Удаляется ли из файла содержимое страницы под областями удаления"""
+    return edits is not None and bool(edits.get('redact')) and bool(edits['deletion_areas'])
+
+
+def save_garbage(page_edits):
+    """Уровень сборки мусора при сохранении пересобранного документа"""
+    return REDACTED_SAVE_GARBAGE if any(redacts_content(edits) for edits in page_edits) else 0
+
+
+def incremental_blocker(source_doc, page_edits):
+    """Причина, по которой изменения нельзя дописать в файл, или None"""
+    if not source_doc.can_save_incrementally():
+        return "файл нельзя дописать (поврежден или зашифрован)"
+    for page_num, edits in enumerate(page_edits):
+        if edits is None:
+            continue
+        if not is_overlay_only(edits):
+            return f"страница {page_num + 1} пересобирается (замена цвета или растеризация)"
+        if redacts_content(edits):
+            # Старая версия страницы с удаленным содержимым осталась бы в файле
+            return f"на странице {page_num + 1} содержимое удаляется из файла"
+        if source_doc[page_num].rotation:
+            return f"страница {page_num + 1} повернута"
+    return None
+
+
+def export_incremental(file_path, output_path, page_edits):
+    """Сохранение дописыванием: наложения добавляются к копии исходного файла
+
+    Исходные объекты не переписываются - в конец файла попадают только
+    новые и измененные. Все изменения должны быть наложениями
+    (см. incremental_blocker). Возвращает отчет, как export_document.
+    output_path не может совпадать с file_path (см. save_document).
+    """
+    start = time.perf_counter()
+    shutil.copyfile(file_path, output_path)
+    report = {'pages': [], 'copied_pages': 0, 'copy_steps': 0, 'workers': 1}
+
+    doc = fitz.open(output_path)
+    try:
+        embedded = EmbeddedImages(doc)
+        for page_num, edits in enumerate(page_edits):
+            if edits is None:
+                report['copied_pages'] += 1
+                continue
+            page_start = time.perf_counter()
+            first_xref = doc.xref_length()
+            apply_overlays(doc[page_num], edits, embedded)
+            report['pages'].append({'page': page_num, 'mode': 'overlay',
+                                    'seconds': time.perf_counter() - page_start,
+                                    'bytes': added_bytes(doc, first_xref)})
+        doc.saveIncr()
+    finally:
+        doc.close()
+
+    report['seconds'] = time.perf_counter() - start
+    report['page_seconds'] = sum(page['seconds'] for page in report['pages'])
+    report['page_bytes'] = sum(page['bytes'] for page in report['pages'])
+    return report
+
+
+def choose_export_mode(source_doc, page_edits, mode):
+    """Режим, которым будет сохранен документ, и причина отказа от инкрементального или None"""
+    if mode == EXPORT_MODE_INCREMENTAL:
+        fallback = incremental_blocker(source_doc, page_edits)
+        if fallback is None:
+            return EXPORT_MODE_INCREMENTAL, None
+        return EXPORT_MODE_FULL, fallback
+    return EXPORT_MODE_FULL, None
+
+
+def save_document(source_doc, file_path, output_path, page_edits, mode=EXPORT_MODE_FULL,
+                  workers=None, on_error=None, profile=None):
+    """Сохранение source_doc с изменениями страниц в output_path
+
+    В режиме EXPORT_MODE_INCREMENTAL изменения дописываются к копии файла
+    (export_incremental); если это невозможно, документ пересобирается
+    (export_document), а причина записывается в отчет ('fallback').
+    Возвращает отчет о сохранении с режимом, которым сохранен файл ('mode').
+    Документ с удаленным содержимым сохраняется со сборкой мусора (save_garbage).
+
+    Сохранить в исходный файл нельзя (ValueError): source_doc читает его
+    во время сохранения, а открытый документ и процессы пула после записи
+    видели бы другое содержимое.
+    """
+    if same_file(file_path, output_path):
+        raise ValueError("Нельзя сохранить изменения в открытый файл - выберите другое имя")
+    mode, fallback = choose_export_mode(source_doc, page_edits, mode)
+    if mode == EXPORT_MODE_INCREMENTAL:
+        report = export_incremental(file_path, output_path, page_edits)
+    else:
+        new_doc, report = export_document(source_doc, file_path, page_edits, workers=workers,
+                                          on_error=on_error, profile=profile)
+        try:
+            new_doc.save(output_path, garbage=save_garbage(page_edits))
+        finally:
+            new_doc.close()
+    report['mode'] = mode
+    if fallback is not None:
+        report['fallback'] = fallback
+    return report
+
+
+def export_bytes(source_doc, file_path, page_edits, mode=EXPORT_MODE_FULL,
+                 workers=None, on_error=None, profile=None):
+    """Сохранение source_doc с изменениями страниц в память: (данные PDF, отчет)
+
+    Пересобранный документ сериализуется сразу в память, без записи на диск
+    (со сборкой мусора, если содержимое удалялось - save_garbage).
+    Дописывать изменения MuPDF умеет только в файл, поэтому в инкрементальном
+    режиме используется временная копия, которая сразу удаляется.
+    """
+    mode, fallback = choose_export_mode(source_doc, page_edits, mode)
+    if mode == EXPORT_MODE_INCREMENTAL:
+        fd, temp_path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        try:
+            report = export_incremental(file_path, temp_path, page_edits)
+            with open(temp_path, 'rb') as f:
+                data = f.read()
+        finally:
+            os.remove(temp_path)
+    else:
+        new_doc, report = export_document(source_doc, file_path, page_edits, workers=workers,
+                                          on_error=on_error, profile=profile)
+        try:
+            data = new_doc.tobytes(garbage=save_garbage(page_edits))
+        finally:
+            new_doc.close()
+    report['mode'] = mode
+    if fallback is not None:
+        report['fallback'] = fallback
+    return data, report
+
+
+def format_report(report, limit=10):
+    """Краткий текстовый отчет о сохранении: итоги и самые тяжелые страницы"""
+    if report.get('mode') == EXPORT_MODE_INCREMENTAL:
+        mode = "дописывание изменений в файл"
+    elif report.get('fallback'):
+        mode = f"пересборка документа ({report['fallback']})"
+    else:
+        mode = "пересборка документа"
+    copied = f"без изменений: {report['copied_pages']}"
+    if report['copy_steps']:
+        copied += f" ({report['copy_steps']} серий копирования)"
+    lines = [
+        f"Режим: {mode}",
+        f"Обработано страниц: {len(report['pages'])}, {copied}, процессов: {report['workers']}",
+        f"Время: {report['seconds']:.1f} с (по страницам {report['page_seconds']:.1f} с), "
+        f"размер страниц: {report['page_bytes'] / 1024:.0f} КБ",
+    ]
+    if report.get('unredacted_pages'):
+        pages = ", ".join(str(page + 1) for page in report['unredacted_pages'])
+        lines.append(f"Содержимое под областями удаления удалено не полностью: стр. {pages}")
+    heaviest = sorted(report['pages'], key=lambda page: page['seconds'], reverse=True)[:limit]
+    for page in heaviest:
+        lines.append(f"  стр. {page['page'] + 1}: {page['mode']}, "
+                     f"{page['seconds']:.2f} с, {page['bytes'] / 1024:.0f} КБ")
+    return "\n".join(lines)
@@ -0,0 +1,105 @@
+"""
+Профили сохранения растеризуемых страниц: разрешение и способ сжатия
+"""
+import io
+
+from PIL import Image, features
+
+from pixmap_utils import image_to_pixmap
+
+# Способы сжатия изображения страницы
+CODEC_AUTO = 'auto'   # выбор по содержимому страницы
+CODEC_FLATE = 'flate'  # без потерь (как PNG)
+CODEC_JPEG = 'jpeg'
+CODEC_JPX = 'jpx'     # JPEG 2000
+
+# Профили: dpi - разрешение рендеринга, codec - способ сжатия,
+# photo_codec - сжатие "фотографических" страниц в режиме auto
+EXPORT_PROFILES = {
+    'draft': {'dpi': 72, 'codec': CODEC_AUTO, 'photo_codec': CODEC_JPEG, 'jpeg_quality': 70, 'jpx_rate': 40},
+    'standard': {'dpi': 150, 'codec': CODEC_AUTO, 'photo_codec': CODEC_JPEG, 'jpeg_quality': 85, 'jpx_rate': 20},
+    'print': {'dpi': 300, 'codec': CODEC_AUTO, 'photo_codec': CODEC_JPEG, 'jpeg_quality': 92, 'jpx_rate': 10},
+    'lossless': {'dpi': 150, 'codec': CODEC_FLATE, 'photo_codec': CODEC_FLATE, 'jpeg_quality': 95, 'jpx_rate': 0},
+    'compact': {'dpi': 150, 'codec': CODEC_AUTO, 'photo_codec': CODEC_JPX, 'jpeg_quality': 85, 'jpx_rate': 40},
+}
+DEFAULT_EXPORT_PROFILE = 'standard'
+# Названия профилей в интерфейсе
+EXPORT_PROFILE_LABELS = {
+    'draft': "Черновик (72 DPI, JPEG)",
+    'standard': "Стандарт (150 DPI, JPEG)",
+    'print': "Печать (300 DPI, JPEG)",
+    'lossless': "Без потерь (150 DPI)",
+    'compact': "Компактный (150 DPI, JPEG 2000)",
+}
+# Пределы разрешения профиля, заданного словарем (память страницы растет как квадрат dpi)
+MIN_EXPORT_DPI = 36
+MAX_EXPORT_DPI = 600
+
+# Эвристика: страница считается "графической" (текст, линии, заливки), если
+# несколько самых частых цветов покрывают почти все пиксели
+HEURISTIC_SAMPLE_SIZE = 256
+HEURISTIC_TOP_COLORS = 16
+HEURISTIC_FLAT_COVERAGE = 0.9
+
+
+def get_profile(profile=None):
+    """Профиль по имени или словарю; недостающие параметры берутся из профиля по умолчанию
+
+    Разрешение ограничивается MIN_EXPORT_DPI..MAX_EXPORT_DPI.
+    """
+    if profile is None:
+        profile = DEFAULT_EXPORT_PROFILE
+    if isinstance(profile, str):
+        profile = EXPORT_PROFILES.get(profile, EXPORT_PROFILES[DEFAULT_EXPORT_PROFILE])
+    profile = dict(EXPORT_PROFILES[DEFAULT_EXPORT_PROFILE], **profile)
+    profile['dpi'] = min(MAX_EXPORT_DPI, max(MIN_EXPORT_DPI, float(profile['dpi'])))
+    return profile
+
+
+def is_flat_image(img):
+    """Преобладают ли в изображении несколько цветов (текст и графика, а не фото)"""
+    sample = img.resize(
+        (max(1, min(img.width, HEURISTIC_SAMPLE_SIZE)), max(1, min(img.height, HEURISTIC_SAMPLE_SIZE))),
+        Image.Resampling.NEAREST)
+    total = sample.width * sample.height
+    colors = sample.getcolors(maxcolors=total)
+    counts = sorted((count for count, color in colors), reverse=True)
+    return sum(counts[:HEURISTIC_TOP_COLORS]) >= total * HEURISTIC_FLAT_COVERAGE
+
+
+def choose_codec(img, profile):
+    """Способ сжатия изображения страницы по профилю"""
+    codec = profile['codec']
+    if codec == CODEC_AUTO:
+        codec = CODEC_FLATE if is_flat_image(img) else profile['photo_codec']
+    if codec == CODEC_JPX and not features.check('jpg_2000'):
+        # Pillow собран без OpenJPEG
+        codec = CODEC_JPEG
+    return codec
+
+
+def insert_page_image(page, rect, img, profile):
+    """Вставка изображения страницы с выбранным сжатием; возвращает способ сжатия"""
+    codec = choose_codec(img, profile)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if codec == CODEC_FLATE:
+        # Пиксмап вставляется несжатым - сжимаем поток сразу (без кодирования в PNG)
+        doc = page.parent
+        xref = page.insert_image(rect, pixmap=image_to_pixmap(img))
+        doc.update_stream(xref, doc.xref_stream_raw(xref), compress=True)
+        return codec
+
+    img_bytes = io.BytesIO()
+    if codec == CODEC_JPX:
+        img.save(img_bytes, format='JPEG2000', quality_mode='rates',
+                 quality_layers=[profile['jpx_rate']] if profile['jpx_rate'] else None)
+    else:
+        img.save(img_bytes, format='JPEG', quality=profile['jpeg_quality'], optimize=True)
+    page.insert_image(rect, stream=img_bytes.getvalue())
+    return codec
+
+
+def render_zoom(profile):
+    """Масштаб рендеринга страницы для разрешения профиля"""
+    return profile['dpi'] / 72.0
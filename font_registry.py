@@ -0,0 +1,75 @@
+"""
+Реестр шрифтов для вставленного текста: файлы ищутся один раз, шрифты кэшируются
+"""
+import logging
+import threading
+
+from PIL import ImageFont
+
+logger = logging.getLogger(__name__)
+
+# Файлы шрифтов по семействам в порядке предпочтения
+FONT_CANDIDATES = {
+    'default': ("arial.ttf", "/System/Library/Fonts/Helvetica.ttc"),
+}
+
+
+class FontRegistry:
+    """Поиск файлов шрифтов при запуске и кэш FreeTypeFont по (семейство, размер)
+
+    Если ни один файл семейства не найден, используется стандартный шрифт
+    Pillow; об этом сообщается один раз при поиске, а не при каждой отрисовке.
+    """
+
+    def __init__(self, candidates=None):
+        self.candidates = candidates or FONT_CANDIDATES
+        self.paths = None  # семейство -> путь к файлу или None
+        self.fonts = {}  # (семейство, размер) -> шрифт
+        self.lock = threading.Lock()
+
+    def resolve(self):
+        """Поиск доступных файлов шрифтов (выполняется один раз)"""
+        with self.lock:
+            if self.paths is not None:
+                return self.paths
+            paths = {}
+            for family, files in self.candidates.items():
+                paths[family] = None
+                for file_name in files:
+                    try:
+                        # truetype ищет и в системных папках шрифтов; запоминаем найденный путь
+                        paths[family] = ImageFont.truetype(file_name, 10).path
+                        break
+                    except OSError:
+                        continue
+                if paths[family]:
+                    logger.info("Шрифт '%s': %s", family, paths[family])
+                else:
+                    logger.warning("Шрифт '%s' не найден, используется стандартный шрифт Pillow", family)
+            self.paths = paths
+            return paths
+
+    def font_path(self, family='default'):
+        """Путь к файлу шрифта семейства или None"""
+        return self.resolve().get(family)
+
+    def get_font(self, size, family='default'):
+        """Шрифт заданного размера (загружается один раз)"""
+        key = (family, size)
+        font = self.fonts.get(key)
+        if font is not None:
+            return font
+        path = self.resolve().get(family)
+        if path:
+            try:
+                font = ImageFont.truetype(path, size)
+            except (OSError, ValueError):
+                font = ImageFont.load_default()
+        else:
+            font = ImageFont.load_default()
+        with self.lock:
+            return self.fonts.setdefault(key, font)
+
+
+# Общий реестр приложения
+font_registry = FontRegistry()
@@ -0,0 +1,100 @@
+"""
+Кэш изображений страниц с вытеснением по LRU и ограничением по памяти
+"""
+import threading
+from collections import OrderedDict
+
+# Ограничение кэша по умолчанию (байты)
+DEFAULT_CACHE_LIMIT = 256 * 1024 * 1024
+
+
+def image_nbytes(image):
+    """Оценка объема памяти изображения (PIL Image или Tk PhotoImage)"""
+    width = image.width() if callable(image.width) else image.width
+    height = image.height() if callable(image.height) else image.height
+    # Tk хранит изображения в формате RGBA
+    return width * height * 4
+
+
+class ImageCache:
+    """LRU кэш изображений с ограничением суммарного размера в байтах
+
+    Ключи - кортежи, первый элемент которых - тип изображения
+    ('base', 'preview', 'tile'), второй - номер страницы, третий - масштаб.
+    """
+
+    def __init__(self, limit_bytes=DEFAULT_CACHE_LIMIT):
+        self.limit_bytes = limit_bytes
+        self.entries = OrderedDict()  # key -> (value, nbytes)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key, default=None):
+        """Получение изображения; обращение делает запись самой свежей"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes=None):
+        """Добавление изображения с вытеснением давно не использованных"""
+        if nbytes is None:
+            nbytes = image_nbytes(value)
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (value, nbytes)
+            self.total_bytes += nbytes
+            # Самую свежую запись не вытесняем, даже если она больше лимита
+            while self.total_bytes > self.limit_bytes and len(self.entries) > 1:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                self.evictions += 1
+        return value
+
+    def discard(self, key):
+        """Удаление одной записи"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+    def invalidate(self, predicate):
+        """Удаление всех записей, ключи которых удовлетворяют условию"""
+        with self.lock:
+            for key in [k for k in self.entries if predicate(k)]:
+                self.discard(key)
+
+    def clear(self):
+        """Полная очистка кэша (счетчики обращений сохраняются)"""
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """Статистика кэша"""
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'limit_bytes': self.limit_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / requests if requests else 0.0,
+            }
@@ -0,0 +1,159 @@
+"""
+Вставляемые изображения: кэш для предпросмотра (файл декодируется и масштабируется
+один раз) и встраивание в PDF без дублирования
+"""
+import hashlib
+import io
+import os
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+from image_cache import ImageCache
+
+# Ограничение кэша вставляемых изображений (байты)
+INSERTED_CACHE_LIMIT = 64 * 1024 * 1024
+# Режимы Pillow, которые PNG хранит без преобразования
+PNG_MODES = ('1', 'L', 'LA', 'P', 'RGB', 'RGBA')
+# Во сколько раз источник должен быть больше цели, чтобы JPEG декодировался уменьшенным
+DRAFT_MIN_RATIO = 2
+
+
+def target_size(source_size, width, height):
+    """Итоговый размер вставляемого изображения по заданным ширине и высоте
+
+    0 означает "не задано": вторая сторона вычисляется с сохранением пропорций.
+    """
+    source_width, source_height = source_size
+    if width > 0 and height > 0:
+        return width, height
+    if width > 0:
+        return width, int(source_height * (width / source_width))
+    if height > 0:
+        return int(source_width * (height / source_height)), height
+    return source_width, source_height
+
+
+def has_transparency(img):
+    """Есть ли у изображения прозрачность: альфа-канал или прозрачный цвет (палитра, tRNS)"""
+    return 'A' in img.getbands() or 'transparency' in img.info
+
+
+def decode_image(path, width=0, height=0, scale=1.0):
+    """Декодирование, масштабирование и приведение изображения к RGB/RGBA
+
+    scale - масштаб отрисовки (размеры width/height заданы в пунктах PDF).
+    """
+    img = Image.open(path)
+    size = target_size(img.size, width, height)
+    if scale != 1.0:
+        size = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+    # JPEG можно декодировать сразу в уменьшенном (1/2, 1/4, 1/8) размере
+    if (size != img.size and img.format == 'JPEG' and img.width >= size[0] * DRAFT_MIN_RATIO
+            and img.height >= size[1] * DRAFT_MIN_RATIO):
+        img.draft(img.mode, size)
+    # Преобразование до масштабирования: палитру Pillow масштабирует без сглаживания
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if has_transparency(img) else 'RGB')
+    if size != img.size:
+        img = img.resize(size, Image.Resampling.LANCZOS)
+    else:
+        img.load()
+    return img
+
+
+def png_bytes(data):
+    """Изображение из байтов файла любого формата Pillow, перекодированное в PNG без потерь"""
+    with Image.open(io.BytesIO(data)) as img:
+        if img.mode not in PNG_MODES:
+            img = img.convert('RGBA' if has_transparency(img) else 'RGB')
+        output = io.BytesIO()
+        img.save(output, format='PNG')
+    return output.getvalue()
+
+
+class InsertedImageCache:
+    """Кэш готовых к вставке изображений по (путь, время изменения, размер)
+
+    Изменение файла на диске меняет ключ, поэтому устаревшие записи
+    не используются и со временем вытесняются. Возвращаемые изображения
+    общие - изменять их нельзя.
+    """
+
+    def __init__(self, limit_bytes=INSERTED_CACHE_LIMIT):
+        self.cache = ImageCache(limit_bytes)
+
+    def get(self, path, width=0, height=0, scale=1.0):
+        """Изображение для вставки или None, если файл недоступен"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        key = ('inserted', str(path), mtime, width, height, scale)
+        img = self.cache.get(key)
+        if img is None:
+            img = self.cache.put(key, decode_image(path, width, height, scale))
+        return img
+
+    def stats(self):
+        """Статистика кэша"""
+        return self.cache.stats()
+
+
+# Общий кэш приложения
+inserted_images = InsertedImageCache()
+
+
+class EmbeddedImages:
+    """Изображения, встроенные в документ PDF: одинаковое содержимое встраивается один раз
+
+    Файлы сравниваются по хэшу содержимого, поэтому одно изображение,
+    вставленное на тысячу страниц (или сохраненное в разных файлах),
+    хранится в документе одним объектом, на который ссылаются все страницы.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.hashes = {}  # (путь, время изменения) -> хэш содержимого
+        self.images = {}  # хэш содержимого -> (xref, размер изображения)
+
+    def embed(self, page, path, x, y, width=0, height=0):
+        """Вставка изображения на страницу документа; возвращает False, если файл недоступен"""
+        try:
+            key = (str(path), os.stat(path).st_mtime_ns)
+        except OSError:
+            return False
+
+        data = None
+        digest = self.hashes.get(key)
+        if digest is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = self.hashes[key] = hashlib.sha1(data).hexdigest()
+
+        if digest in self.images:
+            xref, size = self.images[digest]
+            page.insert_image(self.rect(x, y, size, width, height), xref=xref, keep_proportion=False)
+            return True
+
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        # Размер по заголовку файла, без декодирования
+        with Image.open(io.BytesIO(data)) as img:
+            size = img.size
+        rect = self.rect(x, y, size, width, height)
+        try:
+            # Встраивается исходный файл, без перекодирования
+            xref = page.insert_image(rect, stream=data, keep_proportion=False)
+        except Exception:
+            # Формат, который MuPDF не читает (например, WebP), встраивается как PNG
+            xref = page.insert_image(rect, stream=png_bytes(data), keep_proportion=False)
+        self.images[digest] = (xref, size)
+        return True
+
+    @staticmethod
+    def rect(x, y, size, width, height):
+        """Область изображения на странице (размеры в пунктах PDF)"""
+        target_width, target_height = target_size(size, width, height)
+        return fitz.Rect(x, y, x + target_width, y + target_height)
@@ -1,11 +1,27 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, colorchooser
-from PIL import Image, ImageTk
+from PIL import ImageTk
 import fitz  # PyMuPDF
-import io
 import json
+import logging
+import multiprocessing
 from pathlib import Path
 
+from color_sampler import MAX_SAMPLE_RADIUS, color_to_hex, sample_image_color, sample_page_color
+from edit_tracker import EditTracker
+from export_engine import (DEFAULT_EXPORT_WORKERS, EXPORT_MODE_FULL, EXPORT_MODE_INCREMENTAL, format_report,
+                           same_file, save_document)
+from export_profiles import DEFAULT_EXPORT_PROFILE, EXPORT_PROFILE_LABELS
+from font_registry import font_registry
+from image_cache import ImageCache
+from page_edits import apply_edits_to_image, collect_page_edits
+from pixmap_utils import render_page_image
+from render_worker import PageRenderPool
+from tile_renderer import page_pixel_size, render_tile, should_tile, tile_intersects, visible_tiles
+
+# Сколько соседних страниц рендерить заранее в каждую сторону
+PREFETCH_PAGES = 1
+
 
 class PDFEditor:
     def __init__(self, root):
@@ -31,9 +47,28 @@ class PDFEditor:
         self.eyedropper_color = None  # Цвет, выбранный пипеткой
         self.color_replacements = []  # Замены цвета для всей страницы (цвет -> цвет)
         self.color_tolerance = 30  # Допуск для поиска похожих цветов (0-255)
+        self.eyedropper_radius = 0  # Радиус усреднения пипетки в пикселях экрана (0 - один пиксель)
+        self.export_workers = DEFAULT_EXPORT_WORKERS  # Число процессов при сохранении PDF
+        self.export_profile = DEFAULT_EXPORT_PROFILE  # Профиль растеризации страниц (export_profiles)
+        self.export_mode = EXPORT_MODE_FULL  # 'full' - пересборка, 'incremental' - дописывание в файл
+        self.redact_deletions = False  # Удалять содержимое под областями удаления при сохранении
+        self.last_export_report = None  # Отчет о последнем сохранении (время и размер страниц)
         self.inserted_content = []  # Вставленный контент: [{'page': int, 'type': 'text'/'image', 'x': float, 'y': float, 'data': {...}}]
-        self.page_images = []  # Кэш базовых изображений страниц (без изменений)
-        self.preview_images = {}  # Кэш изображений с примененными изменениями
+        self.edit_tracker = EditTracker(0)  # Версии и сводки изменений страниц
+        # Кэш изображений страниц (LRU, ограничен по памяти):
+        #   ('base', страница, масштаб) - без изменений
+        #   ('preview', страница, масштаб) - с примененными изменениями
+        #   ('source', страница, масштаб) - PIL изображение без изменений (для точечного обновления)
+        #   ('composite', страница, масштаб) - PIL изображение с примененными изменениями
+        #   ('tile', страница, масштаб, col, row, предпросмотр) - тайлы больших страниц
+        self.image_cache = ImageCache()
+        self.displayed_images = []  # Изображения, которые сейчас на canvas (не должны удаляться сборщиком мусора)
+        self.tile_items = {}  # ID тайлов на canvas для текущей страницы
+        self.tiled_view = False  # Текущая страница отображается тайлами
+        self.tiles_update_pending = False  # Запланировано обновление тайлов
+        self.render_pool = PageRenderPool(self.root)  # Фоновый рендеринг и предзагрузка страниц
+        self.render_generation = 0  # Номер последнего запроса отображения страницы
+        self.prefetched_images = {}  # Отрендеренные в фоне страницы: (страница, масштаб) -> PIL Image
         self.rect_id = None  # ID текущего прямоугольника выделения
         self.img_id = None  # ID изображения на canvas
         self.selection_rects = {}  # Словарь для хранения ID прямоугольников выделения
@@ -41,6 +76,9 @@ class PDFEditor:
         self.scroll_start_x = None  # Начальная позиция для прокрутки перетаскиванием
         self.scroll_start_y = None
         
+        # Поиск файлов шрифтов для вставленного текста (один раз при запуске)
+        font_registry.resolve()
+        
         # Создание интерфейса
         self.create_widgets()
         # Привязка горячих клавиш
@@ -56,6 +94,27 @@ class PDFEditor:
         menubar.add_cascade(label="Файл", menu=file_menu)
         file_menu.add_command(label="Загрузить PDF...", command=self.load_pdf, accelerator="Ctrl+O")
         file_menu.add_command(label="Сохранить PDF...", command=self.save_pdf, accelerator="Ctrl+S")
+        
+        # Параметры сохранения
+        save_options_menu = tk.Menu(file_menu, tearoff=0)
+        file_menu.add_cascade(label="Параметры сохранения", menu=save_options_menu)
+        self.redact_var = tk.BooleanVar(value=self.redact_deletions)
+        self.export_mode_var = tk.StringVar(value=self.export_mode)
+        save_options_menu.add_radiobutton(label="Пересобрать документ", value=EXPORT_MODE_FULL,
+                                          variable=self.export_mode_var, command=self.set_export_mode)
+        save_options_menu.add_radiobutton(label="Дописать изменения в копию файла",
+                                          value=EXPORT_MODE_INCREMENTAL,
+                                          variable=self.export_mode_var, command=self.set_export_mode)
+        save_options_menu.add_separator()
+        # Профиль растеризации: страницы, которые нельзя сохранить векторными
+        self.export_profile_var = tk.StringVar(value=self.export_profile)
+        for profile, label in EXPORT_PROFILE_LABELS.items():
+            save_options_menu.add_radiobutton(label=label, value=profile,
+                                              variable=self.export_profile_var,
+                                              command=self.set_export_profile)
+        save_options_menu.add_separator()
+        save_options_menu.add_checkbutton(label="Удалять содержимое под областями удаления",
+                                          variable=self.redact_var, command=self.toggle_redaction)
         file_menu.add_separator()
         file_menu.add_command(label="Сохранить шаблон...", command=self.save_template)
         file_menu.add_command(label="Загрузить шаблон...", command=self.load_template)
@@ -243,6 +302,18 @@ class PDFEditor:
         eyedropper_btn.pack(side=tk.LEFT, padx=2)
         self.create_tooltip(eyedropper_btn, "Выбрать цвет для замены на всей странице (E)")
         
+        # Радиус пипетки: 0 - цвет одного пикселя, больше - средний цвет квадрата вокруг него
+        self.eyedropper_radius_var = tk.IntVar(value=self.eyedropper_radius)
+        ttk.Label(toolbar, text="Радиус:").pack(side=tk.LEFT, padx=(2, 0))
+        eyedropper_radius_spin = ttk.Spinbox(toolbar, from_=0, to=MAX_SAMPLE_RADIUS, width=3,
+                                             textvariable=self.eyedropper_radius_var,
+                                             command=self.set_eyedropper_radius)
+        eyedropper_radius_spin.pack(side=tk.LEFT, padx=2)
+        eyedropper_radius_spin.bind('<FocusOut>', lambda e: self.set_eyedropper_radius())
+        eyedropper_radius_spin.bind('<Return>', lambda e: self.set_eyedropper_radius())
+        self.create_tooltip(eyedropper_radius_spin,
+                            "Радиус пипетки в пикселях: 0 - один пиксель, больше - средний цвет вокруг точки")
+        
         remove_btn = ttk.Button(toolbar, text="✂️ Удалить", 
                   command=lambda: self.set_selection_mode('remove'))
         remove_btn.pack(side=tk.LEFT, padx=2)
@@ -326,7 +397,18 @@ class PDFEditor:
         self.canvas = tk.Canvas(canvas_frame, bg='white')
         scrollbar_v = ttk.Scrollbar(canvas_frame, orient=tk.VERTICAL, command=self.canvas.yview)
         scrollbar_h = ttk.Scrollbar(canvas_frame, orient=tk.HORIZONTAL, command=self.canvas.xview)
-        self.canvas.configure(yscrollcommand=scrollbar_v.set, xscrollcommand=scrollbar_h.set)
+        
+        # При любой прокрутке подгружаем новые тайлы (в тайловом режиме)
+        def on_yscroll(first, last):
+            scrollbar_v.set(first, last)
+            self.schedule_tiles_update()
+        
+        def on_xscroll(first, last):
+            scrollbar_h.set(first, last)
+            self.schedule_tiles_update()
+        
+        self.canvas.configure(yscrollcommand=on_yscroll, xscrollcommand=on_xscroll)
+        self.canvas.bind("<Configure>", lambda e: self.schedule_tiles_update())
         
         self.canvas.grid(row=0, column=0, sticky="nsew")
         scrollbar_v.grid(row=0, column=1, sticky="ns")
@@ -540,13 +622,16 @@ class PDFEditor:
                 
                 self.current_page = 0
                 self.zoom = 1.0
-                self.page_images = [None] * self.total_pages
+                self.render_pool.open(file_path)
+                self.prefetched_images.clear()
                 self.deletion_areas = [[] for _ in range(self.total_pages)]
                 self.color_changes = [[] for _ in range(self.total_pages)]
                 self.color_replacements = [[] for _ in range(self.total_pages)]
                 self.inserted_content = []  # Очистка вставленного контента
-                self.preview_images.clear()  # Очистка кэша предпросмотра
+                self.edit_tracker = EditTracker(self.total_pages)
+                self.image_cache.clear()  # Очистка кэша изображений
                 self.update_page_display()
+                self.prefetch_neighbours()
                 self.update_info_panels()
                 self.status_label.config(text=f"Загружен: {Path(file_path).name} ({self.total_pages} страниц)")
             except Exception as e:
@@ -555,180 +640,56 @@ class PDFEditor:
                     self.pdf_document.close()
                     self.pdf_document = None
     
-    def render_page(self, page_num, zoom=1.0, apply_changes=False):
-        """Рендеринг страницы PDF в изображение"""
-        if self.pdf_document is None or page_num >= self.total_pages:
-            return None
-            
-        page = self.pdf_document[page_num]
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        
-        img_data = pix.tobytes("ppm")
-        img = Image.open(io.BytesIO(img_data))
-        
-        # Применение изменений в реальном времени
-        if apply_changes:
-            img = self.apply_changes_to_image(img, page_num, zoom)
-        
-        return ImageTk.PhotoImage(img)
+    def render_page_image(self, page_num, zoom=1.0):
+        """Рендеринг страницы PDF в PIL изображение без изменений"""
+        return render_page_image(self.pdf_document[page_num], zoom)
     
-    def apply_changes_to_image(self, img, page_num, zoom):
-        """Применение изменений к изображению для предпросмотра"""
-        from PIL import ImageDraw
+    def take_page_image(self, page_num, zoom):
+        """PIL изображение страницы: из фоновой предзагрузки или новый рендеринг"""
+        img = self.prefetched_images.pop((page_num, zoom), None)
+        if img is None:
+            img = self.render_page_image(page_num, zoom)
+        return img
+    
+    def apply_changes_to_image(self, img, page_num, zoom, offset=(0, 0)):
+        """Применение изменений к изображению для предпросмотра
         
-        if page_num >= len(self.deletion_areas) and page_num >= len(self.color_changes):
+        offset - положение изображения в пикселях страницы (для тайлов).
+        """
+        if not self.edit_tracker.has_edits(page_num):
             return img
-        
-        # Создаем копию изображения для редактирования
-        img_copy = img.copy()
-        draw = ImageDraw.Draw(img_copy)
-        
-        # Применение удалений (закрашивание белым)
-        if page_num < len(self.deletion_areas):
-            for area in self.deletion_areas[page_num]:
-                x1, y1, x2, y2 = area
-                # Масштабируем координаты
-                x1_scaled = int(x1 * zoom)
-                y1_scaled = int(y1 * zoom)
-                x2_scaled = int(x2 * zoom)
-                y2_scaled = int(y2 * zoom)
-                
-                # Ограничиваем координаты размерами изображения
-                x1_scaled = max(0, min(x1_scaled, img.width))
-                y1_scaled = max(0, min(y1_scaled, img.height))
-                x2_scaled = max(0, min(x2_scaled, img.width))
-                y2_scaled = max(0, min(y2_scaled, img.height))
-                
-                if x1_scaled < x2_scaled and y1_scaled < y2_scaled:
-                    draw.rectangle([x1_scaled, y1_scaled, x2_scaled, y2_scaled], 
-                                 fill=(255, 255, 255), outline=None)
-        
-        # Применение замены цвета
-        if page_num < len(self.color_changes):
-            for change in self.color_changes[page_num]:
-                area, orig_color, new_color = change
-                x1, y1, x2, y2 = area
-                # Масштабируем координаты
-                x1_scaled = int(x1 * zoom)
-                y1_scaled = int(y1 * zoom)
-                x2_scaled = int(x2 * zoom)
-                y2_scaled = int(y2 * zoom)
-                
-                # Ограничиваем координаты размерами изображения
-                x1_scaled = max(0, min(x1_scaled, img.width))
-                y1_scaled = max(0, min(y1_scaled, img.height))
-                x2_scaled = max(0, min(x2_scaled, img.width))
-                y2_scaled = max(0, min(y2_scaled, img.height))
-                
-                if x1_scaled < x2_scaled and y1_scaled < y2_scaled:
-                    # Конвертация hex цвета в RGB
-                    if new_color and new_color.startswith('#'):
-                        try:
-                            r = int(new_color[1:3], 16)
-                            g = int(new_color[3:5], 16)
-                            b = int(new_color[5:7], 16)
-                            draw.rectangle([x1_scaled, y1_scaled, x2_scaled, y2_scaled], 
-                                         fill=(r, g, b), outline=None)
-                        except (ValueError, IndexError):
-                            pass
-        
-        # Применение замены цвета на всей странице (пипетка)
-        if page_num < len(self.color_replacements) and self.color_replacements[page_num]:
-            # Используем PIL для замены цвета (без numpy для совместимости)
-            pixels = img_copy.load()
-            width, height = img_copy.size
-            
-            for replacement in self.color_replacements[page_num]:
-                old_color_hex = replacement['old_color']
-                new_color_hex = replacement['new_color']
-                tolerance = replacement.get('tolerance', self.color_tolerance)
-                
-                # Конвертируем hex цвета в RGB
-                try:
-                    old_r = int(old_color_hex[1:3], 16)
-                    old_g = int(old_color_hex[3:5], 16)
-                    old_b = int(old_color_hex[5:7], 16)
-                    
-                    new_r = int(new_color_hex[1:3], 16)
-                    new_g = int(new_color_hex[3:5], 16)
-                    new_b = int(new_color_hex[5:7], 16)
-                except (ValueError, IndexError):
-                    continue
-                
-                # Проходим по всем пикселям и заменяем похожие цвета
-                for y in range(height):
-                    for x in range(width):
-                        r, g, b = pixels[x, y]
-                        
-                        # Вычисляем расстояние между цветами (евклидово расстояние)
-                        color_distance = ((r - old_r)**2 + (g - old_g)**2 + (b - old_b)**2)**0.5
-                        
-                        # Если цвет в пределах допуска, заменяем его
-                        if color_distance <= tolerance:
-                            pixels[x, y] = (new_r, new_g, new_b)
-        
-        # Применение вставленного контента
+        return apply_edits_to_image(img, self.get_page_edits(page_num), zoom, offset)
+    
+    def get_page_edits(self, page_num):
+        """Изменения страницы в виде словаря (см. page_edits.collect_page_edits)"""
+        # Вставленный контент просматривается, только если он есть на странице
+        has_content = self.edit_tracker.count(page_num, 'inserted_content') > 0
+        return collect_page_edits(page_num, self.deletion_areas, self.color_changes,
+                                  self.color_replacements, self.inserted_content if has_content else [],
+                                  self.color_tolerance, self.redact_deletions)
+    
+    def page_changed(self, page_num, reset=False, **deltas):
+        """Учет изменения страницы (см. EditTracker.changed); reset - все изменения страницы удалены"""
+        if reset:
+            self.edit_tracker.reset_page(page_num)
+        else:
+            self.edit_tracker.changed(page_num, **deltas)
+    
+    def recount_edits(self):
+        """Пересчет сводок изменений всех страниц (после массовой замены списков изменений)"""
+        content_counts = [0] * self.total_pages
         for content in self.inserted_content:
-            if content['page'] == page_num:
-                x = int(content['x'] * zoom)
-                y = int(content['y'] * zoom)
-                
-                if content['type'] == 'text':
-                    # Вставляем текст
-                    try:
-                        from PIL import ImageFont
-                        text = content['data']['text']
-                        font_size = content['data']['font_size']
-                        color_hex = content['data']['color']
-                        
-                        # Конвертируем цвет
-                        r = int(color_hex[1:3], 16)
-                        g = int(color_hex[3:5], 16)
-                        b = int(color_hex[5:7], 16)
-                        
-                        # Пытаемся загрузить шрифт, если не получается - используем стандартный
-                        try:
-                            font = ImageFont.truetype("arial.ttf", font_size)
-                        except:
-                            try:
-                                font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", font_size)
-                            except:
-                                font = ImageFont.load_default()
-                        
-                        # Рисуем текст
-                        draw.text((x, y), text, fill=(r, g, b), font=font)
-                    except Exception as e:
-                        # Если не удалось вставить текст, просто пропускаем
-                        pass
-                
-                elif content['type'] == 'image':
-                    # Вставляем изображение
-                    try:
-                        img_path = content['data']['path']
-                        if Path(img_path).exists():
-                            insert_img = Image.open(img_path)
-                            
-                            # Изменяем размер, если нужно
-                            width = content['data']['width']
-                            height = content['data']['height']
-                            if width > 0 or height > 0:
-                                if width > 0 and height > 0:
-                                    insert_img = insert_img.resize((width, height), Image.Resampling.LANCZOS)
-                                elif width > 0:
-                                    ratio = width / insert_img.width
-                                    insert_img = insert_img.resize((width, int(insert_img.height * ratio)), Image.Resampling.LANCZOS)
-                                elif height > 0:
-                                    ratio = height / insert_img.height
-                                    insert_img = insert_img.resize((int(insert_img.width * ratio), height), Image.Resampling.LANCZOS)
-                            
-                            # Вставляем изображение
-                            img_copy.paste(insert_img, (x, y), insert_img if insert_img.mode == 'RGBA' else None)
-                    except Exception as e:
-                        # Если не удалось вставить изображение, просто пропускаем
-                        pass
-        
-        return img_copy
+            if 0 <= content['page'] < self.total_pages:
+                content_counts[content['page']] += 1
+        for page_num in range(self.total_pages):
+            self.edit_tracker.set_counts(
+                page_num,
+                deletion_areas=len(self.deletion_areas[page_num]) if page_num < len(self.deletion_areas) else 0,
+                color_changes=len(self.color_changes[page_num]) if page_num < len(self.color_changes) else 0,
+                color_replacements=(len(self.color_replacements[page_num])
+                                    if page_num < len(self.color_replacements) else 0),
+                inserted_content=content_counts[page_num]
+            )
     
     def update_page_display(self):
         """Обновление отображения текущей страницы"""
@@ -738,52 +699,43 @@ class PDFEditor:
         # Очистка canvas
         self.canvas.delete("all")
         self.img_id = None
+        self.tile_items = {}
+        self.displayed_images = []
         
-        # Рендеринг базового изображения страницы (кэшируется)
-        if self.page_images[self.current_page] is None:
-            self.page_images[self.current_page] = self.render_page(self.current_page, self.zoom, apply_changes=False)
-        
-        if self.page_images[self.current_page] is None:
+        # Большие страницы отображаются тайлами: рендерится только видимая часть
+        page = self.pdf_document[self.current_page]
+        self.tiled_view = should_tile(page, self.zoom)
+        if self.tiled_view:
+            self.show_tiled_page(page)
             return
         
-        # Определяем, какое изображение показывать
-        page_key = f"{self.current_page}_{self.zoom}"
+        # Каждая пара (страница, масштаб) рендерится один раз: изображение без
+        # изменений уходит в Tk напрямую, с изменениями - через композит
         display_image = None
-        
-        if self.show_preview:
-            # Проверяем, есть ли изменения для этой страницы
-            has_changes = (
-                (self.current_page < len(self.deletion_areas) and len(self.deletion_areas[self.current_page]) > 0) or
-                (self.current_page < len(self.color_changes) and len(self.color_changes[self.current_page]) > 0) or
-                (self.current_page < len(self.color_replacements) and len(self.color_replacements[self.current_page]) > 0) or
-                any(c['page'] == self.current_page for c in self.inserted_content)
-            )
-            
-            if has_changes:
-                # Создаем изображение с примененными изменениями
-                if page_key not in self.preview_images:
-                    # Получаем базовое изображение
-                    base_img = self.render_page(self.current_page, self.zoom, apply_changes=False)
-                    if base_img:
-                        # Конвертируем PhotoImage обратно в PIL Image для редактирования
-                        page = self.pdf_document[self.current_page]
-                        mat = fitz.Matrix(self.zoom, self.zoom)
-                        pix = page.get_pixmap(matrix=mat, alpha=False)
-                        img_data = pix.tobytes("ppm")
-                        img = Image.open(io.BytesIO(img_data))
-                        # Применяем изменения
-                        img_with_changes = self.apply_changes_to_image(img, self.current_page, self.zoom)
-                        self.preview_images[page_key] = ImageTk.PhotoImage(img_with_changes)
-                display_image = self.preview_images.get(page_key)
-            else:
-                # Нет изменений, используем базовое изображение
-                display_image = self.page_images[self.current_page]
+        if self.show_preview and self.page_has_changes(self.current_page):
+            page_key = ('preview', self.current_page, self.zoom)
+            display_image = self.image_cache.get(page_key)
+            if display_image is None:
+                # Исходное изображение сохраняем для точечного обновления областей
+                source_key = ('source', self.current_page, self.zoom)
+                img = self.image_cache.get(source_key)
+                if img is None:
+                    img = self.image_cache.put(source_key, self.take_page_image(self.current_page, self.zoom))
+                # Применяем изменения
+                img_with_changes = self.apply_changes_to_image(img, self.current_page, self.zoom)
+                self.image_cache.put(('composite', self.current_page, self.zoom), img_with_changes)
+                display_image = self.image_cache.put(page_key, ImageTk.PhotoImage(img_with_changes))
         else:
-            # Режим без предпросмотра
-            display_image = self.page_images[self.current_page]
+            # Нет изменений или режим без предпросмотра: базовое изображение (кэшируется)
+            base_key = ('base', self.current_page, self.zoom)
+            display_image = self.image_cache.get(base_key)
+            if display_image is None:
+                img = self.image_cache.get(('source', self.current_page, self.zoom))
+                if img is None:
+                    img = self.take_page_image(self.current_page, self.zoom)
+                display_image = self.image_cache.put(base_key, ImageTk.PhotoImage(img))
         
-        if display_image is None:
-            display_image = self.page_images[self.current_page]
+        self.displayed_images = [display_image]
         
         # Получение размеров изображения
         img_width = display_image.width()
@@ -799,6 +751,10 @@ class PDFEditor:
         # Установка области прокрутки
         self.canvas.config(scrollregion=(0, 0, img_width + 40, img_height + 40))
         
+        self.finish_page_display()
+    
+    def finish_page_display(self):
+        """Общая часть отображения страницы: контуры, метка страницы, панели"""
         # Отображение контуров выделенных областей (для навигации)
         # В режиме предпросмотра показываем тонкие контуры поверх изображения
         self.draw_selection_areas()
@@ -809,6 +765,67 @@ class PDFEditor:
         # Обновление информации о выделениях для текущей страницы
         self.update_info_panels()
     
+    def page_has_changes(self, page_num):
+        """Проверка, есть ли изменения на странице"""
+        return self.edit_tracker.has_edits(page_num)
+    
+    def show_tiled_page(self, page):
+        """Отображение большой страницы тайлами"""
+        img_width, img_height = page_pixel_size(page, self.zoom)
+        
+        self.canvas.config(scrollregion=(0, 0, img_width + 40, img_height + 40))
+        self.finish_page_display()
+        self.update_visible_tiles()
+    
+    def schedule_tiles_update(self):
+        """Отложенное обновление тайлов после прокрутки (не чаще одного раза за цикл)"""
+        if not self.tiled_view or self.tiles_update_pending:
+            return
+        self.tiles_update_pending = True
+        self.root.after_idle(self.update_visible_tiles)
+    
+    def update_visible_tiles(self):
+        """Рендеринг тайлов, попадающих в видимую область canvas"""
+        self.tiles_update_pending = False
+        if (not self.tiled_view or self.pdf_document is None or
+                not (0 <= self.current_page < self.total_pages)):
+            return
+        
+        page = self.pdf_document[self.current_page]
+        img_width, img_height = page_pixel_size(page, self.zoom)
+        
+        # Видимая область в пикселях страницы (изображение смещено на 20 пикселей)
+        view_x = self.canvas.canvasx(0) - 20
+        view_y = self.canvas.canvasy(0) - 20
+        view_box = (view_x, view_y,
+                    view_x + self.canvas.winfo_width(), view_y + self.canvas.winfo_height())
+        
+        preview = self.show_preview and self.page_has_changes(self.current_page)
+        for col, row in visible_tiles(img_width, img_height, view_box):
+            key = ('tile', self.current_page, self.zoom, col, row, preview)
+            if key in self.tile_items:
+                continue
+            
+            tile = self.image_cache.get(key)
+            if tile is None:
+                img, position = render_tile(page, self.zoom, col, row)
+                if img is None:
+                    continue
+                if preview:
+                    img = self.apply_changes_to_image(img, self.current_page, self.zoom, offset=position)
+                tile = self.image_cache.put(key, (ImageTk.PhotoImage(img), position[0], position[1]),
+                                            img.width * img.height * 4)
+            
+            photo, x, y = tile
+            item_id = self.canvas.create_image(
+                x + 20, y + 20, anchor=tk.NW, image=photo, tags=("page_tile",)
+            )
+            # Тайл на canvas держит ссылку на изображение, даже если его вытеснили из кэша
+            self.tile_items[key] = (item_id, photo)
+        
+        # Тайлы всегда под контурами выделений
+        self.canvas.tag_lower("page_tile")
+    
     def draw_selection_areas(self):
         """Отрисовка выделенных областей на canvas"""
         if not (0 <= self.current_page < len(self.deletion_areas)):
@@ -910,21 +927,16 @@ class PDFEditor:
             
             # Проверяем, что клик в пределах страницы
             if 0 <= page_x < page_width and 0 <= page_y < page_height:
-                # Получаем изображение страницы
-                pix = page.get_pixmap()
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                
-                # Получаем цвет пикселя
-                pixel_x = int(page_x)
-                pixel_y = int(page_y)
-                
-                # Ограничиваем координаты
-                pixel_x = max(0, min(pixel_x, img.width - 1))
-                pixel_y = max(0, min(pixel_y, img.height - 1))
-                
-                # Получаем RGB цвет
-                r, g, b = img.getpixel((pixel_x, pixel_y))
-                selected_color = f"#{r:02x}{g:02x}{b:02x}"
+                # Цвет берем в масштабе отображения: из уже отрендеренной страницы,
+                # а если ее нет в кэше - из небольшого фрагмента вокруг точки
+                source = self.image_cache.get(('source', self.current_page, self.zoom))
+                if source is not None:
+                    rgb = sample_image_color(source, canvas_x - 20, canvas_y - 20,
+                                             self.eyedropper_radius)
+                else:
+                    rgb = sample_page_color(page, page_x, page_y, self.zoom,
+                                            self.eyedropper_radius)
+                selected_color = color_to_hex(rgb)
                 self.eyedropper_color = selected_color
                 
                 # Показываем диалог выбора нового цвета
@@ -944,6 +956,7 @@ class PDFEditor:
                         'new_color': new_color[1],
                         'tolerance': self.color_tolerance
                     })
+                    self.page_changed(self.current_page, color_replacements=1)
                     
                     # Инвалидируем кэш предпросмотра
                     self.invalidate_preview_cache(self.current_page)
@@ -977,8 +990,9 @@ class PDFEditor:
                                 # Находим индекс области
                                 for rect_id, idx in self.selection_rects[page_key]['delete']:
                                     if rect_id == item_id and 0 <= idx < len(self.deletion_areas[self.current_page]):
-                                        del self.deletion_areas[self.current_page][idx]
-                                        self.invalidate_preview_cache(self.current_page)
+                                        area = self.deletion_areas[self.current_page].pop(idx)
+                                        self.page_changed(self.current_page, deletion_areas=-1)
+                                        self.refresh_preview_region(self.current_page, area)
                                         self.update_page_display()
                                         self.update_info_panels()
                                         return
@@ -986,8 +1000,9 @@ class PDFEditor:
                                 # Находим индекс замены цвета
                                 for rect_id, idx in self.selection_rects[page_key]['color']:
                                     if rect_id == item_id and 0 <= idx < len(self.color_changes[self.current_page]):
-                                        del self.color_changes[self.current_page][idx]
-                                        self.invalidate_preview_cache(self.current_page)
+                                        area = self.color_changes[self.current_page].pop(idx)[0]
+                                        self.page_changed(self.current_page, color_changes=-1)
+                                        self.refresh_preview_region(self.current_page, area)
                                         self.update_page_display()
                                         self.update_info_panels()
                                         return
@@ -999,6 +1014,7 @@ class PDFEditor:
                                         if 0 <= idx < len(self.inserted_content):
                                             if self.inserted_content[idx]['page'] == self.current_page:
                                                 del self.inserted_content[idx]
+                                                self.page_changed(self.current_page, inserted_content=-1)
                                                 self.invalidate_preview_cache(self.current_page)
                                                 self.update_page_display()
                                                 self.update_info_panels()
@@ -1062,13 +1078,64 @@ class PDFEditor:
     def invalidate_preview_cache(self, page_num=None):
         """Инвалидация кэша предпросмотра для страницы"""
         if page_num is not None:
-            # Удаляем все кэшированные изображения для этой страницы
-            keys_to_remove = [k for k in self.preview_images.keys() if k.startswith(f"{page_num}_")]
-            for key in keys_to_remove:
-                del self.preview_images[key]
+            # Удаляем все изображения с изменениями для этой страницы (и тайлы)
+            self.image_cache.invalidate(
+                lambda key: key[1] == page_num and self.is_preview_key(key)
+            )
         else:
-            # Очищаем весь кэш
-            self.preview_images.clear()
+            # Очищаем весь кэш предпросмотра
+            self.image_cache.invalidate(self.is_preview_key)
+    
+    @staticmethod
+    def is_preview_key(key):
+        """Ключ кэша относится к изображению с примененными изменениями"""
+        return key[0] in ('preview', 'composite') or (key[0] == 'tile' and key[5])
+    
+    def refresh_preview_region(self, page_num, area):
+        """Точечное обновление предпросмотра после добавления или удаления области
+        
+        Вместо полной пересборки страницы заново собирается только прямоугольник
+        area (в координатах страницы) из закэшированного исходного рендера.
+        """
+        zoom = self.zoom
+        x1, y1, x2, y2 = area
+        # +1: прямоугольники рисуются включительно по правой и нижней границе
+        box = (int(x1 * zoom), int(y1 * zoom), int(x2 * zoom) + 1, int(y2 * zoom) + 1)
+        
+        if not self.page_has_changes(page_num):
+            self.invalidate_preview_cache(page_num)
+            return
+        
+        def is_stale(key):
+            if key[1] != page_num or not self.is_preview_key(key):
+                return False
+            if key[2] != zoom:
+                return True
+            if key[0] == 'tile':
+                return tile_intersects(key[3], key[4], box)
+            return False
+        
+        self.image_cache.invalidate(is_stale)
+        
+        source = self.image_cache.get(('source', page_num, zoom))
+        composite = self.image_cache.get(('composite', page_num, zoom))
+        preview = self.image_cache.get(('preview', page_num, zoom))
+        if source is None or composite is None or preview is None:
+            # Нечего обновлять точечно - страница пересоберется целиком при отображении
+            self.image_cache.discard(('composite', page_num, zoom))
+            self.image_cache.discard(('preview', page_num, zoom))
+            return
+        
+        box = (max(0, box[0]), max(0, box[1]),
+               min(composite.width, box[2]), min(composite.height, box[3]))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+        
+        region = self.apply_changes_to_image(source.crop(box), page_num, zoom, offset=box[:2])
+        composite.paste(region, box[:2])
+        # Копируем обновленный фрагмент прямо в отображаемое Tk изображение
+        patch = ImageTk.PhotoImage(region)
+        self.root.tk.call(str(preview), 'copy', str(patch), '-to', box[0], box[1])
     
     def on_mouse_up(self, event):
         """Завершение выделения области"""
@@ -1121,19 +1188,19 @@ class PDFEditor:
         try:
             if self.selection_mode == 'delete':
                 self.deletion_areas[self.current_page].append((x1, y1, x2, y2))
-                # Инвалидируем кэш предпросмотра для текущей страницы
-                self.invalidate_preview_cache(self.current_page)
+                self.page_changed(self.current_page, deletion_areas=1)
+                # Обновляем предпросмотр только в пределах новой области
+                self.refresh_preview_region(self.current_page, (x1, y1, x2, y2))
             elif self.selection_mode == 'color':
                 # Получение исходного цвета из PDF
-                pix = page.get_pixmap()
+                img = render_page_image(page)
                 
                 # Получение среднего цвета в области
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
                 # Ограничение координат для обрезки
                 crop_x1 = max(0, int(x1))
                 crop_y1 = max(0, int(y1))
-                crop_x2 = min(pix.width, int(x2))
-                crop_y2 = min(pix.height, int(y2))
+                crop_x2 = min(img.width, int(x2))
+                crop_y2 = min(img.height, int(y2))
                 
                 if crop_x2 > crop_x1 and crop_y2 > crop_y1:
                     cropped = img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
@@ -1147,8 +1214,9 @@ class PDFEditor:
                     self.color_changes[self.current_page].append(
                         ((x1, y1, x2, y2), orig_color, self.target_color)
                     )
-                    # Инвалидируем кэш предпросмотра для текущей страницы
-                    self.invalidate_preview_cache(self.current_page)
+                    self.page_changed(self.current_page, color_changes=1)
+                    # Обновляем предпросмотр только в пределах новой области
+                    self.refresh_preview_region(self.current_page, (x1, y1, x2, y2))
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось обработать выделение: {str(e)}")
             if self.rect_id:
@@ -1335,6 +1403,7 @@ class PDFEditor:
                         }
                     }
                     self.inserted_content.append(content_item)
+                    self.page_changed(content_item['page'], inserted_content=1)
                     
                     # Инвалидируем кэш
                     self.invalidate_preview_cache(self.current_page)
@@ -1373,6 +1442,7 @@ class PDFEditor:
                         }
                     }
                     self.inserted_content.append(content_item)
+                    self.page_changed(content_item['page'], inserted_content=1)
                     
                     # Инвалидируем кэш
                     self.invalidate_preview_cache(self.current_page)
@@ -1410,8 +1480,40 @@ class PDFEditor:
         if file_path:
             path_var.set(file_path)
     
+    def set_export_mode(self):
+        """Выбор режима сохранения: пересборка документа или дописывание изменений"""
+        self.export_mode = self.export_mode_var.get()
+        if self.export_mode == EXPORT_MODE_INCREMENTAL:
+            self.status_label.config(text="При сохранении изменения дописываются в конец копии файла")
+        else:
+            self.status_label.config(text="При сохранении документ пересобирается")
+    
+    def set_eyedropper_radius(self):
+        """Радиус усреднения пипетки из поля на панели инструментов (0..MAX_SAMPLE_RADIUS)"""
+        try:
+            radius = int(self.eyedropper_radius_var.get())
+        except (tk.TclError, ValueError):
+            radius = self.eyedropper_radius
+        self.eyedropper_radius = max(0, min(radius, MAX_SAMPLE_RADIUS))
+        self.eyedropper_radius_var.set(self.eyedropper_radius)
+    
+    def set_export_profile(self):
+        """Выбор профиля растеризации страниц при сохранении (разрешение и сжатие)"""
+        self.export_profile = self.export_profile_var.get()
+        self.status_label.config(
+            text=f"Растеризуемые страницы сохраняются с профилем: {EXPORT_PROFILE_LABELS[self.export_profile]}")
+    
+    def toggle_redaction(self):
+        """Переключение удаления содержимого под областями удаления при сохранении"""
+        self.redact_deletions = self.redact_var.get()
+        if self.redact_deletions:
+            self.status_label.config(text="При сохранении содержимое под областями удаления удаляется из файла")
+        else:
+            self.status_label.config(text="При сохранении области удаления только закрашиваются белым")
+    
     def on_closing(self):
         """Обработка закрытия приложения"""
+        self.render_pool.shutdown()
         if self.pdf_document is not None:
             self.pdf_document.close()
         self.root.destroy()
@@ -1426,8 +1528,9 @@ class PDFEditor:
         if selection:
             index = selection[0]
             if 0 <= index < len(self.deletion_areas[self.current_page]):
-                del self.deletion_areas[self.current_page][index]
-                self.invalidate_preview_cache(self.current_page)
+                area = self.deletion_areas[self.current_page].pop(index)
+                self.page_changed(self.current_page, deletion_areas=-1)
+                self.refresh_preview_region(self.current_page, area)
                 self.update_page_display()
                 self.update_info_panels()
     
@@ -1441,8 +1544,9 @@ class PDFEditor:
         if selection:
             index = selection[0]
             if 0 <= index < len(self.color_changes[self.current_page]):
-                del self.color_changes[self.current_page][index]
-                self.invalidate_preview_cache(self.current_page)
+                area = self.color_changes[self.current_page].pop(index)[0]
+                self.page_changed(self.current_page, color_changes=-1)
+                self.refresh_preview_region(self.current_page, area)
                 self.update_page_display()
                 self.update_info_panels()
     
@@ -1458,7 +1562,9 @@ class PDFEditor:
         if self.current_page < len(self.color_replacements):
             self.color_replacements[self.current_page] = []
         # Удаляем вставленный контент на текущей странице
-        self.inserted_content = [c for c in self.inserted_content if c['page'] != self.current_page]
+        if self.edit_tracker.count(self.current_page, 'inserted_content'):
+            self.inserted_content = [c for c in self.inserted_content if c['page'] != self.current_page]
+        self.page_changed(self.current_page, reset=True)
         self.invalidate_preview_cache(self.current_page)
         self.update_page_display()
         self.update_info_panels()
@@ -1470,13 +1576,11 @@ class PDFEditor:
             return
         
         # Проверяем, есть ли что применять
-        has_deletions = (self.current_page < len(self.deletion_areas) and 
-                        len(self.deletion_areas[self.current_page]) > 0)
-        has_color_changes = (self.current_page < len(self.color_changes) and 
-                           len(self.color_changes[self.current_page]) > 0)
-        has_color_replacements = (self.current_page < len(self.color_replacements) and 
-                                 len(self.color_replacements[self.current_page]) > 0)
-        has_inserted_content = any(c['page'] == self.current_page for c in self.inserted_content)
+        summary = self.edit_tracker.summary(self.current_page)
+        has_deletions = summary['deletion_areas'] > 0
+        has_color_changes = summary['color_changes'] > 0
+        has_color_replacements = summary['color_replacements'] > 0
+        has_inserted_content = summary['inserted_content'] > 0
         
         if not has_deletions and not has_color_changes and not has_color_replacements and not has_inserted_content:
             messagebox.showinfo("Информация", "На текущей странице нет выделений для применения")
@@ -1498,14 +1602,13 @@ class PDFEditor:
         # Информация
         info_text = f"Текущая страница: {self.current_page + 1}\n"
         if has_deletions:
-            info_text += f"Областей для удаления: {len(self.deletion_areas[self.current_page])}\n"
+            info_text += f"Областей для удаления: {summary['deletion_areas']}\n"
         if has_color_changes:
-            info_text += f"Замен цвета (области): {len(self.color_changes[self.current_page])}\n"
+            info_text += f"Замен цвета (области): {summary['color_changes']}\n"
         if has_color_replacements:
-            info_text += f"Замен цвета (вся страница): {len(self.color_replacements[self.current_page])}\n"
+            info_text += f"Замен цвета (вся страница): {summary['color_replacements']}\n"
         if has_inserted_content:
-            content_count = sum(1 for c in self.inserted_content if c['page'] == self.current_page)
-            info_text += f"Вставленный контент: {content_count}\n"
+            info_text += f"Вставленный контент: {summary['inserted_content']}\n"
         
         ttk.Label(dialog, text=info_text).pack(padx=10, pady=10, anchor=tk.W)
         
@@ -1621,6 +1724,17 @@ class PDFEditor:
             
             # Применяем изменения
             applied_types = []
+            # Копируемый контент собирается один раз (до добавления копий в общий список)
+            current_page_content = []
+            if apply_insert and has_inserted_content:
+                current_page_content = [c for c in self.inserted_content if c['page'] == self.current_page]
+            # Сколько изменений каждого типа добавляется на каждую выбранную страницу
+            deltas = {
+                'deletion_areas': summary['deletion_areas'] if apply_del else 0,
+                'color_changes': summary['color_changes'] if apply_col else 0,
+                'color_replacements': summary['color_replacements'] if apply_col_rep else 0,
+                'inserted_content': len(current_page_content),
+            }
             for page_num in selected_pages:
                 # Копируем области удаления
                 if apply_del and has_deletions:
@@ -1669,13 +1783,14 @@ class PDFEditor:
                 
                 # Копируем вставленный контент
                 if apply_insert and has_inserted_content:
-                    current_page_content = [c.copy() for c in self.inserted_content if c['page'] == self.current_page]
                     for content in current_page_content:
+                        content = content.copy()
                         content['page'] = page_num
                         self.inserted_content.append(content)
                     if current_page_content and "вставленный контент" not in applied_types:
                         applied_types.append("вставленный контент")
                 
+                self.page_changed(page_num, **deltas)
                 # Инвалидируем кэш для этой страницы
                 self.invalidate_preview_cache(page_num)
             
@@ -1712,10 +1827,9 @@ class PDFEditor:
             return
         
         # Проверяем, есть ли замены цвета на текущей странице
-        has_color_changes = (self.current_page < len(self.color_changes) and 
-                           len(self.color_changes[self.current_page]) > 0)
-        has_color_replacements = (self.current_page < len(self.color_replacements) and 
-                                 len(self.color_replacements[self.current_page]) > 0)
+        summary = self.edit_tracker.summary(self.current_page)
+        has_color_changes = summary['color_changes'] > 0
+        has_color_replacements = summary['color_replacements'] > 0
         
         if not has_color_changes and not has_color_replacements:
             messagebox.showinfo("Информация", "На текущей странице нет замен цвета для применения")
@@ -1725,8 +1839,8 @@ class PDFEditor:
         result = messagebox.askyesno(
             "Подтверждение",
             f"Применить замены цвета с текущей страницы ({self.current_page + 1}) ко всем {self.total_pages} страницам?\n\n"
-            f"Замены цвета (области): {len(self.color_changes[self.current_page]) if has_color_changes else 0}\n"
-            f"Замены цвета (вся страница): {len(self.color_replacements[self.current_page]) if has_color_replacements else 0}",
+            f"Замены цвета (области): {summary['color_changes']}\n"
+            f"Замены цвета (вся страница): {summary['color_replacements']}",
             icon='question'
         )
         
@@ -1761,6 +1875,8 @@ class PDFEditor:
                         self.color_replacements.append([])
                     self.color_replacements[page_num] = self.color_replacements[self.current_page].copy()
             
+            self.page_changed(page_num, color_changes=summary['color_changes'],
+                              color_replacements=summary['color_replacements'])
             # Инвалидируем кэш для этой страницы
             self.invalidate_preview_cache(page_num)
             applied_count += 1
@@ -1778,15 +1894,7 @@ class PDFEditor:
             return
         
         # Проверяем, есть ли что сохранять
-        has_changes = False
-        for page_num in range(len(self.deletion_areas)):
-            if (page_num < len(self.deletion_areas) and self.deletion_areas[page_num]) or \
-               (page_num < len(self.color_changes) and self.color_changes[page_num]) or \
-               (page_num < len(self.color_replacements) and self.color_replacements[page_num]):
-                has_changes = True
-                break
-        
-        if not has_changes and not self.inserted_content:
+        if not self.edit_tracker.edited:
             messagebox.showinfo("Информация", "Нет выделений для сохранения в шаблон")
             return
         
@@ -1847,13 +1955,8 @@ class PDFEditor:
                 current_pages = self.total_pages
                 
                 # Проверяем, есть ли существующие выделения
-                has_existing = False
-                for page_num in range(current_pages):
-                    if (page_num < len(self.deletion_areas) and self.deletion_areas[page_num]) or \
-                       (page_num < len(self.color_changes) and self.color_changes[page_num]) or \
-                       (page_num < len(self.color_replacements) and self.color_replacements[page_num]):
-                        has_existing = True
-                        break
+                totals = self.edit_tracker.totals()
+                has_existing = any(totals[key] for key in ('deletion_areas', 'color_changes', 'color_replacements'))
                 
                 # Диалог выбора способа применения
                 replace_mode = False
@@ -1983,6 +2086,9 @@ class PDFEditor:
                     self.target_color = template_data['target_color']
                     self.color_btn.config(bg=self.target_color)
                 
+                # Шаблон меняет списки изменений целиком - сводки пересчитываются
+                self.recount_edits()
+                
                 # Инвалидируем кэш для всех страниц
                 for page_num in range(current_pages):
                     self.invalidate_preview_cache(page_num)
@@ -2044,13 +2150,82 @@ class PDFEditor:
         """Переход к предыдущей странице"""
         if self.pdf_document and self.current_page > 0:
             self.current_page -= 1
-            self.update_page_display()
+            self.request_page_display()
     
     def next_page(self):
         """Переход к следующей странице"""
         if self.pdf_document and self.current_page < self.total_pages - 1:
             self.current_page += 1
+            self.request_page_display()
+    
+    def request_page_display(self):
+        """Отображение текущей страницы с рендерингом в фоновом потоке
+        
+        Если страница уже отрендерена (кэш или предзагрузка), она показывается
+        сразу. Иначе рендеринг уходит в пул, а запросы для пролистанных
+        страниц отменяются; в mainloop возвращается только последний результат.
+        """
+        self.render_generation += 1
+        generation = self.render_generation
+        page_num = self.current_page
+        zoom = self.zoom
+        self.page_label.config(text=f"Страница: {page_num + 1}/{self.total_pages}")
+        
+        if ((page_num, zoom) in self.prefetched_images or ('base', page_num, zoom) in self.image_cache or
+                should_tile(self.pdf_document[page_num], zoom)):
             self.update_page_display()
+            self.prefetch_neighbours()
+            return
+        
+        self.render_pool.cancel_except([(page_num, zoom)])
+        self.status_label.config(text=f"Загрузка страницы {page_num + 1}...")
+        
+        def on_done(rendered_page, rendered_zoom, img):
+            self.store_prefetched(rendered_page, rendered_zoom, img)
+            self.show_rendered_page(generation)
+        
+        self.render_pool.submit(page_num, zoom, on_done)
+    
+    def show_rendered_page(self, generation):
+        """Отображение страницы, отрендеренной в фоне (только последний запрос)"""
+        if generation != self.render_generation or self.pdf_document is None:
+            return
+        self.status_label.config(text="Готов к работе")
+        self.update_page_display()
+        self.prefetch_neighbours()
+    
+    def is_render_wanted(self, page_num, zoom):
+        """Нужна ли еще отрендеренная в фоне страница"""
+        return (zoom == self.zoom and
+                abs(page_num - self.current_page) <= PREFETCH_PAGES)
+    
+    def store_prefetched(self, page_num, zoom, img):
+        """Сохранение страницы, отрендеренной в фоне"""
+        if not self.is_render_wanted(page_num, zoom):
+            return
+        self.prefetched_images[(page_num, zoom)] = img
+        # Храним только соседей текущей страницы при текущем масштабе
+        for key in list(self.prefetched_images):
+            if not self.is_render_wanted(*key):
+                del self.prefetched_images[key]
+    
+    def prefetch_neighbours(self):
+        """Предзагрузка соседних страниц при текущем масштабе"""
+        if self.pdf_document is None:
+            return
+        wanted = []
+        for offset in range(1, PREFETCH_PAGES + 1):
+            for page_num in (self.current_page + offset, self.current_page - offset):
+                if not (0 <= page_num < self.total_pages) or ('base', page_num, self.zoom) in self.image_cache:
+                    continue
+                if should_tile(self.pdf_document[page_num], self.zoom):
+                    continue
+                wanted.append((page_num, self.zoom))
+        
+        self.render_pool.cancel_except(wanted)
+        wanted = [key for key in wanted if key not in self.prefetched_images]
+        for page_num, zoom in wanted:
+            self.render_pool.submit(page_num, zoom, self.store_prefetched)
     
     def zoom_in(self):
         """Увеличение масштаба"""
@@ -2058,9 +2233,9 @@ class PDFEditor:
             new_zoom = self.zoom * 1.2
             if new_zoom <= 5.0:  # Ограничение максимального масштаба
                 self.zoom = new_zoom
-                self.page_images[self.current_page] = None
                 self.invalidate_preview_cache(self.current_page)
                 self.update_page_display()
+                self.prefetch_neighbours()
     
     def zoom_out(self):
         """Уменьшение масштаба"""
@@ -2068,163 +2243,17 @@ class PDFEditor:
             new_zoom = self.zoom / 1.2
             if new_zoom >= 0.2:  # Ограничение минимального масштаба
                 self.zoom = new_zoom
-                self.page_images[self.current_page] = None
                 self.invalidate_preview_cache(self.current_page)
                 self.update_page_display()
+                self.prefetch_neighbours()
     
     def reset_zoom(self):
         """Сброс масштаба"""
         if self.pdf_document:
             self.zoom = 1.0
-            self.page_images[self.current_page] = None
             self.invalidate_preview_cache(self.current_page)
             self.update_page_display()
-    
-    def apply_changes_to_page(self, page_num):
-        """Применение изменений к странице PDF"""
-        if (not self.pdf_document or page_num < 0 or 
-            page_num >= self.total_pages or 
-            page_num >= len(self.deletion_areas)):
-            return None
-            
-        try:
-            page = self.pdf_document[page_num]
-            page_rect = page.rect
-            
-            # Создание нового документа для этой страницы
-            doc = fitz.open()
-            new_page = doc.new_page(width=page_rect.width, height=page_rect.height)
-            
-            # Проверяем, есть ли замены цвета на всю страницу или вставленный контент
-            has_full_page_color_replacements = (page_num < len(self.color_replacements) and 
-                                               self.color_replacements[page_num])
-            has_inserted_content = any(c['page'] == page_num for c in self.inserted_content)
-            
-            if has_full_page_color_replacements or has_inserted_content:
-                # Если есть замены цвета на всю страницу, используем изображение
-                # Получаем изображение страницы
-                pix = page.get_pixmap()
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                
-                # Применяем все изменения к изображению
-                img_with_changes = self.apply_changes_to_image(img, page_num, 1.0)
-                
-                # Конвертируем обратно в pixmap и вставляем в PDF
-                img_bytes = io.BytesIO()
-                img_with_changes.save(img_bytes, format='PNG')
-                img_bytes.seek(0)
-                
-                # Вставляем изображение на страницу
-                img_rect = fitz.Rect(0, 0, page_rect.width, page_rect.height)
-                new_page.insert_image(img_rect, stream=img_bytes.getvalue())
-            else:
-                # Вставка оригинальной страницы
-                new_page.show_pdf_page(new_page.rect, self.pdf_document, page_num)
-                
-                # Применение удалений (закрашивание белым)
-                for area in self.deletion_areas[page_num]:
-                    x1, y1, x2, y2 = area
-                    # Валидация координат
-                    x1 = max(0, min(x1, page_rect.width))
-                    y1 = max(0, min(y1, page_rect.height))
-                    x2 = max(0, min(x2, page_rect.width))
-                    y2 = max(0, min(y2, page_rect.height))
-                    
-                    if x1 < x2 and y1 < y2:
-                        rect = fitz.Rect(x1, y1, x2, y2)
-                        new_page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
-                
-                # Применение замены цвета в выделенных областях
-                if page_num < len(self.color_changes):
-                    for area, orig_color, new_color in self.color_changes[page_num]:
-                        x1, y1, x2, y2 = area
-                        # Валидация координат
-                        x1 = max(0, min(x1, page_rect.width))
-                        y1 = max(0, min(y1, page_rect.height))
-                        x2 = max(0, min(x2, page_rect.width))
-                        y2 = max(0, min(y2, page_rect.height))
-                        
-                        if x1 < x2 and y1 < y2:
-                            rect = fitz.Rect(x1, y1, x2, y2)
-                            
-                            # Конвертация hex цвета в RGB
-                            if new_color and new_color.startswith('#'):
-                                try:
-                                    r = int(new_color[1:3], 16) / 255.0
-                                    g = int(new_color[3:5], 16) / 255.0
-                                    b = int(new_color[5:7], 16) / 255.0
-                                    new_page.draw_rect(rect, color=(r, g, b), fill=(r, g, b))
-                                except (ValueError, IndexError):
-                                    # Если цвет некорректный, пропускаем
-                                    pass
-                
-                # Применение вставленного контента (только если нет замен цвета на всю страницу)
-                if not has_full_page_color_replacements:
-                    for content in self.inserted_content:
-                        if content['page'] == page_num:
-                            try:
-                                if content['type'] == 'text':
-                                    # Вставляем текст
-                                    text = content['data']['text']
-                                    font_size = content['data']['font_size']
-                                    color_hex = content['data']['color']
-                                    
-                                    # Конвертируем цвет
-                                    r = int(color_hex[1:3], 16) / 255.0
-                                    g = int(color_hex[3:5], 16) / 255.0
-                                    b = int(color_hex[5:7], 16) / 255.0
-                                    
-                                    # Вставляем текст
-                                    point = fitz.Point(content['x'], content['y'])
-                                    new_page.insert_text(
-                                        point,
-                                        text,
-                                        fontsize=font_size,
-                                        color=(r, g, b)
-                                    )
-                                
-                                elif content['type'] == 'image':
-                                    # Вставляем изображение
-                                    img_path = content['data']['path']
-                                    if Path(img_path).exists():
-                                        width = content['data']['width']
-                                        height = content['data']['height']
-                                        
-                                        # Открываем изображение
-                                        img = Image.open(img_path)
-                                        
-                                        # Изменяем размер, если нужно
-                                        if width > 0 or height > 0:
-                                            if width > 0 and height > 0:
-                                                img = img.resize((width, height), Image.Resampling.LANCZOS)
-                                            elif width > 0:
-                                                ratio = width / img.width
-                                                img = img.resize((width, int(img.height * ratio)), Image.Resampling.LANCZOS)
-                                            elif height > 0:
-                                                ratio = height / img.height
-                                                img = img.resize((int(img.width * ratio), height), Image.Resampling.LANCZOS)
-                                        
-                                        # Конвертируем в bytes
-                                        img_bytes = io.BytesIO()
-                                        img.save(img_bytes, format='PNG')
-                                        img_bytes.seek(0)
-                                        
-                                        # Вставляем изображение
-                                        rect = fitz.Rect(
-                                            content['x'],
-                                            content['y'],
-                                            content['x'] + img.width,
-                                            content['y'] + img.height
-                                        )
-                                        new_page.insert_image(rect, stream=img_bytes.getvalue())
-                            except Exception as e:
-                                # Если не удалось вставить контент, пропускаем
-                                pass
-            
-            return doc
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось применить изменения к странице {page_num + 1}: {str(e)}")
-            return None
+            self.prefetch_neighbours()
     
     def save_pdf(self):
         """Сохранение отредактированного PDF"""
@@ -2238,47 +2267,43 @@ class PDFEditor:
             filetypes=[("PDF files", "*.pdf"), ("All files", "*.*")]
         )
         
+        if save_path and same_file(self.pdf_document.name, save_path):
+            # Открытый документ читает этот файл - перезаписать его нельзя
+            messagebox.showwarning("Предупреждение",
+                                   "Нельзя сохранить изменения в открытый PDF файл.\n"
+                                   "Выберите другое имя файла.")
+            return
+        
         if save_path:
-            new_doc = None
             try:
-                # Создание нового PDF документа
-                new_doc = fitz.open()
+                # Изменения страниц; страницы без изменений копируются как есть
+                page_edits = [None] * self.total_pages
+                for page_num in self.edit_tracker.edited_pages():
+                    page_edits[page_num] = self.get_page_edits(page_num)
                 
-                # Обработка каждой страницы
-                for page_num in range(self.total_pages):
-                    temp_doc = None
-                    try:
-                        has_changes = (
-                            (page_num < len(self.deletion_areas) and len(self.deletion_areas[page_num]) > 0) or
-                            (page_num < len(self.color_changes) and len(self.color_changes[page_num]) > 0) or
-                            (page_num < len(self.color_replacements) and len(self.color_replacements[page_num]) > 0)
-                        )
-                        
-                        if not has_changes:
-                            # Если нет изменений, копируем оригинальную страницу
-                            new_doc.insert_pdf(self.pdf_document, from_page=page_num, to_page=page_num)
-                        else:
-                            # Применяем изменения к странице
-                            temp_doc = self.apply_changes_to_page(page_num)
-                            if temp_doc:
-                                new_doc.insert_pdf(temp_doc)
-                    finally:
-                        if temp_doc is not None:
-                            temp_doc.close()
+                # Страницы с изменениями обрабатываются параллельно в нескольких процессах
+                # (или дописываются в копию файла в инкрементальном режиме)
+                report = save_document(
+                    self.pdf_document, self.pdf_document.name, save_path, page_edits,
+                    mode=self.export_mode, workers=self.export_workers, profile=self.export_profile,
+                    on_error=lambda page_num, e: messagebox.showerror(
+                        "Ошибка", f"Не удалось применить изменения к странице {page_num + 1}: {str(e)}")
+                )
                 
-                # Сохранение нового документа
-                new_doc.save(save_path)
-                self.status_label.config(text=f"Сохранено: {Path(save_path).name}")
-                messagebox.showinfo("Успех", f"PDF успешно сохранен как:\n{save_path}")
+                self.last_export_report = report
+                self.status_label.config(
+                    text=f"Сохранено: {Path(save_path).name} ({report['seconds']:.1f} с)")
+                messagebox.showinfo("Успех", f"PDF успешно сохранен как:\n{save_path}\n\n{format_report(report)}")
                 
             except Exception as e:
                 messagebox.showerror("Ошибка", f"Не удалось сохранить PDF: {str(e)}")
-            finally:
-                if new_doc is not None:
-                    new_doc.close()
 
 
 def main():
+    # Нужно для пула процессов сохранения в собранном приложении (PyInstaller)
+    multiprocessing.freeze_support()
+    # Сообщения модулей (например, о шрифтах) в консоль
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
     root = tk.Tk()
     app = PDFEditor(root)
     root.mainloop()
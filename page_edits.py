@@ -0,0 +1,587 @@
+"""
+Применение изменений одной страницы: к изображению (предпросмотр) и к PDF (сохранение)
+
+Изменения страницы передаются словарем (см. collect_page_edits), поэтому
+функции не зависят от интерфейса и могут выполняться в других процессах.
+"""
+from functools import lru_cache
+
+import fitz  # PyMuPDF
+import numpy as np
+from PIL import ImageDraw
+
+from color_engine import apply_color_replacements, compile_replacements, map_color, parse_hex_color
+from export_profiles import get_profile, insert_page_image, render_zoom
+from font_registry import font_registry
+from inserted_images import inserted_images
+from pixmap_utils import render_page_image
+from vector_recolor import from_byte, recolor_page_vectors
+
+# Цвет бумаги: фон страницы, который при растеризации тоже попадает под замену
+PAPER_COLOR = (255, 255, 255)
+# Имена ресурсов шрифтов вставленного текста: шрифт из файла и стандартный Helvetica
+OVERLAY_FONT_NAMES = {'F-default': 'F-overlay', 'helv': 'F-helv'}
+# Стандартный Helvetica без встраивания (как его создает insert_font('helv'))
+HELVETICA_FONT_OBJECT = "<</Type/Font/Subtype/Type1/BaseFont/Helvetica/Encoding/WinAnsiEncoding>>"
+# Сколько областей удаления применяется за раз: учет аннотаций в PyMuPDF
+# растет квадратично, поэтому тысячи областей обрабатываются пачками
+REDACTION_BATCH = 100
+
+
+def collect_page_edits(page_num, deletion_areas, color_changes, color_replacements,
+                       inserted_content, tolerance=30, redact=False):
+    """Изменения одной страницы из списков изменений всего документа
+
+    redact - удалять содержимое под областями удаления при сохранении
+    (а не только закрашивать его белым).
+    """
+    return {
+        'deletion_areas': list(deletion_areas[page_num]) if page_num < len(deletion_areas) else [],
+        'color_changes': list(color_changes[page_num]) if page_num < len(color_changes) else [],
+        'color_replacements': (list(color_replacements[page_num])
+                               if page_num < len(color_replacements) else []),
+        'inserted_content': [c for c in inserted_content if c['page'] == page_num],
+        'tolerance': tolerance,
+        'redact': redact,
+    }
+
+
+def has_edits(edits):
+    """Есть ли на странице изменения"""
+    return any(edits[key] for key in (
+        'deletion_areas', 'color_changes', 'color_replacements', 'inserted_content'))
+
+
+@lru_cache(maxsize=None)
+def pdf_font(fontname, fontfile):
+    """Шрифт MuPDF для проверки символов и метрик (загружается один раз)"""
+    return fitz.Font(fontname=fontname, fontfile=fontfile)
+
+
+def text_font(text):
+    """Шрифт для вставки текста в PDF: (имя, файл) или None, если текст можно только растеризовать"""
+    path = font_registry.font_path()
+    if path:
+        # Тот же файл, что и в предпросмотре; встраивается один раз на документ
+        font = pdf_font('F-default', path)
+        if all(font.has_glyph(ord(ch)) for ch in text if not ch.isspace()):
+            return 'F-default', path
+    try:
+        text.encode('cp1252')
+    except UnicodeEncodeError:
+        # Стандартный Helvetica без встраивания кодирует только WinAnsi
+        return None
+    return 'helv', None
+
+
+def is_raster_content(content):
+    """Вставляется ли контент только через растеризацию страницы"""
+    return content['type'] == 'text' and text_font(content['data']['text']) is None
+
+
+def content_overlays(edits):
+    """Вставленный контент, который добавляется в PDF поверх страницы, а не растеризуется"""
+    return [c for c in edits['inserted_content'] if not is_raster_content(c)]
+
+
+def raster_only_edits(edits):
+    """Изменения страницы без контента, вставляемого поверх (см. content_overlays)"""
+    return dict(edits, inserted_content=[c for c in edits['inserted_content'] if is_raster_content(c)])
+
+
+def font_resources(page):
+    """(xref объекта, путь к словарю шрифтов) ресурсов страницы, в том числе унаследованных"""
+    doc = page.parent
+    xref = page.xref
+    while True:
+        kind, value = doc.xref_get_key(xref, 'Resources')
+        if kind == 'xref':
+            return int(value.split()[0]), 'Font'
+        if kind == 'dict':
+            return xref, 'Resources/Font'
+        kind, value = doc.xref_get_key(xref, 'Parent')
+        if kind != 'xref':
+            return page.xref, 'Resources/Font'
+        xref = int(value.split()[0])
+
+
+def add_overlay_font(page, fontname, fontfile):
+    """Добавление шрифта вставленного текста на страницу под свободным именем ресурса
+
+    Шрифт с тем же именем может уже быть на странице - в ее ресурсах или
+    в форме, вставленной show_pdf_page (/helv в PDF, созданных PyMuPDF,
+    подмножество F-overlay в ранее сохраненном файле). insert_font тогда не
+    добавляет шрифт в ресурсы страницы, и текст выводится чужим шрифтом,
+    поэтому берется имя, которого на странице нет. Возвращает имя ресурса.
+    """
+    used = {font[4] for font in page.get_fonts()}
+    base = OVERLAY_FONT_NAMES[fontname]
+    name, suffix = base, 1
+    while name in used:
+        name, suffix = f"{base}{suffix}", suffix + 1
+    if fontfile:
+        page.insert_font(fontname=name, fontfile=fontfile)
+    else:
+        # Стандартные шрифты insert_font добавляет только под своими именами (helv)
+        doc = page.parent
+        font_xref = doc.get_new_xref()
+        doc.update_object(font_xref, HELVETICA_FONT_OBJECT)
+        xref, path = font_resources(page)
+        doc.xref_set_key(xref, f"{path}/{name}", f"{font_xref} 0 R")
+    return name
+
+
+def insert_text_overlay(page, content, fonts):
+    """Вставка текста векторным шрифтом; (x, y) - левый верхний угол, как в предпросмотре
+
+    fonts - имена ресурсов шрифтов, уже добавленных на страницу (add_overlay_font).
+    """
+    text = content['data']['text']
+    font_size = content['data']['font_size']
+    r, g, b = parse_hex_color(content['data']['color'])
+    fontname, fontfile = text_font(text)
+    if fontname not in fonts:
+        fonts[fontname] = add_overlay_font(page, fontname, fontfile)
+    # В PDF задается базовая линия, а не верх строки
+    point = fitz.Point(content['x'], content['y'] + pdf_font(fontname, fontfile).ascender * font_size)
+    page.insert_text(point, text, fontsize=font_size, fontname=fonts[fontname],
+                     color=(r / 255.0, g / 255.0, b / 255.0))
+
+
+def insert_content_overlays(page, edits, embedded):
+    """Вставка текста и изображений страницы поверх содержимого в порядке добавления
+
+    embedded - EmbeddedImages документа страницы: одинаковые изображения
+    на разных страницах ссылаются на один объект PDF. Возвращает True,
+    если на страницу вставлен текст (его шрифт стоит сократить subset_fonts).
+    """
+    has_text = False
+    fonts = {}
+    for content in content_overlays(edits):
+        try:
+            if content['type'] == 'text':
+                insert_text_overlay(page, content, fonts)
+                has_text = True
+            elif content['type'] == 'image':
+                embedded.embed(page, content['data']['path'], content['x'], content['y'],
+                               content['data']['width'], content['data']['height'])
+        except Exception:
+            # Если не удалось вставить контент, просто пропускаем
+            pass
+    return has_text
+
+
+def is_overlay_only(edits):
+    """Применяются ли все изменения страницы наложением поверх ее содержимого"""
+    return not edits['color_replacements'] and not raster_only_edits(edits)['inserted_content']
+
+
+def scale_area(area, zoom, offset, width, height):
+    """Область страницы в пикселях изображения, ограниченная его размерами"""
+    x1, y1, x2, y2 = area
+    # Масштабируем координаты
+    x1_scaled = int(x1 * zoom) - offset[0]
+    y1_scaled = int(y1 * zoom) - offset[1]
+    x2_scaled = int(x2 * zoom) - offset[0]
+    y2_scaled = int(y2 * zoom) - offset[1]
+
+    # Ограничиваем координаты размерами изображения
+    return (
+        max(0, min(x1_scaled, width)),
+        max(0, min(y1_scaled, height)),
+        max(0, min(x2_scaled, width)),
+        max(0, min(y2_scaled, height)),
+    )
+
+
+def clip_area(area, page_rect):
+    """Область в координатах PDF, ограниченная страницей, или None, если она пуста"""
+    x1, y1, x2, y2 = area
+    # Валидация координат
+    x1 = max(0, min(x1, page_rect.width))
+    y1 = max(0, min(y1, page_rect.height))
+    x2 = max(0, min(x2, page_rect.width))
+    y2 = max(0, min(y2, page_rect.height))
+    if x1 < x2 and y1 < y2:
+        return fitz.Rect(x1, y1, x2, y2)
+    return None
+
+
+def apply_edits_to_image(img, edits, zoom=1.0, offset=(0, 0)):
+    """Применение изменений страницы к изображению
+
+    offset - положение изображения в пикселях страницы (для тайлов).
+    Возвращает новое изображение; исходное не изменяется.
+    """
+    # Создаем копию изображения для редактирования
+    img_copy = img.copy()
+    draw = ImageDraw.Draw(img_copy)
+
+    # Применение удалений (закрашивание белым)
+    for area in edits['deletion_areas']:
+        x1, y1, x2, y2 = scale_area(area, zoom, offset, img.width, img.height)
+        if x1 < x2 and y1 < y2:
+            draw.rectangle([x1, y1, x2, y2], fill=(255, 255, 255), outline=None)
+
+    # Применение замены цвета в областях
+    for area, orig_color, new_color in edits['color_changes']:
+        x1, y1, x2, y2 = scale_area(area, zoom, offset, img.width, img.height)
+        if x1 < x2 and y1 < y2 and new_color and new_color.startswith('#'):
+            try:
+                draw.rectangle([x1, y1, x2, y2], fill=parse_hex_color(new_color), outline=None)
+            except (ValueError, IndexError):
+                pass
+
+    # Применение замены цвета на всей странице (пипетка)
+    if edits['color_replacements']:
+        img_copy = apply_color_replacements(img_copy, edits['color_replacements'],
+                                            edits['tolerance'])
+        draw = ImageDraw.Draw(img_copy)
+
+    # Применение вставленного контента
+    for content in edits['inserted_content']:
+        x = int(content['x'] * zoom) - offset[0]
+        y = int(content['y'] * zoom) - offset[1]
+
+        if content['type'] == 'text':
+            try:
+                # Размер шрифта задан в пунктах PDF - масштабируем вместе со страницей
+                font_size = content['data']['font_size']
+                if zoom != 1.0:
+                    font_size = max(1, round(font_size * zoom))
+                # Шрифт берем из реестра (файлы ищутся один раз при запуске)
+                font = font_registry.get_font(font_size)
+                draw.text((x, y), content['data']['text'],
+                          fill=parse_hex_color(content['data']['color']), font=font)
+            except Exception:
+                # Если не удалось вставить текст, просто пропускаем
+                pass
+
+        elif content['type'] == 'image':
+            try:
+                # Декодированное изображение нужного размера (кэшируется)
+                insert_img = inserted_images.get(content['data']['path'],
+                                                 content['data']['width'],
+                                                 content['data']['height'],
+                                                 zoom)
+                if insert_img is not None:
+                    img_copy.paste(insert_img, (x, y), insert_img if insert_img.mode == 'RGBA' else None)
+            except Exception:
+                # Если не удалось вставить изображение, просто пропускаем
+                pass
+
+    return img_copy
+
+
+def merge_areas(rects):
+    """Сокращение списка областей без изменения покрываемой ими площади
+
+    Области с общими границами по одной оси, которые пересекаются или
+    соприкасаются по другой, склеиваются; вложенные области отбрасываются.
+    """
+    rects = [tuple(rect) for rect in rects]
+    count = None
+    while count != len(rects):
+        count = len(rects)
+        for axis in (0, 1):
+            # axis 0: столбцы с одинаковыми x0, x1; axis 1: строки с одинаковыми y0, y1
+            other = 1 - axis
+            rects.sort(key=lambda r: (r[axis], r[axis + 2], r[other]))
+            merged = []
+            for rect in rects:
+                last = merged[-1] if merged else None
+                if (last is not None and last[axis] == rect[axis] and last[axis + 2] == rect[axis + 2]
+                        and rect[other] <= last[other + 2]):
+                    end = max(last[other + 2], rect[other + 2])
+                    merged[-1] = last[:other + 2] + (end,) + last[other + 3:]
+                else:
+                    merged.append(rect)
+            rects = merged
+
+    # Вложенные области: сначала крупные
+    rects.sort(key=lambda r: (r[2] - r[0]) * (r[3] - r[1]), reverse=True)
+    kept = []
+    for rect in rects:
+        if not any(k[0] <= rect[0] and k[1] <= rect[1] and rect[2] <= k[2] and rect[3] <= k[3]
+                   for k in kept):
+            kept.append(rect)
+    return [fitz.Rect(rect) for rect in kept]
+
+
+def overlapping(boxes, rects, centers=False):
+    """Какие из boxes пересекаются с какой-либо из rects (centers - проверяются только центры)
+
+    boxes и rects - массивы numpy (n, 4); сравнения выполняются частями,
+    чтобы тысячи областей не требовали огромных промежуточных массивов.
+    """
+    result = np.zeros(len(boxes), dtype=bool)
+    if not len(boxes) or not len(rects):
+        return result
+    if centers:
+        x = (boxes[:, 0] + boxes[:, 2]) / 2
+        y = (boxes[:, 1] + boxes[:, 3]) / 2
+        boxes = np.stack([x, y, x, y], axis=1)
+    step = max(1, 1000000 // len(rects))
+    for start in range(0, len(boxes), step):
+        b = boxes[start:start + step, None, :]
+        inside = ((b[..., 0] <= rects[:, 2]) & (b[..., 2] >= rects[:, 0]) &
+                  (b[..., 1] <= rects[:, 3]) & (b[..., 3] >= rects[:, 1]))
+        result[start:start + step] = inside.any(axis=1)
+    return result
+
+
+def area_images(page, rects):
+    """xref изображений страницы (в том числе внутри форм), задевающих области"""
+    infos = [info for info in page.get_image_info(xrefs=True) if info['xref']]
+    boxes = np.array([info['bbox'] for info in infos], dtype=float).reshape(-1, 4)
+    hits = overlapping(boxes, rects)
+    return [info['xref'] for info, hit in zip(infos, hits) if hit]
+
+
+def remaining_content(page, rects, images_before):
+    """Сколько символов и изображений осталось под областями после apply_redactions
+
+    Символ остался, если центр его рамки внутри области (MuPDF проверяет
+    контур глифа, поэтому касание рамкой - не остаток). Изображение
+    осталось, если на его месте тот же объект, что был до удаления,
+    а не закрашенная копия.
+    """
+    chars = [char['bbox'] for block in page.get_text('rawdict')['blocks'] if block['type'] == 0
+             for line in block['lines'] for span in line['spans'] for char in span['chars']
+             if not char['c'].isspace()]
+    boxes = np.array(chars, dtype=float).reshape(-1, 4)
+    count = int(overlapping(boxes, rects, centers=True).sum())
+    return count + len(set(area_images(page, rects)) & set(images_before))
+
+
+def redact_areas(page, rects):
+    """Удаление содержимого страницы под областями: одно применение на REDACTION_BATCH областей
+
+    Текст под областями удаляется, пиксели изображений закрашиваются,
+    полностью закрытая графика удаляется; области заливаются белым.
+    Общие с другими страницами формы и изображения MuPDF не изменяет,
+    а заменяет копиями. Возвращает, сколько символов и изображений под
+    областями удалить не удалось (remaining_content); частично закрытая
+    графика остается по правилам MuPDF и не считается.
+    """
+    rects = merge_areas(rects)
+    area_rects = np.array([tuple(rect) for rect in rects], dtype=float).reshape(-1, 4)
+    images_before = area_images(page, area_rects)
+    for start in range(0, len(rects), REDACTION_BATCH):
+        for rect in rects[start:start + REDACTION_BATCH]:
+            page.add_redact_annot(rect, fill=(1, 1, 1))
+        page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_PIXELS,
+                              graphics=fitz.PDF_REDACT_LINE_ART_REMOVE_IF_COVERED)
+    return remaining_content(page, area_rects, images_before)
+
+
+def draw_area_edits(page, page_rect, edits):
+    """Удаления и замены цвета в областях поверх векторного содержимого страницы
+
+    Возвращает, сколько символов и изображений осталось под областями
+    удаления, если их содержимое удаляется (redact), см. redact_areas.
+    """
+    unredacted = 0
+    deletions = [rect for rect in (clip_area(area, page_rect) for area in edits['deletion_areas'])
+                 if rect is not None]
+    if deletions and edits.get('redact'):
+        # Содержимое под областями удаляется из файла
+        unredacted = redact_areas(page, deletions)
+    elif deletions:
+        # Закрашивание белым: все области одной фигурой
+        shape = page.new_shape()
+        for rect in deletions:
+            shape.draw_rect(rect)
+        shape.finish(color=(1, 1, 1), fill=(1, 1, 1))
+        shape.commit()
+
+    # Применение замены цвета в выделенных областях
+    shape = None
+    for area, orig_color, new_color in edits['color_changes']:
+        rect = clip_area(area, page_rect)
+        if rect is not None and new_color and new_color.startswith('#'):
+            try:
+                r, g, b = parse_hex_color(new_color)
+            except (ValueError, IndexError):
+                # Если цвет некорректный, пропускаем
+                continue
+            if shape is None:
+                shape = page.new_shape()
+            shape.draw_rect(rect)
+            shape.finish(color=(r / 255.0, g / 255.0, b / 255.0), fill=(r / 255.0, g / 255.0, b / 255.0))
+    if shape is not None:
+        shape.commit()
+    return unredacted
+
+
+class RecoloredPages:
+    """Страницы source_doc, перекрашенные без растеризации, для вставки в другие документы
+
+    Страницы с одинаковыми заменами копируются в общий промежуточный
+    документ и перекрашиваются там: общие изображения и формы переносятся
+    и перекрашиваются один раз, а show_pdf_page из промежуточного
+    документа оставляет их общими и в итоговом документе. Поэтому все
+    страницы стоит подготовить (prepare) до первой вставки (add): после
+    вставки промежуточный документ не дополняется, следующие страницы
+    с теми же заменами попадают в новый.
+    """
+
+    def __init__(self, source_doc):
+        self.source_doc = source_doc
+        self.docs = {}  # rules -> {'doc', 'recolored': перекрашенные xref, 'shown': были ли вставки}
+        # (номер страницы, rules) -> (промежуточный документ, номер страницы, остатки под
+        # областями удаления - см. draw_area_edits) или None
+        self.pages = {}
+        self.all_docs = []
+
+    def prepare(self, page_num, edits):
+        """Перекрашивание страницы в промежуточном документе; False - только растеризацией
+
+        Ошибка перекрашивания тоже означает растеризацию: результат
+        запоминается, и add страницу больше не перекрашивает.
+        """
+        rules = compile_replacements(edits['color_replacements'], edits['tolerance'])
+        key = (page_num, rules)
+        if key not in self.pages:
+            try:
+                self.pages[key] = self.recolor(page_num, edits, rules)
+            except Exception:
+                self.pages[key] = None
+        return self.pages[key] is not None
+
+    def recolor(self, page_num, edits, rules):
+        """(промежуточный документ, номер перекрашенной страницы, остатки) или None, если не удалось"""
+        target = self.docs.get(rules)
+        if target is None or target['shown']:
+            # Сопоставление объектов show_pdf_page не учитывает объекты, добавленные позже
+            target = self.docs[rules] = {'doc': fitz.open(), 'recolored': set(), 'shown': False}
+            self.all_docs.append(target['doc'])
+        doc = target['doc']
+        doc.insert_pdf(self.source_doc, from_page=page_num, to_page=page_num,
+                       links=False, annots=False, widgets=False, final=0)
+        page = doc[-1]
+        try:
+            # Области рисуются до замены цвета, как и при растеризации
+            unredacted = draw_area_edits(page, self.source_doc[page_num].rect, edits)
+            recolored = recolor_page_vectors(doc, page, rules, target['recolored'])
+        except Exception:
+            doc.delete_page(page.number)
+            raise
+        if not recolored:
+            doc.delete_page(page.number)
+            return None
+        return doc, page.number, unredacted
+
+    def add(self, doc, page_num, edits):
+        """Перекрашенная страница в конце doc
+
+        Возвращает число остатков под областями удаления (см. draw_area_edits)
+        или None (страница не добавляется), если перекрасить можно только растеризацией.
+        """
+        if not self.prepare(page_num, edits):
+            return None
+        rules = compile_replacements(edits['color_replacements'], edits['tolerance'])
+        source, number, unredacted = self.pages[(page_num, rules)]
+        for target in self.docs.values():
+            if target['doc'] is source:
+                target['shown'] = True
+        page_rect = self.source_doc[page_num].rect
+        new_page = doc.new_page(width=page_rect.width, height=page_rect.height)
+        new_page.show_pdf_page(new_page.rect, source, number)
+
+        # Фон страницы тоже мог попасть под замену
+        paper = map_color(PAPER_COLOR, rules)
+        if paper != PAPER_COLOR:
+            fill = tuple(from_byte(channel) for channel in paper)
+            new_page.draw_rect(new_page.rect, color=None, fill=fill, overlay=False)
+        return unredacted
+
+    def close(self):
+        """Закрытие промежуточных документов"""
+        for doc in self.all_docs:
+            doc.close()
+        self.all_docs.clear()
+        self.docs.clear()
+        self.pages.clear()
+
+
+def is_recolor_candidate(edits):
+    """Можно ли попробовать заменить цвет на странице без растеризации"""
+    return bool(edits['color_replacements']) and not raster_only_edits(edits)['inserted_content']
+
+
+def add_recolored_page(doc, source_doc, page_num, edits, recolored=None):
+    """Страница с заменой цвета на всю страницу без растеризации в конце doc
+
+    Операторы цвета переписываются в потоках содержимого (vector_recolor).
+    recolored - RecoloredPages документа source_doc, общий для страниц
+    одного сохранения. Возвращает None (страница не добавляется), если
+    страницу можно перекрасить только растеризацией, иначе число остатков
+    под областями удаления (см. draw_area_edits).
+    """
+    if recolored is not None:
+        return recolored.add(doc, page_num, edits)
+    recolored = RecoloredPages(source_doc)
+    try:
+        return recolored.add(doc, page_num, edits)
+    finally:
+        recolored.close()
+
+
+def add_edited_page(doc, source_doc, page_num, edits, profile=None, recolored=None, recolor=True):
+    """Страница source_doc с примененными изменениями в конце doc
+
+    Растеризуются (с разрешением и сжатием профиля export_profiles) только
+    страницы с заменой цвета на всю страницу, которую нельзя выполнить
+    в потоках содержимого, и с текстом, для которого нет векторного шрифта;
+    остальные остаются векторными. Вставленный контент, кроме растеризуемого,
+    на страницу не попадает - его добавляет insert_content_overlays.
+    recolored - RecoloredPages для source_doc (см. add_recolored_page);
+    recolor=False - страница растеризуется без попытки перекрасить ее
+    (попытка уже не удалась). Возвращает статистику страницы: {'mode': способ, 'unredacted': число
+    символов и изображений, оставшихся под областями удаления при redact}.
+    Способ - 'vector', 'recolored' или 'raster-<сжатие>'; растеризованная
+    страница содержит только изображение с закрашенными областями.
+    """
+    raster_edits = raster_only_edits(edits)
+    if recolor and is_recolor_candidate(edits):
+        unredacted = add_recolored_page(doc, source_doc, page_num, edits, recolored)
+        if unredacted is not None:
+            return {'mode': 'recolored', 'unredacted': unredacted}
+
+    page = source_doc[page_num]
+    page_rect = page.rect
+
+    new_page = doc.new_page(width=page_rect.width, height=page_rect.height)
+
+    if not is_overlay_only(edits):
+        # Применяем все изменения к изображению страницы в разрешении профиля
+        profile = get_profile(profile)
+        zoom = render_zoom(profile)
+        img = apply_edits_to_image(render_page_image(page, zoom), raster_edits, zoom)
+
+        img_rect = fitz.Rect(0, 0, page_rect.width, page_rect.height)
+        return {'mode': 'raster-' + insert_page_image(new_page, img_rect, img, profile), 'unredacted': 0}
+
+    # Вставка оригинальной страницы
+    new_page.show_pdf_page(new_page.rect, source_doc, page_num)
+    return {'mode': 'vector', 'unredacted': draw_area_edits(new_page, page_rect, edits)}
+
+
+def build_edited_page(source_doc, page_num, edits, profile=None, recolor=True):
+    """Новый документ из одной страницы source_doc с примененными изменениями
+
+    Возвращает (документ, статистика страницы), см. add_edited_page.
+    """
+    doc = fitz.open()
+    try:
+        return doc, add_edited_page(doc, source_doc, page_num, edits, profile, recolor=recolor)
+    except Exception:
+        doc.close()
+        raise
+
+
+def apply_overlays(page, edits, embedded):
+    """Изменения поверх содержимого существующей страницы (для is_overlay_only)"""
+    draw_area_edits(page, page.rect, edits)
+    insert_content_overlays(page, edits, embedded)
@@ -0,0 +1,47 @@
+"""
+Общий слой преобразования пиксмапов PyMuPDF в изображения PIL и обратно
+"""
+import fitz  # PyMuPDF
+from PIL import Image
+
+# Режим PIL по числу компонент пиксмапа
+PIXMAP_MODES = {
+    (1, False): "L",
+    (3, False): "RGB",
+    (4, True): "RGBA",
+}
+
+
+def pixmap_to_image(pix):
+    """Изображение PIL поверх памяти пиксмапа (pix.samples_mv) без PPM/PNG
+
+    Для режимов, которые Pillow умеет отображать напрямую (L, RGBA),
+    изображение использует память пиксмапа без копирования. RGB Pillow
+    хранит по 4 байта на пиксель, поэтому здесь остается одна распаковка,
+    но без кодирования и разбора промежуточного формата.
+    """
+    mode = PIXMAP_MODES.get((pix.n, bool(pix.alpha)))
+    if mode is None:
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+        mode = PIXMAP_MODES[(pix.n, bool(pix.alpha))]
+    img = Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv,
+                           "raw", mode, pix.stride, 1)
+    if img.readonly:
+        # Изображение ссылается на память пиксмапа - он должен жить столько же
+        img.pixmap = pix
+    return img
+
+
+def render_page_image(page, zoom=1.0, clip=None):
+    """Рендеринг страницы (или ее части) в RGB изображение PIL"""
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+    return pixmap_to_image(pix)
+
+
+def image_to_pixmap(img):
+    """Пиксмап из изображения PIL для вставки в PDF без кодирования в PNG"""
+    if img.mode == "RGBA":
+        return fitz.Pixmap(fitz.csRGB, img.width, img.height, img.tobytes(), True)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return fitz.Pixmap(fitz.csRGB, img.width, img.height, img.tobytes(), False)
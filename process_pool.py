@@ -0,0 +1,109 @@
+"""
+Пулы процессов: запуск через spawn, документы, которые процессы открывают сами,
+и остановка пула перед удалением открытых им файлов
+"""
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+
+
+def spawn_pool(max_workers):
+    """Пул процессов, запускаемых через spawn
+
+    fork многопоточного процесса (сервер, окно с фоновыми потоками) может
+    зависнуть на унаследованной блокировке. Документы основного процесса
+    процессам не передаются - они открывают файлы сами (WorkerDocuments).
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+class WorkerDocuments:
+    """Документы, открытые процессом пула (у каждого процесса свои)
+
+    Ключ - кортеж из пути к файлу и его версии (время изменения, хэш
+    содержимого): перезаписанный файл открывается заново. Давно не
+    использованные документы сверх limit закрываются.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.documents = OrderedDict()  # ключ -> fitz.Document, от давно использованных к свежим
+
+    def get(self, key):
+        """Документ по ключу (путь, версия...); открывается при первом обращении"""
+        doc = self.documents.get(key)
+        if doc is None:
+            doc = self.documents[key] = fitz.open(key[0])
+            while len(self.documents) > self.limit:
+                _, evicted = self.documents.popitem(last=False)
+                evicted.close()
+        else:
+            self.documents.move_to_end(key)
+        return doc
+
+
+class SpawnPool:
+    """Пул процессов spawn, общий для потоков; создается при первой задаче
+
+    Помнит файлы, которые могли открыть его процессы (WorkerDocuments
+    держит их открытыми): пока они открыты, на Windows файл нельзя удалить,
+    а на Linux место на диске не освобождается. Поэтому перед удалением
+    файлов пул, открывавший их, останавливается (release).
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.workers = 0
+        self.paths = set()  # Файлы, которые могли открыть процессы текущего пула
+        self.restarts = 0
+        self.lock = threading.Lock()
+
+    def submit(self, workers, file_path, calls):
+        """Задачи [(функция, аргументы), ...] с файлом file_path в пуле из workers процессов
+
+        Возвращает (пул, [Future, ...]); пул нужен для reset при сбое. Задачи
+        ставятся под той же блокировкой, под которой release останавливает
+        пул, поэтому не попадают в остановленный пул.
+        """
+        with self.lock:
+            if self.executor is None or self.workers != workers:
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                self.executor = spawn_pool(workers)
+                self.workers = workers
+                self.paths = set()
+            self.paths.add(str(file_path))
+            return self.executor, [self.executor.submit(fn, *args) for fn, args in calls]
+
+    def reset(self, executor):
+        """Замена неисправного пула новым (при следующей задаче)"""
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+                self.restarts += 1
+        executor.shutdown(wait=False)
+
+    def release(self, paths):
+        """Остановка пула, процессы которого могли открыть файлы paths (перед их удалением)
+
+        Ждет завершения начатых задач и выхода процессов, которые при этом
+        закрывают файлы. Следующая задача запускает новый пул. Возвращает,
+        был ли пул остановлен.
+        """
+        paths = {str(path) for path in paths}
+        with self.lock:
+            if self.executor is None or not self.paths & paths:
+                return False
+            executor, self.executor = self.executor, None
+        executor.shutdown(wait=True)
+        return True
+
+    def shutdown(self):
+        """Остановка пула без ожидания задач"""
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,100 @@
+"""
+Рендеринг страниц веб-версии в ограниченном пуле исполнителей с собственными документами
+"""
+import io
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+from page_edits import apply_edits_to_image
+from pixmap_utils import render_page_image
+from process_pool import SpawnPool, WorkerDocuments
+
+# Форматы изображения страницы: имя -> (формат Pillow, MIME-тип)
+PAGE_IMAGE_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+}
+WEBP_QUALITY = 90
+# Сколько документов держит открытыми один исполнитель
+WORKER_OPEN_DOCUMENTS = 4
+# Сколько запросов на исполнителя может ожидать в очереди пула
+QUEUE_PER_WORKER = 2
+
+
+def default_render_workers():
+    """Число процессов рендеринга: PDF_EDITOR_RENDER_WORKERS или число ядер"""
+    try:
+        return max(1, int(os.environ['PDF_EDITOR_RENDER_WORKERS']))
+    except (KeyError, ValueError):
+        return max(1, os.cpu_count() or 1)
+
+
+DEFAULT_RENDER_WORKERS = default_render_workers()
+
+# Документы, открытые исполнителем, по (путь, хэш содержимого): повторная
+# загрузка файла с тем же именем не оставит исполнителю устаревший документ
+_worker_documents = WorkerDocuments(WORKER_OPEN_DOCUMENTS)
+
+
+def encode_page_image(img, image_format):
+    """Кодирование изображения страницы в байты выбранного формата"""
+    img_bytes = io.BytesIO()
+    if image_format == 'webp':
+        img.save(img_bytes, format=PAGE_IMAGE_FORMATS[image_format][0], quality=WEBP_QUALITY)
+    else:
+        img.save(img_bytes, format=PAGE_IMAGE_FORMATS[image_format][0])
+    return img_bytes.getvalue()
+
+
+def render_page_bytes(file_path, doc_hash, page_num, zoom, edits, image_format):
+    """Рендеринг страницы в исполнителе: закодированное изображение с изменениями edits (или без)"""
+    img = render_page_image(_worker_documents.get((file_path, doc_hash))[page_num], zoom)
+    if edits is not None:
+        img = apply_edits_to_image(img, edits, zoom)
+    return encode_page_image(img, image_format)
+
+
+class RenderPool(SpawnPool):
+    """Ограниченный пул рендеринга страниц
+
+    Страницы рендерятся в процессах (при workers == 1 - в одном): MuPDF не
+    отпускает GIL, поэтому страницы разных сессий рендерятся параллельно
+    только в разных процессах, а PyMuPDF не рассчитан на одновременную работу
+    из нескольких потоков одного процесса (поток рендеринга пересекался бы
+    с запросами, которые работают с документами сессий). Исполнители сами
+    открывают документы по пути к файлу; перед удалением файлов сессии пул
+    останавливается (release). Ожидающих запросов не больше
+    workers * QUEUE_PER_WORKER: остальные ждут места, а не копят очередь в пуле.
+    """
+
+    def __init__(self, workers=None):
+        super().__init__()
+        self.max_workers = workers or DEFAULT_RENDER_WORKERS
+        self.slots = threading.BoundedSemaphore(self.max_workers * QUEUE_PER_WORKER)
+        self.rendered = 0
+
+    def render(self, file_path, doc_hash, page_num, zoom, edits, image_format):
+        """Закодированное изображение страницы (вызывающий поток ждет результата)"""
+        with self.slots:
+            executor, (future,) = self.submit(
+                self.max_workers, file_path,
+                [(render_page_bytes, (file_path, doc_hash, page_num, zoom, edits, image_format))])
+            try:
+                data = future.result()
+            except BrokenProcessPool:
+                # Процесс пула аварийно завершился (например, сбой MuPDF) - пул пересоздается
+                self.reset(executor)
+                raise
+            with self.lock:
+                self.rendered += 1
+            return data
+
+    def stats(self):
+        """Статистика пула"""
+        with self.lock:
+            return {
+                'workers': self.max_workers,
+                'rendered': self.rendered,
+                'restarts': self.restarts,
+            }
@@ -0,0 +1,147 @@
+"""
+Фоновый рендеринг страниц: пул процессов с отменой устаревших запросов
+"""
+import os
+import queue
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+from process_pool import WorkerDocuments, spawn_pool
+
+# Как часто окно проверяет готовые результаты, пока есть запросы (мс)
+POLL_INTERVAL_MS = 20
+# Сколько документов держит открытыми процесс рендеринга
+WORKER_OPEN_DOCUMENTS = 2
+
+# Документы, открытые процессом рендеринга, по (путь, время изменения)
+_worker_documents = WorkerDocuments(WORKER_OPEN_DOCUMENTS)
+
+
+def render_page_samples(file_path, mtime, page_num, zoom):
+    """Рендеринг страницы в процессе: (ширина, высота, пиксели RGB) или None, если страницы нет"""
+    doc = _worker_documents.get((file_path, mtime))
+    if page_num >= len(doc):
+        return None
+    pix = doc[page_num].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return pix.width, pix.height, pix.samples
+
+
+class PageRenderPool:
+    """Пул фоновых процессов для рендеринга страниц
+
+    MuPDF не отпускает GIL, поэтому рендеринг в потоке останавливает и
+    окно; процессы рендерят страницы, не мешая главному потоку. Каждый
+    процесс сам открывает документ по пути. Результаты передаются через
+    очередь, которую главный поток Tk проверяет (root.after), пока есть
+    запросы: колбэки on_done вызываются только в главном потоке, а после
+    shutdown не вызываются вовсе. Запросы для страниц, которые пользователь
+    уже пролистал, отменяются cancel_except.
+    """
+
+    def __init__(self, root, max_workers=2):
+        self.root = root
+        self.max_workers = max_workers
+        self.executor = None
+        self.file_path = None
+        self.mtime = None
+        self.futures = {}  # (page_num, zoom) -> Future
+        self.callbacks = {}  # (page_num, zoom) -> [on_done, ...]
+        self.results = queue.Queue()  # (ключ, Future) завершенных запросов
+        self.poll_id = None
+        self.closed = False
+
+    def get_executor(self):
+        """Пул процессов (создается при первом запросе)"""
+        if self.executor is None:
+            self.executor = spawn_pool(self.max_workers)
+        return self.executor
+
+    def open(self, file_path):
+        """Смена документа; процессы откроют его при следующем запросе"""
+        self.cancel_except(())
+        self.file_path = str(file_path)
+        self.mtime = os.stat(file_path).st_mtime_ns
+
+    def submit(self, page_num, zoom, on_done):
+        """Запрос рендеринга страницы; повторный запрос той же страницы не дублируется
+
+        on_done(page_num, zoom, img) вызывается в главном потоке Tk.
+        """
+        if self.closed or self.file_path is None:
+            return
+        key = (page_num, zoom)
+        self.callbacks.setdefault(key, []).append(on_done)
+        if key not in self.futures:
+            future = self.get_executor().submit(render_page_samples, self.file_path, self.mtime,
+                                                page_num, zoom)
+            self.futures[key] = future
+            # Колбэк Future выполняется в служебном потоке пула - только очередь
+            future.add_done_callback(lambda f, key=key: self.results.put((key, f)))
+        if self.poll_id is None:
+            self.poll_id = self.root.after(POLL_INTERVAL_MS, self.poll)
+
+    def cancel_except(self, keep):
+        """Отмена запросов, кроме страниц из keep [(page_num, zoom), ...]
+
+        Уже выполняющийся рендеринг не прерывается, но его результат не передается.
+        """
+        keep = set(keep)
+        for key in list(self.futures):
+            if key not in keep:
+                self.futures.pop(key).cancel()
+                self.callbacks.pop(key, None)
+
+    def poll(self):
+        """Передача готовых результатов колбэкам (в главном потоке Tk)"""
+        self.poll_id = None
+        if self.closed:
+            return
+        while True:
+            try:
+                key, future = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if self.futures.get(key) is not future:
+                # Запрос отменен или заменен новым
+                continue
+            del self.futures[key]
+            callbacks = self.callbacks.pop(key, [])
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                # Процесс пула аварийно завершился - пул пересоздается при следующем запросе
+                self.reset()
+                continue
+            except Exception:
+                continue
+            if result is None:
+                continue
+            width, height, samples = result
+            img = Image.frombytes("RGB", (width, height), samples)
+            for on_done in callbacks:
+                on_done(key[0], key[1], img)
+        # Колбэки могли уже запланировать проверку новым submit
+        if self.futures and self.poll_id is None:
+            self.poll_id = self.root.after(POLL_INTERVAL_MS, self.poll)
+
+    def reset(self):
+        """Замена неисправного пула: его запросы отменяются"""
+        executor, self.executor = self.executor, None
+        self.cancel_except(())
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        """Остановка пула без ожидания текущих запросов; колбэки больше не вызываются"""
+        self.closed = True
+        if self.poll_id is not None:
+            self.root.after_cancel(self.poll_id)
+            self.poll_id = None
+        self.cancel_except(())
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,291 @@
+"""
+Сессии веб-версии: открытые документы, закрытие простаивающих сессий и очистка временных файлов
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Сессия без обращений дольше этого времени закрывается (секунды)
+SESSION_IDLE_TTL = 2 * 60 * 60
+# Сколько документов держать открытыми одновременно
+MAX_OPEN_DOCUMENTS = 8
+# Период фоновой очистки (секунды)
+CLEANUP_INTERVAL = 5 * 60
+
+
+def remove_file(path):
+    """Удаление файла; отсутствующий файл - не ошибка"""
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+def process_memory():
+    """Текущий и пиковый объем памяти процесса в байтах (None, если недоступно)"""
+    rss = peak = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux сообщает килобайты, macOS - байты
+        peak *= 1 if sys.platform == 'darwin' else 1024
+    return {'rss_bytes': rss, 'peak_rss_bytes': peak}
+
+
+class SessionManager:
+    """Сессии: данные изменений и документы PDF
+
+    Данные сессии живут, пока к ней обращаются (простой дольше idle_ttl -
+    сессия закрывается, ее файлы удаляются). Открытых документов не больше
+    max_open: давно не использованный документ закрывается и открывается
+    заново из загруженного файла при следующем обращении.
+    Файлы сессии перечислены в data['files'].
+
+    Данные и документ сессии меняются и используются только под блокировкой
+    сессии (locked): запросы одной сессии выполняются по очереди, разных -
+    параллельно. Блокировка существует, пока ее держат или ждут, поэтому
+    запросы с неизвестными id не оставляют блокировок. Порядок блокировок:
+    сначала сессии, затем self.lock; документы и сессии, занятые другими
+    потоками, не закрываются.
+    """
+
+    def __init__(self, upload_dir, idle_ttl=SESSION_IDLE_TTL, max_open=MAX_OPEN_DOCUMENTS,
+                 on_close=None, on_remove=None):
+        self.upload_dir = Path(upload_dir)
+        self.idle_ttl = idle_ttl
+        self.max_open = max_open
+        self.on_close = on_close  # on_close(session_id) - после закрытия сессии
+        # on_remove(paths) - перед удалением файлов закрытой сессии (их могут держать открытыми
+        # процессы пулов)
+        self.on_remove = on_remove
+        self.data = {}  # session_id -> данные сессии
+        self.documents = OrderedDict()  # session_id -> fitz.Document, от давно использованных к свежим
+        self.last_used = {}  # session_id -> time.monotonic() последнего обращения
+        # session_id -> [threading.RLock, число потоков, которые ее держат или ждут]
+        self.session_locks = {}
+        self.reopened = 0  # Документов открыто заново после закрытия по лимиту
+        self.evicted = 0  # Документов закрыто по лимиту
+        self.expired = 0  # Сессий закрыто по простою
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.cleanup_thread = None
+
+    def __contains__(self, session_id):
+        with self.lock:
+            return session_id in self.data
+
+    @contextmanager
+    def locked(self, session_id, blocking=True):
+        """Блокировка сессии на время изменения ее данных или работы с ее документом
+
+        Возвращает, захвачена ли блокировка: при blocking=False занятая
+        сессия не ждется (False). Блокировка удаляется, когда ее больше
+        никто не держит и не ждет.
+        """
+        with self.lock:
+            entry = self.session_locks.setdefault(session_id, [threading.RLock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.session_locks[session_id]
+
+    def add(self, session_id, doc, data):
+        """Новая сессия с открытым документом; прежняя сессия с тем же id закрывается"""
+        with self.locked(session_id):
+            if session_id in self:
+                self.close_session(session_id, keep_files=data.get('files', ()))
+            with self.lock:
+                self.data[session_id] = data
+                self.documents[session_id] = doc
+                self.touch(session_id)
+                self.close_excess()
+
+    def touch(self, session_id):
+        """Отметка об обращении к сессии"""
+        with self.lock:
+            if session_id in self.data:
+                self.last_used[session_id] = time.monotonic()
+
+    def document(self, session_id):
+        """Открытый документ сессии (закрытый по лимиту открывается заново)
+
+        Вызывается под блокировкой сессии (locked).
+        """
+        with self.lock:
+            doc = self.documents.get(session_id)
+            if doc is None:
+                doc = fitz.open(self.data[session_id]['file_path'])
+                self.documents[session_id] = doc
+                self.reopened += 1
+            self.documents.move_to_end(session_id)
+            self.touch(session_id)
+            self.close_excess()
+            return doc
+
+    def close_excess(self):
+        """Закрытие давно не использованных документов сверх лимита (данные сессий сохраняются)
+
+        Самый свежий документ и документы занятых сессий не закрываются.
+        """
+        with self.lock:
+            for session_id in list(self.documents)[:-1]:
+                if len(self.documents) <= self.max_open:
+                    break
+                with self.locked(session_id, blocking=False) as acquired:
+                    if not acquired:
+                        continue
+                    self.documents.pop(session_id).close()
+                    self.evicted += 1
+
+    def close_session(self, session_id, keep_files=()):
+        """Закрытие сессии: документ закрывается, ее временные файлы удаляются
+
+        Ждет завершения запросов сессии, выполняющихся в других потоках.
+        """
+        with self.locked(session_id):
+            with self.lock:
+                data = self.data.pop(session_id, None)
+                doc = self.documents.pop(session_id, None)
+                self.last_used.pop(session_id, None)
+            if doc is not None:
+                doc.close()
+        if data is not None:
+            keep_files = {str(path) for path in keep_files}
+            paths = {str(path) for path in data.get('files', ())} - keep_files
+            if paths and self.on_remove is not None:
+                self.on_remove(paths)
+            for path in paths:
+                remove_file(path)
+        if self.on_close is not None:
+            self.on_close(session_id)
+        return data is not None
+
+    def expire_idle(self):
+        """Закрытие сессий, простаивающих дольше idle_ttl; возвращает их id"""
+        now = time.monotonic()
+        with self.lock:
+            expired = [session_id for session_id, last_used in self.last_used.items()
+                       if now - last_used > self.idle_ttl]
+        closed = []
+        for session_id in expired:
+            # Занятая сессия не простаивает - она будет проверена при следующей очистке
+            with self.locked(session_id, blocking=False) as acquired:
+                if acquired and self.close_session(session_id):
+                    self.expired += 1
+                    closed.append(session_id)
+        return closed
+
+    def cleanup_files(self):
+        """Удаление старых файлов каталога загрузок, не принадлежащих ни одной сессии
+
+        Это остатки закрытых сессий и прежних запусков сервера. Файлы моложе
+        idle_ttl не трогаются: они могут быть только что загружены.
+        """
+        with self.lock:
+            live = {str(path) for data in self.data.values() for path in data.get('files', ())}
+        now = time.time()
+        removed = 0
+        for path in self.upload_dir.iterdir():
+            try:
+                if (path.is_file() and str(path) not in live
+                        and now - path.stat().st_mtime > self.idle_ttl):
+                    path.unlink()
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def cleanup(self):
+        """Закрытие простаивающих сессий и удаление лишних файлов"""
+        try:
+            self.expire_idle()
+            self.cleanup_files()
+        except Exception:
+            logger.exception("Ошибка очистки сессий")
+
+    def start_cleanup(self, interval=CLEANUP_INTERVAL):
+        """Запуск фоновой очистки раз в interval секунд"""
+        if self.cleanup_thread is not None:
+            return
+
+        def run():
+            while not self.stop_event.wait(interval):
+                self.cleanup()
+
+        self.cleanup_thread = threading.Thread(target=run, name="session-cleanup", daemon=True)
+        self.cleanup_thread.start()
+
+    def stop(self):
+        """Остановка фоновой очистки и закрытие всех сессий"""
+        self.stop_event.set()
+        with self.lock:
+            session_ids = list(self.data)
+        for session_id in session_ids:
+            self.close_session(session_id)
+
+    def disk_usage(self):
+        """Число и суммарный размер файлов в каталоге загрузок"""
+        files = total_bytes = 0
+        for path in self.upload_dir.iterdir():
+            try:
+                if path.is_file():
+                    files += 1
+                    total_bytes += path.stat().st_size
+            except OSError:
+                pass
+        return {'files': files, 'bytes': total_bytes}
+
+    def report(self):
+        """Активные сессии, открытые документы, память процесса и место на диске"""
+        now = time.monotonic()
+        with self.lock:
+            sessions = []
+            for session_id, data in self.data.items():
+                output = data.get('output')
+                sessions.append({
+                    'session_id': session_id,
+                    'idle_seconds': round(now - self.last_used.get(session_id, now), 1),
+                    'document_open': session_id in self.documents,
+                    'files': len(data.get('files', ())),
+                    'output_bytes': output['size'] if output else 0,
+                })
+            report = {
+                'sessions': sessions,
+                'active_sessions': len(self.data),
+                'open_documents': len(self.documents),
+                'max_open_documents': self.max_open,
+                'idle_ttl': self.idle_ttl,
+                'reopened': self.reopened,
+                'evicted': self.evicted,
+                'expired': self.expired,
+            }
+        report['memory'] = process_memory()
+        report['disk'] = self.disk_usage()
+        report['disk']['output_bytes'] = sum(s['output_bytes'] for s in sessions)
+        return report
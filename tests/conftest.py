@@ -0,0 +1,24 @@
+"""
+Общие данные тестов: модули редактора лежат в корне репозитория
+"""
+import sys
+from pathlib import Path
+
+import fitz  # PyMuPDF
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def source_pdf(tmp_path):
+    """Исходный PDF из четырех страниц с текстом "Hello page N": (документ, путь)"""
+    path = tmp_path / 'source.pdf'
+    doc = fitz.open()
+    for page_num in range(4):
+        doc.new_page().insert_text((72, 72), f"Hello page {page_num}")
+    doc.save(str(path))
+    doc.close()
+    doc = fitz.open(str(path))
+    yield doc, str(path)
+    doc.close()
@@ -0,0 +1,68 @@
+"""
+Тесты сохранения документа с изменениями страниц
+"""
+import fitz  # PyMuPDF
+import pytest
+
+import page_edits
+from export_engine import export_bytes, save_document
+from page_edits import collect_page_edits
+
+# Область, закрывающая строку текста на каждой странице source_pdf
+TEXT_AREA = (60, 50, 300, 90)
+
+
+def redacted_edits(doc):
+    """Удаление строки текста со всех страниц вместе с содержимым под областью"""
+    deletion_areas = [[TEXT_AREA]] * len(doc)
+    return [collect_page_edits(page_num, deletion_areas, [], [], [], redact=True)
+            for page_num in range(len(doc))]
+
+
+def raw_streams(data):
+    """Распакованные потоки всех объектов PDF, включая недостижимые"""
+    doc = fitz.open("pdf", data)
+    try:
+        return [doc.xref_stream(xref) for xref in range(1, doc.xref_length())
+                if doc.xref_is_stream(xref)]
+    finally:
+        doc.close()
+
+
+def contains_text(data, text):
+    """Есть ли текст в PDF: в исходном виде или в шестнадцатеричной строке"""
+    raw = text.encode('latin-1')
+    return any(raw in stream or raw.hex().encode() in stream.lower() for stream in raw_streams(data))
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_export_bytes_drops_redacted_text(source_pdf, workers):
+    doc, path = source_pdf
+    data, report = export_bytes(doc, path, redacted_edits(doc), workers=workers)
+    assert not report['unredacted_pages']
+    for page_num in range(len(doc)):
+        assert not contains_text(data, f"Hello page {page_num}")
+
+
+def test_save_document_drops_redacted_text(source_pdf, tmp_path):
+    doc, path = source_pdf
+    output_path = tmp_path / 'redacted.pdf'
+    save_document(doc, path, str(output_path), redacted_edits(doc))
+    data = output_path.read_bytes()
+    for page_num in range(len(doc)):
+        assert not contains_text(data, f"Hello page {page_num}")
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_failed_recolor_falls_back_to_raster(source_pdf, monkeypatch, workers):
+    def fail(*args, **kwargs):
+        raise RuntimeError("recolor failed")
+
+    monkeypatch.setattr(page_edits, 'recolor_page_vectors', fail)
+    doc, path = source_pdf
+    replacements = [[('#000000', '#ff0000')]] * len(doc)
+    edits = [collect_page_edits(page_num, [], [], replacements, [])
+             for page_num in range(len(doc))]
+    data, report = export_bytes(doc, path, edits, workers=workers)
+    assert fitz.open("pdf", data).page_count == len(doc)
+    assert all(page['mode'].startswith('raster-') for page in report['pages'])
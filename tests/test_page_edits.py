@@ -0,0 +1,49 @@
+"""
+Тесты применения изменений страницы к PDF
+"""
+import re
+
+import fitz  # PyMuPDF
+import pytest
+
+import font_registry
+from export_engine import EXPORT_MODE_INCREMENTAL, export_bytes
+from page_edits import collect_page_edits
+
+
+def text_edits(doc, text):
+    """Вставка текста на первую страницу, остальные страницы без изменений"""
+    inserted = [{'page': 0, 'type': 'text', 'x': 72, 'y': 200,
+                 'data': {'text': text, 'font_size': 11, 'color': '#000000'}}]
+    return [collect_page_edits(0, [], [], [], inserted)] + [None] * (len(doc) - 1)
+
+
+def page_font_resources(doc, page):
+    """Шрифты из собственных ресурсов страницы: имя ресурса -> BaseFont"""
+    kind, value = doc.xref_get_key(page.xref, 'Resources')
+    xref, path = (int(value.split()[0]), 'Font') if kind == 'xref' else (page.xref, 'Resources/Font')
+    fonts = {}
+    kind, value = doc.xref_get_key(xref, path)
+    for name, font_xref in re.findall(r'/([^\s/<>]+)\s+(\d+) 0 R', value):
+        fonts[name] = doc.xref_get_key(int(font_xref), 'BaseFont')[1].lstrip('/')
+    return fonts
+
+
+@pytest.mark.parametrize('mode', ['full', EXPORT_MODE_INCREMENTAL])
+def test_text_overlay_font_in_page_resources(source_pdf, monkeypatch, mode):
+    # Без файла шрифта текст вставляется стандартным Helvetica; в исходном PDF
+    # (создан PyMuPDF) уже есть шрифт /helv
+    monkeypatch.setattr(font_registry.font_registry, 'paths', {'default': None})
+    doc, path = source_pdf
+    data, report = export_bytes(doc, path, text_edits(doc, "Inserted text"), mode=mode)
+    assert report['mode'] == mode
+    out = fitz.open("pdf", data)
+    page = out[0]
+    fonts = page_font_resources(out, page)
+    # Все шрифты, выбранные операторами Tf страницы, есть в ее ресурсах
+    used = {name.decode() for name in re.findall(rb'/([^\s/]+)\s+[\d.]+\s+Tf', page.read_contents())}
+    assert used and used <= set(fonts)
+    assert all(fonts[name] == 'Helvetica' for name in used)
+    spans = [span for block in page.get_text('dict')['blocks'] for line in block.get('lines', ())
+             for span in line['spans'] if span['text'] == "Inserted text"]
+    assert spans and spans[0]['font'] == 'Helvetica'
@@ -0,0 +1,86 @@
+"""
+Тайловый рендеринг страниц: отрисовываются только видимые части страницы
+"""
+import math
+
+import fitz  # PyMuPDF
+
+from pixmap_utils import pixmap_to_image
+
+# Размер тайла в пикселях экрана
+TILE_SIZE = 512
+# Запас вокруг видимой области, который рендерится заранее (в пикселях)
+TILE_MARGIN = 256
+# Начиная с этого размера страницы (в пикселях) используется тайловый режим
+TILED_MIN_PIXELS = 4_000_000
+
+
+def page_pixel_size(page, zoom):
+    """Размер отрендеренной страницы в пикселях при заданном масштабе"""
+    irect = (page.rect * fitz.Matrix(zoom, zoom)).irect
+    return irect.width, irect.height
+
+
+def should_tile(page, zoom):
+    """Нужен ли тайловый режим для страницы при заданном масштабе"""
+    width, height = page_pixel_size(page, zoom)
+    return width * height >= TILED_MIN_PIXELS
+
+
+def visible_tiles(page_width, page_height, view_box, tile_size=TILE_SIZE, margin=TILE_MARGIN):
+    """Список тайлов (col, row), пересекающих видимую область с запасом
+
+    view_box - (x1, y1, x2, y2) видимой области в пикселях страницы.
+    """
+    if page_width <= 0 or page_height <= 0:
+        return []
+
+    x1, y1, x2, y2 = view_box
+    x1 = max(0, x1 - margin)
+    y1 = max(0, y1 - margin)
+    x2 = min(page_width, x2 + margin)
+    y2 = min(page_height, y2 + margin)
+    if x1 >= x2 or y1 >= y2:
+        return []
+
+    first_col = int(x1 // tile_size)
+    first_row = int(y1 // tile_size)
+    last_col = min(math.ceil(x2 / tile_size), math.ceil(page_width / tile_size)) - 1
+    last_row = min(math.ceil(y2 / tile_size), math.ceil(page_height / tile_size)) - 1
+
+    # Сначала тайлы ближе к центру видимой области
+    center_col = (x1 + x2) / 2 / tile_size
+    center_row = (y1 + y2) / 2 / tile_size
+    tiles = [(col, row)
+             for row in range(first_row, last_row + 1)
+             for col in range(first_col, last_col + 1)]
+    tiles.sort(key=lambda t: (t[0] + 0.5 - center_col) ** 2 + (t[1] + 0.5 - center_row) ** 2)
+    return tiles
+
+
+def render_tile(page, zoom, col, row, tile_size=TILE_SIZE):
+    """Рендеринг одного тайла страницы через get_pixmap(clip=...)
+
+    Возвращает (PIL Image, (x, y)), где (x, y) - положение тайла в пикселях
+    страницы, либо (None, None), если тайл пуст.
+    """
+    clip = fitz.Rect(
+        col * tile_size / zoom,
+        row * tile_size / zoom,
+        (col + 1) * tile_size / zoom,
+        (row + 1) * tile_size / zoom,
+    ) & page.rect
+    if clip.is_empty:
+        return None, None
+
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+    img = pixmap_to_image(pix)
+    # Положение берем из самого пиксмапа, чтобы тайлы стыковались без щелей
+    return img, (pix.x, pix.y)
+
+
+def tile_intersects(col, row, box, tile_size=TILE_SIZE):
+    """Пересекается ли тайл с прямоугольником box (x1, y1, x2, y2) в пикселях страницы"""
+    x1, y1, x2, y2 = box
+    return (col * tile_size < x2 and x1 < (col + 1) * tile_size and
+            row * tile_size < y2 and y1 < (row + 1) * tile_size)
@@ -0,0 +1,466 @@
+"""
+Замена цвета без растеризации: переписывание операторов цвета в потоках содержимого
+
+Цвета заливки и обводки (rg/RG, g/G, k/K, sc/scn/SC/SCN) сравниваются с
+заменами по тому же правилу допуска, что и при замене пикселей
+(color_engine), и переписываются на месте. Изображения страницы
+перекрашиваются в исходном разрешении. Все, что нельзя переписать
+надежно (градиенты, шаблоны, встроенные изображения), делает страницу
+непригодной - тогда вызывающий код растеризует ее, как раньше.
+"""
+import hashlib
+import re
+import zlib
+from functools import lru_cache
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from color_engine import apply_rules_with_cube, map_color
+from image_cache import ImageCache
+
+# Разделители и пробельные символы синтаксиса PDF
+WHITESPACE = b'\x00\t\n\x0c\r '
+TOKEN_RE = re.compile(
+    rb'[\x00\t\n\x0c\r ]+'             # пробелы
+    rb'|%[^\r\n]*'                     # комментарий
+    rb'|<<|>>|\[|\]|\{|\}'             # словари, массивы, функции
+    rb'|<[0-9A-Fa-f\x00\t\n\x0c\r ]*>'  # hex строка
+    rb'|/[^\x00\t\n\x0c\r ()<>\[\]{}/%]*'  # имя
+    rb'|[+-]?(?:\d+\.?\d*|\.\d+)'      # число
+    rb'|[^\x00\t\n\x0c\r ()<>\[\]{}/%]+'  # оператор
+)
+NUMBER_RE = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)$')
+
+# Семейства цветовых пространств
+RGB = 'rgb'
+GRAY = 'gray'
+CMYK = 'cmyk'
+OTHER = 'other'
+
+DEVICE_SPACES = {
+    '/DeviceRGB': RGB, '/RGB': RGB,
+    '/DeviceGray': GRAY, '/G': GRAY,
+    '/DeviceCMYK': CMYK, '/CMYK': CMYK,
+}
+COMPONENTS = {RGB: 3, GRAY: 1, CMYK: 4}
+# Начальный цвет пространства (после cs/CS и в начале страницы) - черный
+INITIAL_COLORS = {RGB: (0, 0, 0), GRAY: (0,), CMYK: (0, 0, 0, 1)}
+
+# Операторы, задающие цвет в фиксированном пространстве: оператор -> (пространство, обводка)
+DIRECT_COLOR_OPERATORS = {
+    b'rg': (RGB, False), b'RG': (RGB, True),
+    b'g': (GRAY, False), b'G': (GRAY, True),
+    b'k': (CMYK, False), b'K': (CMYK, True),
+}
+# Операторы цвета в текущем пространстве: оператор -> обводка
+SPACE_COLOR_OPERATORS = {b'sc': False, b'scn': False, b'SC': True, b'SCN': True}
+
+
+# Перекрашенные изображения: общее изображение обрабатывается один раз,
+# даже если страницы сохраняются в отдельных документах
+recolored_images = ImageCache(64 * 1024 * 1024)
+
+
+class NotRewritable(Exception):
+    """Содержимое страницы нельзя перекрасить без растеризации"""
+
+
+def to_byte(value):
+    """Компонента цвета 0..1 в 0..255 так же, как при рендеринге (float32, отбрасывание дробной части)"""
+    return int(np.float32(min(1.0, max(0.0, value))) * np.float32(255))
+
+
+def from_byte(channel):
+    """Компонента 0..1, которая при рендеринге даст ровно channel (середина интервала)"""
+    return min(1.0, (channel + 0.5) / 255.0)
+
+
+@lru_cache(maxsize=1024)
+def cmyk_to_rgb(cmyk):
+    """CMYK (0..255) в RGB тем же преобразованием MuPDF, что и при рендеринге"""
+    pix = fitz.Pixmap(fitz.csCMYK, 1, 1, bytes(cmyk), False)
+    return tuple(fitz.Pixmap(fitz.csRGB, pix).samples)
+
+
+def components_to_rgb(space, values):
+    """Цвет в пространстве space в RGB 0..255"""
+    if space == RGB:
+        return tuple(to_byte(v) for v in values)
+    if space == GRAY:
+        return (to_byte(values[0]),) * 3
+    return cmyk_to_rgb(tuple(to_byte(v) for v in values))
+
+
+def rgb_to_components(space, rgb):
+    """Цвет RGB 0..255 в пространстве space или None, если его там не выразить
+
+    CMYK MuPDF преобразует через ICC профиль, поэтому точный обратный
+    перевод не гарантирован - такие цвета не переписываются.
+    """
+    values = [from_byte(channel) for channel in rgb]
+    if space == RGB:
+        return values
+    if space == GRAY and rgb[0] == rgb[1] == rgb[2]:
+        return values[:1]
+    return None
+
+
+def image_cache_key(doc, xref, rules):
+    """Ключ перекрашенного изображения: содержимое потока, описание и замены"""
+    digest = hashlib.sha1(doc.xref_stream_raw(xref))
+    for key in ('Width', 'Height', 'BitsPerComponent', 'Decode', 'Filter', 'DecodeParms'):
+        digest.update(repr(doc.xref_get_key(xref, key)).encode())
+    kind, value = doc.xref_get_key(xref, 'ColorSpace')
+    if kind == 'xref':
+        value = doc.xref_object(int(value.split()[0]), compressed=True)
+    # Ссылки внутри описания пространства (ICC профиль) разворачиваем до содержимого
+    for ref in re.findall(r'(\d+) 0 R', value):
+        if doc.xref_is_stream(int(ref)):
+            digest.update(hashlib.sha1(doc.xref_stream_raw(int(ref))).digest())
+    digest.update(re.sub(r'\d+ 0 R', 'R', value).encode())
+    return ('image', digest.hexdigest(), rules)
+
+
+def format_number(value):
+    """Число в записи оператора PDF"""
+    text = ('%.6f' % value).rstrip('0').rstrip('.')
+    return '0' if text in ('', '-0') else text
+
+
+class ContentRecolorer:
+    """Перекрашивание потоков содержимого одной страницы документа"""
+
+    def __init__(self, doc, rules, recolored=None):
+        self.doc = doc
+        self.rules = rules
+        # xref потоков, форм и изображений doc, уже перекрашенных с теми же rules
+        # (общие для нескольких страниц): повторно не обрабатываются
+        self.recolored = set() if recolored is None else recolored
+        self.mapped = {}  # rgb -> rgb после замен
+        self.visited_forms = set()
+        self.images = []  # xref изображений страницы, перекрашиваются после разбора потоков
+        self.streams = {}  # xref -> новый поток; записываются, только если вся страница переписана
+        self.changed = 0  # Сколько операторов переписано
+
+    def map_rgb(self, rgb):
+        """Цвет после применения цепочки замен"""
+        result = self.mapped.get(rgb)
+        if result is None:
+            result = self.mapped[rgb] = map_color(rgb, self.rules)
+        return result
+
+    # --- ресурсы ---
+
+    def resource(self, owner_xref, category, name):
+        """Объект ресурса (тип, значение) по имени из словаря Resources владельца"""
+        return self.doc.xref_get_key(owner_xref, f"Resources/{category}/{name[1:]}")
+
+    def colorspace_family(self, owner_xref, name):
+        """Семейство цветового пространства по его имени в операторе cs/CS"""
+        if name in DEVICE_SPACES:
+            return DEVICE_SPACES[name]
+        if name == '/Pattern':
+            return OTHER
+        kind, value = self.resource(owner_xref, 'ColorSpace', name)
+        if kind == 'name':
+            return DEVICE_SPACES.get(value, OTHER)
+        if kind == 'xref':
+            value = self.doc.xref_object(int(value.split()[0]), compressed=True)
+        return self.array_family(value)
+
+    def array_family(self, value):
+        """Семейство цветового пространства, заданного массивом [/ICCBased ...]"""
+        value = value.strip()
+        if value in DEVICE_SPACES:
+            return DEVICE_SPACES[value]
+        match = re.match(r'\[\s*(/\w+)\s*(.*)\]$', value, re.S)
+        if not match:
+            return OTHER
+        family, rest = match.groups()
+        if family == '/CalRGB':
+            return RGB
+        if family == '/CalGray':
+            return GRAY
+        if family == '/ICCBased':
+            ref = re.match(r'(\d+)\s+0\s+R', rest.strip())
+            if ref:
+                kind, components = self.doc.xref_get_key(int(ref.group(1)), 'N')
+                return {'1': GRAY, '3': RGB, '4': CMYK}.get(components, OTHER)
+        return OTHER
+
+    # --- изображения ---
+
+    def recolor_image(self, xref):
+        """Перекрашенные пиксели изображения в исходном разрешении (None - без изменений)"""
+        if self.doc.xref_get_key(xref, 'ImageMask')[1] == 'true':
+            # Маска рисуется текущим цветом заливки, который переписывается
+            return None
+        if self.doc.xref_get_key(xref, 'Mask')[0] == 'array':
+            # Маска по цветам задана в исходном цветовом пространстве
+            raise NotRewritable("Изображение с маской по цветам")
+
+        key = image_cache_key(self.doc, xref, self.rules)
+        samples = recolored_images.get(key)
+        if samples is None:
+            pix = fitz.Pixmap(self.doc, xref)
+            if pix.alpha:
+                # Прозрачность внутри самого изображения (например, JPX) не переносится
+                raise NotRewritable("Изображение со встроенной прозрачностью")
+            if pix.colorspace is None or pix.colorspace.n != 3:
+                pix = fitz.Pixmap(fitz.csRGB, pix)
+            pixels = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+            recolored = apply_rules_with_cube(pixels.copy(), self.rules)
+            # b'' - изображение не затронуто заменами
+            samples = recolored.tobytes() if (recolored != pixels).any() else b''
+            recolored_images.put(key, samples, nbytes=len(samples))
+        return samples or None
+
+    def write_image(self, xref, samples):
+        """Замена потока изображения на месте
+
+        Ссылки на изображение (в том числе с других страниц) остаются прежними,
+        маска прозрачности (/SMask) не меняется. Поток сжимается здесь же:
+        update_stream оставляет несжимаемые данные как есть, а фильтр
+        /FlateDecode у несжатых данных испортил бы изображение.
+        """
+        self.doc.update_stream(xref, zlib.compress(samples), compress=False)
+        self.doc.xref_set_key(xref, 'Filter', '/FlateDecode')
+        self.doc.xref_set_key(xref, 'DecodeParms', 'null')
+        self.doc.xref_set_key(xref, 'Decode', 'null')
+        self.doc.xref_set_key(xref, 'ColorSpace', '/DeviceRGB')
+        self.doc.xref_set_key(xref, 'BitsPerComponent', '8')
+        self.changed += 1
+
+    # --- потоки ---
+
+    def recolor_page(self, page):
+        """Перекрашивание страницы и всех ее форм; NotRewritable, если это невозможно"""
+        state = {'fill': GRAY, 'stroke': GRAY}
+        # Содержимое без операторов цвета рисуется черным по умолчанию: если
+        # черный тоже заменяется, новый цвет задается в начале страницы
+        prefix = self.default_color()
+        if prefix is not None:
+            state = {'fill': RGB, 'stroke': RGB}
+        contents = page.get_contents()
+        for xref in contents:
+            if xref not in self.recolored:
+                self.recolor_stream(xref, page.xref, state)
+        # Изображения обрабатываются, только если потоки удалось переписать целиком
+        images = []
+        for xref in self.images:
+            samples = self.recolor_image(xref)
+            if samples is not None:
+                images.append((xref, samples))
+
+        # Документ изменяется, только когда вся страница переписана без ошибок
+        for xref, data in self.streams.items():
+            self.doc.update_stream(xref, data)
+        for xref, samples in images:
+            self.write_image(xref, samples)
+        if prefix is not None:
+            self.prepend_contents(page, prefix)
+        self.recolored.update(contents, self.visited_forms, self.images)
+
+    def default_color(self):
+        """Операторы rg/RG с заменой черного цвета по умолчанию (None - черный не меняется)"""
+        new_rgb = self.map_rgb((0, 0, 0))
+        if new_rgb == (0, 0, 0):
+            return None
+        color = ' '.join(format_number(v) for v in rgb_to_components(RGB, new_rgb))
+        self.changed += 1
+        return f'{color} rg {color} RG\n'.encode()
+
+    def prepend_contents(self, page, data):
+        """Новый поток содержимого в начале страницы"""
+        xref = self.doc.get_new_xref()
+        self.doc.update_object(xref, '<<>>')
+        self.doc.update_stream(xref, data)
+        kind, value = self.doc.xref_get_key(page.xref, 'Contents')
+        if kind == 'array':
+            contents = value.strip()[1:-1].strip()
+        elif kind == 'xref':
+            contents = value
+        else:
+            contents = ''
+        self.doc.xref_set_key(page.xref, 'Contents', f'[{xref} 0 R {contents}]'.replace(' ]', ']'))
+
+    def recolor_stream(self, xref, owner_xref, state):
+        """Перекрашивание одного потока содержимого"""
+        data = self.doc.xref_stream(xref)
+        new_data = self.rewrite(data, owner_xref, state)
+        if new_data is not data:
+            self.streams[xref] = new_data
+
+    def recolor_form(self, xref, owner_xref, state):
+        """Перекрашивание формы (XObject); общая форма обрабатывается один раз"""
+        if xref in self.visited_forms or xref in self.recolored:
+            return
+        self.visited_forms.add(xref)
+        # Форма без своих ресурсов использует ресурсы вызывающего содержимого
+        if self.doc.xref_get_key(xref, 'Resources')[0] == 'null':
+            owner = owner_xref
+        else:
+            owner = xref
+        data = self.doc.xref_stream(xref)
+        new_data = self.rewrite(data, owner, dict(state))
+        if new_data is not data:
+            self.streams[xref] = new_data
+
+    def rewrite(self, data, owner_xref, state):
+        """Новый поток с переписанными операторами цвета (или data без изменений)"""
+        pieces = []  # (начало, конец, замена)
+        operands = []  # (начало, конец, токен)
+        stack = []
+        pos = 0
+        length = len(data)
+
+        while pos < length:
+            if data[pos] == 0x28:  # '(' - строка
+                end = self.skip_string(data, pos)
+                operands.append((pos, end, b'()'))
+                pos = end
+                continue
+            match = TOKEN_RE.match(data, pos)
+            if match is None:
+                raise NotRewritable("Не удалось разобрать поток содержимого")
+            token = match.group()
+            start, pos = pos, match.end()
+            first = token[:1]
+            if first in WHITESPACE or first == b'%':
+                continue
+            if first in b'/[]{}<' or token == b'>>' or NUMBER_RE.match(token):
+                operands.append((start, pos, token))
+                continue
+
+            # Оператор
+            if token == b'BI':
+                raise NotRewritable("Встроенное изображение")
+            if token == b'sh':
+                raise NotRewritable("Градиентная заливка")
+            if token == b'q':
+                stack.append(dict(state))
+            elif token == b'Q':
+                if stack:
+                    state.update(stack.pop())
+            elif token in (b'cs', b'CS'):
+                if operands and operands[-1][2][:1] == b'/':
+                    family = self.colorspace_family(owner_xref, operands[-1][2].decode('latin-1'))
+                    state['stroke' if token == b'CS' else 'fill'] = family
+                    if family in INITIAL_COLORS:
+                        # cs/CS сбрасывает цвет на начальный (черный)
+                        self.rewrite_initial_color(pieces, pos, family, token == b'CS')
+            elif token in DIRECT_COLOR_OPERATORS:
+                space, stroke = DIRECT_COLOR_OPERATORS[token]
+                state['stroke' if stroke else 'fill'] = space
+                self.rewrite_color(pieces, operands, pos, space, stroke, direct=True)
+            elif token in SPACE_COLOR_OPERATORS:
+                stroke = SPACE_COLOR_OPERATORS[token]
+                space = state['stroke' if stroke else 'fill']
+                if space == OTHER:
+                    raise NotRewritable("Цвет в неподдерживаемом цветовом пространстве")
+                self.rewrite_color(pieces, operands, pos, space, stroke, direct=False)
+            elif token == b'Do':
+                if operands and operands[-1][2][:1] == b'/':
+                    self.paint_xobject(operands[-1][2].decode('latin-1'), owner_xref, state)
+            operands = []
+
+        if not pieces:
+            return data
+        result = []
+        last = 0
+        for start, end, replacement in pieces:
+            result.append(data[last:start])
+            result.append(replacement)
+            last = end
+        result.append(data[last:])
+        return b''.join(result)
+
+    @staticmethod
+    def skip_string(data, pos):
+        """Позиция после строки в круглых скобках (с вложенными скобками и экранированием)"""
+        depth = 0
+        length = len(data)
+        while pos < length:
+            char = data[pos]
+            if char == 0x5C:  # '\'
+                pos += 2
+                continue
+            if char == 0x28:
+                depth += 1
+            elif char == 0x29:
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+            pos += 1
+        raise NotRewritable("Незакрытая строка в потоке содержимого")
+
+    def rewrite_initial_color(self, pieces, operator_end, space, stroke):
+        """Замена начального цвета, установленного оператором cs/CS: sc/SC сразу после него"""
+        rgb = components_to_rgb(space, INITIAL_COLORS[space])
+        new_rgb = self.map_rgb(rgb)
+        if new_rgb == rgb:
+            return
+        values = rgb_to_components(space, new_rgb)
+        if values is None:
+            raise NotRewritable("Новый цвет нельзя выразить в цветовом пространстве")
+        operator = ' SC' if stroke else ' sc'
+        text = ' ' + ' '.join(format_number(v) for v in values) + operator
+        pieces.append((operator_end, operator_end, text.encode()))
+        self.changed += 1
+
+    def rewrite_color(self, pieces, operands, operator_end, space, stroke, direct):
+        """Замена операндов (и при необходимости оператора) одного оператора цвета"""
+        if len(operands) != COMPONENTS[space] or not all(NUMBER_RE.match(op[2]) for op in operands):
+            if not direct:
+                # Пространство sc/SC могло быть определено неверно (например, после
+                # замены начального черного на RGB) - цвет нельзя проверить
+                raise NotRewritable("Операнды оператора цвета не соответствуют пространству")
+            # Некорректные операнды оставляем как есть
+            return
+        rgb = components_to_rgb(space, [float(op[2]) for op in operands])
+        new_rgb = self.map_rgb(rgb)
+        if new_rgb == rgb:
+            return
+
+        start = operands[0][0]
+        if direct and space != RGB:
+            # g/G/k/K заменяются вместе с оператором на rg/RG: следующий
+            # оператор цвета все равно задает пространство сам
+            values = rgb_to_components(RGB, new_rgb)
+            operator = ' RG' if stroke else ' rg'
+            end = operator_end
+        else:
+            values = rgb_to_components(space, new_rgb)
+            if values is None:
+                raise NotRewritable("Новый цвет нельзя выразить в цветовом пространстве")
+            operator = ''
+            end = operands[-1][1]
+        pieces.append((start, end, (' '.join(format_number(v) for v in values) + operator).encode()))
+        self.changed += 1
+
+    def paint_xobject(self, name, owner_xref, state):
+        """Обработка оператора Do: форма перекрашивается, изображение запоминается"""
+        kind, value = self.resource(owner_xref, 'XObject', name)
+        if kind != 'xref':
+            return
+        xref = int(value.split()[0])
+        subtype = self.doc.xref_get_key(xref, 'Subtype')[1]
+        if subtype == '/Form':
+            self.recolor_form(xref, owner_xref, state)
+        elif subtype == '/Image' and xref not in self.images and xref not in self.recolored:
+            self.images.append(xref)
+
+
+def recolor_page_vectors(doc, page, rules, recolored=None):
+    """Перекрашивание векторного содержимого страницы на месте
+
+    Возвращает True, если все замены удалось выполнить без растеризации.
+    При False документ не изменяется. recolored - множество xref, уже
+    перекрашенных в doc теми же rules (см. ContentRecolorer), дополняется.
+    """
+    try:
+        ContentRecolorer(doc, rules, recolored).recolor_page(page)
+    except NotRewritable:
+        return False
+    return True